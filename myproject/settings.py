@@ -27,6 +27,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Считает запросы к базе на запрос к сайту (см. shop/querybudget.py)
+    'shop.querybudget.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -105,6 +107,11 @@ LOGIN_REDIRECT_URL = '/'  # После входа - на главную
 LOGOUT_REDIRECT_URL = '/'  # После выхода - на главную
 LOGIN_URL = 'users:login'  # Страница для входа
 
+# Бюджет запросов к базе (shop/querybudget.py): True — превышение @query_budget
+# бросает исключение вместо предупреждения в логе (включается в тестах)
+QUERY_BUDGET_STRICT = False
+TEST_RUNNER = 'shop.testrunner.StrictQueryBudgetRunner'
+
 # ================================
 # EMAIL НАСТРОЙКИ ДЛЯ GMAIL
 # ================================
@@ -1,6 +1,14 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from .models import Category, Product, Order, OrderItem, Review
-from .models import Location
+from .models import Location, InventoryMovement, ArchivedOrder, ArchivedOrderItem
+from .checkout import cancel_order
+from .exports import CONTENT_TYPES, export_lines
+from .inventory import adjust_stock
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -10,16 +18,17 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ['name', 'slug', 'price', 'stock', 'available', 'created', 'updated']
-    list_filter = ['available', 'created', 'updated', 'category']
+    list_display = ['name', 'slug', 'price', 'stock', 'available', 'flash_sale', 'created', 'updated']
+    list_filter = ['available', 'flash_sale', 'created', 'updated', 'category']
     list_editable = ['price', 'stock', 'available']
+    readonly_fields = ['created', 'updated']  # Даты ставятся моделью
     prepopulated_fields = {'slug': ('name',)}
     fieldsets = (
         (None, {
             'fields': ('name', 'slug', 'description', 'category', 'price')
         }),
         ('Изображение и наличие', {
-            'fields': ('image', 'stock', 'available')
+            'fields': ('image', 'stock', 'available', 'flash_sale')
         }),
         ('Даты', {
             'fields': ('created', 'updated'),
@@ -27,18 +36,84 @@ class ProductAdmin(admin.ModelAdmin):
         }),
     )
 
+    def formfield_for_dbfield(self, db_field, request, **kwargs):
+        if db_field.name == 'stock':
+            # Форма и список отправляют и остаток, который видел администратор
+            # (скрытое initial-stock): от него считается разница в save_model
+            kwargs['show_hidden_initial'] = True
+        return super().formfield_for_dbfield(db_field, request, **kwargs)
+
+    def _shown_stock(self, form):
+        """Остаток на момент открытия формы; без скрытого поля — текущий из базы"""
+        field = form.fields['stock']
+        value = field.hidden_widget().value_from_datadict(form.data, form.files, form.add_initial_prefix('stock'))
+        try:
+            shown = field.to_python(value)
+        except ValidationError:
+            shown = None
+        return form.initial['stock'] if shown is None else shown
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            # Начальный остаток записывается в журнал сигналом создания товара
+            return super().save_model(request, obj, form, change)
+
+        with transaction.atomic():
+            # Остаток меняется на разницу с тем, что видел администратор, а не
+            # перезаписывается: продажи, прошедшие пока была открыта форма, не теряются
+            if 'stock' in form.changed_data:
+                delta = obj.stock - self._shown_stock(form)
+                if not adjust_stock(obj.pk, delta, note=f'Админка: {request.user.username}'):
+                    self.message_user(request, f'Остаток "{obj.name}" не изменен: на складе меньше {-delta} шт.',
+                                      level=messages.ERROR)
+            # Пишем только измененные поля, чтобы не затереть held и рейтинги
+            fields = [name for name in form.changed_data if name != 'stock']
+            obj.save(update_fields=fields + ['updated'])
+            obj.refresh_from_db(fields=['stock', 'available'])
+
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     raw_id_fields = ['product']
     extra = 0  # Не показывать пустые строки для новых товаров
 
 
+class OrderExportActions:
+    """Действия выгрузки позиций выбранных заказов (см. shop/exports.py) для заказов и архива"""
+    actions = ['export_csv', 'export_jsonl']
+
+    def _export(self, queryset, fmt):
+        # Выгрузка отдается потоком: память не растет с числом заказов
+        response = StreamingHttpResponse(export_lines(queryset, fmt), content_type=CONTENT_TYPES[fmt])
+        filename = f'orders-{timezone.localtime():%Y%m%d-%H%M}.{fmt}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @admin.action(description='Выгрузить позиции выбранных заказов в CSV')
+    def export_csv(self, request, queryset):
+        return self._export(queryset, 'csv')
+
+    @admin.action(description='Выгрузить позиции выбранных заказов в JSONL')
+    def export_jsonl(self, request, queryset):
+        return self._export(queryset, 'jsonl')
+
+
+class OrderAdminForm(forms.ModelForm):
+    def clean_status(self):
+        status = self.cleaned_data['status']
+        # Отмена вернула товар на склад; обратно в работу заказ не переводится,
+        # иначе его позиции снова считались бы проданными без списания остатка
+        if self.instance.pk and self.initial.get('status') == 'cancelled' and status != 'cancelled':
+            raise forms.ValidationError('Отмененный заказ нельзя вернуть в работу — оформите новый заказ')
+        return status
+
+
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'created', 'status', 'payment_method', 'total_price', 'paid']
+class OrderAdmin(OrderExportActions, admin.ModelAdmin):
+    form = OrderAdminForm
+    list_display = ['id', 'user', 'created', 'status', 'payment_method', 'item_count', 'total_price', 'paid']
     list_filter = ['status', 'paid', 'created', 'updated', 'payment_method']
     list_editable = ['status', 'paid']  # Можно редактировать прямо в списке
-    readonly_fields = ['created', 'updated']  # Эти поля только для чтения
+    readonly_fields = ['created', 'updated', 'item_count']  # Эти поля только для чтения
 
     # Поля в форме редактирования
     fieldsets = (
@@ -52,7 +127,7 @@ class OrderAdmin(admin.ModelAdmin):
             'fields': ('customer_name', 'customer_email', 'customer_phone')
         }),
         ('Дополнительно', {
-            'fields': ('payment_method', 'tracking_number', 'notes', 'created', 'updated')
+            'fields': ('payment_method', 'tracking_number', 'notes', 'item_count', 'created', 'updated')
         }),
     )
 
@@ -60,6 +135,62 @@ class OrderAdmin(admin.ModelAdmin):
     search_fields = ['id', 'user__username', 'customer_name', 'customer_email']
     date_hierarchy = 'created'
 
+    def get_changelist_form(self, request, **kwargs):
+        # Статус правится и прямо в списке (list_editable) — с той же проверкой
+        kwargs.setdefault('form', OrderAdminForm)
+        return super().get_changelist_form(request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        # Отмена возвращает товар на склад; статус меняет сама cancel_order
+        cancelling = change and 'status' in form.changed_data and obj.status == 'cancelled'
+        if cancelling:
+            obj.status = form.initial['status']
+        super().save_model(request, obj, form, change)
+        if cancelling:
+            cancel_order(obj)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Позиции могли поменяться в инлайне — сводка для списков пересчитывается
+        if any(formset.has_changed() for formset in formsets):
+            form.instance.refresh_summary()
+
+
+class ArchivedOrderItemInline(admin.TabularInline):
+    model = ArchivedOrderItem
+    raw_id_fields = ['product']
+    extra = 0
+    can_delete = False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ArchivedOrder)
+class ArchivedOrderAdmin(OrderExportActions, admin.ModelAdmin):
+    """Архив заказов только для просмотра (см. shop/archive.py)"""
+    list_display = ['id', 'user', 'created', 'status', 'payment_method', 'item_count', 'total_price', 'archived']
+    list_filter = ['status', 'payment_method']
+    search_fields = ['id', 'user__username', 'customer_name', 'customer_email']
+    inlines = [ArchivedOrderItemInline]
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(InventoryMovement)
+class InventoryMovementAdmin(admin.ModelAdmin):
+    list_display = ['product', 'kind', 'quantity', 'order', 'note', 'created']
+    list_filter = ['kind', 'created']
+    raw_id_fields = ['product', 'order']
+    search_fields = ['product__name', 'note']
+
 
 # Дополнительно: зарегистрируйте Review, если хотите
 @admin.register(Review)
@@ -0,0 +1,60 @@
+"""Архивация старых завершенных заказов.
+
+Доставленные и отмененные заказы старше ARCHIVE_AFTER переносятся вместе с
+позициями из Order/OrderItem в ArchivedOrder/ArchivedOrderItem с теми же id,
+так что рабочие таблицы (история заказов, админка, date_hierarchy) остаются
+маленькими. Перенос идет пачками по batch_size, каждая пачка — отдельная
+транзакция: копия в архив и удаление из рабочих таблиц видны вместе.
+
+Покупатель по-прежнему видит архивные заказы: история заказов читает обе
+таблицы и сливает страницы (shop/pagination.py), а order_detail ищет заказ
+в архиве, если его нет в Order.
+
+Заказы с несписанными позициями флеш-распродажи (stock_flushed=False) ждут
+flush_flash_stock: сверка остатков (shop/inventory.py) учитывает их только
+в рабочей таблице.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+ARCHIVE_AFTER = timedelta(days=180)
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_STATUSES = ('delivered', 'cancelled')
+
+ITEM_FIELDS = ('id', 'order_id', 'product_id', 'price', 'quantity')
+
+
+def archive_orders(older_than=ARCHIVE_AFTER, batch_size=ARCHIVE_BATCH_SIZE):
+    """Переносит старые завершенные заказы в архив; возвращает их число"""
+    candidates = (
+        Order.objects.filter(status__in=ARCHIVE_STATUSES, created__lt=timezone.now() - older_than)
+        .exclude(items__stock_flushed=False)
+    )
+    order_fields = [field.attname for field in Order._meta.concrete_fields]
+
+    total = 0
+    while True:
+        with transaction.atomic():
+            # Заказы, которые сейчас правят в админке, пропускаются до следующего запуска
+            batch = list(
+                candidates.select_for_update(skip_locked=True)
+                .order_by('pk')
+                .values_list(*order_fields)[:batch_size]
+            )
+            order_ids = [row[0] for row in batch]
+            if batch:
+                ArchivedOrder.objects.bulk_create(
+                    [ArchivedOrder(**dict(zip(order_fields, row))) for row in batch], batch_size=500
+                )
+                items = OrderItem.objects.filter(order_id__in=order_ids).values_list(*ITEM_FIELDS)
+                ArchivedOrderItem.objects.bulk_create(
+                    [ArchivedOrderItem(**dict(zip(ITEM_FIELDS, row))) for row in items], batch_size=500
+                )
+                Order.objects.filter(pk__in=order_ids).delete()
+        total += len(batch)
+        if len(batch) < batch_size:
+            return total
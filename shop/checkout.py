@@ -0,0 +1,208 @@
+"""Оформление заказа.
+
+Заказ, его позиции, списание остатков и очистка корзины выполняются в одной
+транзакции. Остатки всех позиций списываются одним условным UPDATE (см.
+Product.take_stock), позиции заказа вставляются одним bulk_create, поэтому
+число запросов не зависит от размера корзины. Если хотя бы одной позиции не
+хватает, транзакция откатывается целиком и на складе ничего не меняется.
+Холды покупателя (shop/holds.py) снимаются в той же транзакции, а при нехватке
+товара — и просроченные чужие холды этих товаров.
+
+Каждая проданная позиция пишется в журнал движения товара (shop/inventory.py)
+тем же пакетом, отмена заказа возвращает товар на склад и тоже попадает в
+журнал.
+
+Товары флеш-распродажи списываются не из строки товара, а со счетчиков
+FlashStock (shop/flash.py) в той же транзакции; откат заказа возвращает и их.
+
+Форма оформления несет ключ идемпотентности (CheckoutToken). Он сохраняется
+в той же транзакции, что и заказ, поэтому повторная отправка формы (двойной
+клик, обновление страницы после медленного ответа) не создает второй заказ:
+повтор после коммита находит заказ по ключу (find_order), а одновременный
+дубль откатывается на ограничении первичного ключа (DuplicateCheckout).
+
+Сводка заказа для истории и админки (Order.item_count, Order.preview)
+заполняется из уже загруженных товаров корзины при сохранении заказа;
+для старых заказов ее заполняет backfill_summaries
+(команда backfill_order_summaries).
+"""
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Prefetch, Value, When
+from django.utils import timezone
+
+from . import flash
+from .holds import release_expired, release_holds
+from .inventory import record
+from .models import CartItem, CheckoutToken, InventoryMovement, Order, OrderItem, Product, per_product
+
+
+class InsufficientStock(Exception):
+    """На складе меньше товара, чем в корзине"""
+
+    def __init__(self, product, requested):
+        self.product = product
+        self.requested = requested
+        super().__init__(f'Недостаточно товара "{product.name}" на складе')
+
+
+class DuplicateCheckout(Exception):
+    """Заказ с этим ключом уже сохранила другая отправка формы"""
+
+    def __init__(self, token):
+        self.token = token
+        super().__init__(f'Заказ по ключу {token} уже оформлен')
+
+
+def find_order(user, token):
+    """Заказ пользователя, оформленный с ключом token, или None"""
+    return Order.objects.filter(user=user, checkout_token__token=token).first()
+
+
+def _find_shortage(cart_items, quantities):
+    """Первая позиция, которой не хватает на складе (запрос только при отказе)"""
+    products = Product.objects.filter(pk__in=quantities).values_list('pk', 'stock', 'held')
+    left = {pk: stock - held for pk, stock, held in products}
+    for cart_item in cart_items:
+        if cart_item.product_id in quantities and left.get(cart_item.product_id, 0) < quantities[cart_item.product_id]:
+            return cart_item
+    return cart_items[0]
+
+
+def place_order(order, cart_items, token=None):
+    """Сохраняет заказ из позиций корзины и списывает остатки.
+
+    cart_items — сохраненные CartItem с загруженными товарами
+    (select_related('product')). Бросает
+    InsufficientStock, если какого-то товара не хватило; в этом случае ни
+    заказ, ни изменения остатков не сохраняются. Если передан token, а заказ
+    с таким ключом уже сохранен, транзакция откатывается с DuplicateCheckout.
+    """
+    cart_items = list(cart_items)
+    order.total_price = sum(item.get_total_price() for item in cart_items)
+    order.fill_summary([item.product for item in cart_items])
+    quantities = Counter()
+    flash_quantities = Counter()
+    for cart_item in cart_items:
+        target = flash_quantities if cart_item.product.flash_sale else quantities
+        target[cart_item.product_id] += cart_item.quantity
+
+    with transaction.atomic():
+        short = flash.take(flash_quantities)
+        if short is not None:
+            cart_item = next(item for item in cart_items if item.product_id == short)
+            raise InsufficientStock(cart_item.product, flash_quantities[short])
+
+        # Свои холды больше не нужны: их количество списывается из остатка ниже
+        release_holds(order.user_id)
+        # Товар могут держать просроченные чужие холды, которые sweep_holds еще не снял:
+        # при нехватке они снимаются сразу и списание повторяется (как в hold_cart)
+        if not Product.take_stock(quantities):
+            if not release_expired(product_ids=list(quantities)) or not Product.take_stock(quantities):
+                cart_item = _find_shortage(cart_items, quantities)
+                raise InsufficientStock(cart_item.product, quantities[cart_item.product_id])
+        order.save()
+        if token is not None:
+            try:
+                CheckoutToken.objects.create(token=token, user_id=order.user_id, order=order)
+            except IntegrityError:
+                raise DuplicateCheckout(token)
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=cart_item.product,
+                price=cart_item.product.price,
+                quantity=cart_item.quantity,
+                stock_flushed=not cart_item.product.flash_sale
+            )
+            for cart_item in cart_items
+        ])
+        record(
+            InventoryMovement(
+                product_id=cart_item.product_id,
+                kind=InventoryMovement.SALE,
+                quantity=-cart_item.quantity,
+                order=order
+            )
+            for cart_item in cart_items
+        )
+        CartItem.objects.filter(pk__in=[item.pk for item in cart_items]).delete()
+    return order
+
+
+def cancel_order(order):
+    """Отменяет заказ и возвращает его товары на склад.
+
+    Возвращает False, если заказ уже был отменен. Позиции флеш-распродажи,
+    которые еще не списаны из Product.stock, просто помечаются списанными, а
+    их количество возвращается на счетчик.
+    """
+    with transaction.atomic():
+        cancelled = Order.objects.filter(pk=order.pk).exclude(status='cancelled').update(
+            status='cancelled', updated=timezone.now()
+        )
+        if not cancelled:
+            return False
+        order.status = 'cancelled'
+
+        items = list(order.items.values_list('pk', 'product_id', 'quantity', 'stock_flushed', 'product__flash_sale'))
+        returned = Counter()
+        flash_returned = Counter()
+        unflushed = []
+        for pk, product_id, quantity, stock_flushed, flash_sale in items:
+            if stock_flushed:
+                returned[product_id] += quantity
+            else:
+                unflushed.append(pk)
+            if flash_sale:
+                flash_returned[product_id] += quantity
+
+        if unflushed:
+            OrderItem.objects.filter(pk__in=unflushed).update(stock_flushed=True)
+        if returned:
+            Product.objects.filter(pk__in=returned).update(
+                stock=F('stock') + per_product(returned),
+                # Распроданный товар возвращается в продажу
+                available=Case(When(stock=0, then=Value(True)), default=F('available')),
+                updated=timezone.now(),
+            )
+        record(
+            InventoryMovement(product_id=product_id, kind=InventoryMovement.CANCEL, quantity=quantity, order=order)
+            for _, product_id, quantity, _, _ in items
+        )
+        flash.give_back(flash_returned)
+    return True
+
+
+SUMMARY_BATCH_SIZE = 500
+
+
+def backfill_summaries(batch_size=SUMMARY_BATCH_SIZE, missing_only=True):
+    """Заполняет сводку заказов по их позициям пачками по batch_size.
+
+    По умолчанию только заказы без сводки (item_count = 0). Возвращает число
+    обновленных заказов.
+    """
+    orders = Order.objects.order_by('pk')
+    if missing_only:
+        orders = orders.filter(item_count=0)
+    items = OrderItem.objects.select_related('product').order_by('id')
+
+    total = 0
+    last_pk = 0
+    while True:
+        batch = list(
+            orders.filter(pk__gt=last_pk)
+            .only('pk', 'item_count', 'preview')
+            .prefetch_related(Prefetch('items', queryset=items))[:batch_size]
+        )
+        if not batch:
+            return total
+        for order in batch:
+            order.fill_summary([item.product for item in order.items.all()])
+        # Заказы без позиций так и остаются без сводки
+        changed = [order for order in batch if order.item_count or not missing_only]
+        Order.objects.bulk_update(changed, ['item_count', 'preview'])
+        total += len(changed)
+        last_pk = batch[-1].pk
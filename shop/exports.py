@@ -0,0 +1,121 @@
+"""Потоковая выгрузка заказов для службы доставки: CSV или JSONL.
+
+Одна строка выгрузки — одна позиция заказа с полями заказа и названием
+товара. Строки читаются одним запросом с JOIN'ами через
+.iterator(chunk_size), а на выход отдаются генератором, поэтому память не
+зависит от размера выгрузки, а первая строка (заголовок CSV) уходит клиенту
+еще до запроса к базе.
+
+Заказы, перенесенные в архив (shop/archive.py), читаются вторым таким же
+запросом из ArchivedOrderItem и сливаются с живыми по id заказа; колонка
+archived отмечает их строки.
+
+Используется действиями OrderAdmin и ArchivedOrderAdmin
+(StreamingHttpResponse) и командой export_orders.
+"""
+import csv
+import heapq
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import ArchivedOrder, ArchivedOrderItem, OrderItem
+
+EXPORT_CHUNK_SIZE = 2000
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+# Колонка выгрузки -> поле OrderItem
+COLUMNS = [
+    ('order_id', 'order_id'),
+    ('created', 'order__created'),
+    ('status', 'order__status'),
+    ('paid', 'order__paid'),
+    ('payment_method', 'order__payment_method'),
+    ('order_total', 'order__total_price'),
+    ('customer_name', 'order__customer_name'),
+    ('customer_email', 'order__customer_email'),
+    ('customer_phone', 'order__customer_phone'),
+    ('shipping_country', 'order__shipping_country'),
+    ('shipping_city', 'order__shipping_city'),
+    ('shipping_zip_code', 'order__shipping_zip_code'),
+    ('shipping_address', 'order__shipping_address'),
+    ('product_id', 'product_id'),
+    ('product_name', 'product__name'),
+    ('price', 'price'),
+    ('quantity', 'quantity'),
+]
+HEADER = [name for name, _ in COLUMNS] + ['archived']
+CREATED = HEADER.index('created')
+
+
+def filter_orders(orders, status=None, date_from=None, date_to=None):
+    """Заказы со статусом status, созданные с date_from по date_to включительно"""
+    if status:
+        orders = orders.filter(status=status)
+    # Границы дня в часовом поясе магазина, чтобы фильтр шел по индексу created
+    if date_from:
+        orders = orders.filter(created__gte=timezone.make_aware(datetime.combine(date_from, time.min)))
+    if date_to:
+        orders = orders.filter(created__lt=timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min)))
+    return orders
+
+
+def _item_rows(orders, chunk_size):
+    """(order_id, id позиции, строка выгрузки) позиций заказов или архивных заказов orders"""
+    archived = orders.model is ArchivedOrder
+    items = ArchivedOrderItem if archived else OrderItem
+    rows = (
+        items.objects.filter(order__in=orders.order_by().values('pk'))
+        .order_by('order_id', 'id')
+        .values_list('id', *(field for _, field in COLUMNS))
+    )
+    for item_id, *row in rows.iterator(chunk_size=chunk_size):
+        row[CREATED] = timezone.localtime(row[CREATED]).isoformat()
+        row.append(archived)
+        yield row[0], item_id, row
+
+
+def export_rows(orders, chunk_size=EXPORT_CHUNK_SIZE, archived_orders=None):
+    """Строки выгрузки (списки в порядке HEADER) для позиций заказов orders.
+
+    orders — заказы Order или ArchivedOrder. archived_orders — архивные
+    заказы, которые выгружаются вместе с orders в общем порядке id заказа.
+    """
+    sources = [_item_rows(orders, chunk_size)]
+    if archived_orders is not None:
+        sources.append(_item_rows(archived_orders, chunk_size))
+    for _, _, row in heapq.merge(*sources, key=lambda entry: entry[:2]):
+        yield row
+
+
+class _Echo:
+    """Файл для csv.writer, который возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(HEADER)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(HEADER, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def export_lines(orders, fmt, chunk_size=EXPORT_CHUNK_SIZE, archived_orders=None):
+    """Генератор строк выгрузки в формате fmt ('csv' или 'jsonl')"""
+    rows = export_rows(orders, chunk_size=chunk_size, archived_orders=archived_orders)
+    if fmt == 'jsonl':
+        return jsonl_lines(rows)
+    return csv_lines(rows)
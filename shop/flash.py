@@ -0,0 +1,167 @@
+"""Счетчики остатков для флеш-распродаж (товары с Product.flash_sale).
+
+На распродаже тысячи заказов приходятся на одну строку товара. Для
+флеш-товаров остаток для продажи хранится в отдельной строке FlashStock:
+оформление заказа списывает его условным UPDATE
+(SET remaining = remaining - n WHERE remaining >= n) в транзакции заказа и не
+пишет в строку товара вовсе. Поэтому продажи не меняют Product.updated и не
+сбрасывают кэши каталога, а счетчик один на все процессы: он лежит в базе,
+а не в кэше процесса.
+
+Списания копятся в позициях заказа с stock_flushed=False и переносятся в
+Product.stock функцией flush (команда flush_flash_stock, запускается по
+расписанию). Счетчик и позиции заказа меняются в одной транзакции, поэтому
+всегда remaining = stock - несписанные позиции. reconcile выставляет счетчик
+по этому равенству под блокировкой строки счетчика (после правки остатка);
+недостающие строки создаются без перезаписи существующих.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import FlashStock, OrderItem, Product, per_product
+
+FLUSH_BATCH_SIZE = 1000
+
+
+def _unflushed(product_ids):
+    rows = (
+        OrderItem.objects.filter(stock_flushed=False, product_id__in=product_ids)
+        .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    return dict(rows)
+
+
+def _expected(product_ids):
+    """{id флеш-товара: stock - несписанные позиции} по базе"""
+    stocks = dict(Product.objects.filter(flash_sale=True, pk__in=product_ids).values_list('pk', 'stock'))
+    unflushed = _unflushed(list(stocks))
+    return {pk: max(stock - unflushed.get(pk, 0), 0) for pk, stock in stocks.items()}
+
+
+def _ensure(product_ids):
+    """Создает недостающие счетчики; существующие не трогает (ignore_conflicts)"""
+    missing = set(product_ids) - set(FlashStock.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+    if missing:
+        FlashStock.objects.bulk_create(
+            [FlashStock(product_id=pk, remaining=left) for pk, left in _expected(missing).items()],
+            ignore_conflicts=True,
+        )
+
+
+def reconcile(product_ids=None):
+    """Выставляет счетчики флеш-товаров по базе: stock минус несписанные позиции.
+
+    Значение считается подзапросами в самом UPDATE, а строки счетчиков сначала
+    блокируются (select_for_update): заказ, уже списавший счетчик, к этому
+    моменту сохранил и свои позиции, и его списание не затирается.
+    """
+    products = Product.objects.filter(flash_sale=True)
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+    product_ids = list(products.values_list('pk', flat=True))
+    if not product_ids:
+        return 0
+    _ensure(product_ids)
+    stock = Product.objects.filter(pk=OuterRef('pk')).values('stock')
+    unflushed = (
+        OrderItem.objects.filter(product_id=OuterRef('pk'), stock_flushed=False)
+        .values('product_id').annotate(total=Sum('quantity')).values('total')
+    )
+    with transaction.atomic():
+        counters = FlashStock.objects.select_for_update().filter(pk__in=product_ids)
+        list(counters.values_list('pk'))
+        counters.update(remaining=Greatest(Subquery(stock) - Coalesce(Subquery(unflushed), 0), 0))
+    return len(product_ids)
+
+
+def stock_left(product_id):
+    """Остаток флеш-товара по счетчику"""
+    left = FlashStock.objects.filter(pk=product_id).values_list('remaining', flat=True).first()
+    if left is None:
+        _ensure([product_id])
+        left = FlashStock.objects.filter(pk=product_id).values_list('remaining', flat=True).first()
+    return left or 0
+
+
+def _take_all(quantities):
+    enough = Q()
+    for product_id, quantity in quantities.items():
+        enough |= Q(pk=product_id, remaining__gte=quantity)
+    with transaction.atomic():
+        updated = FlashStock.objects.filter(enough).update(remaining=F('remaining') - per_product(quantities))
+        if updated != len(quantities):
+            transaction.set_rollback(True)
+            return False
+    return True
+
+
+def take(quantities):
+    """Списывает {id товара: количество} со счетчиков одним условным UPDATE.
+
+    Вызывается в транзакции заказа: при ее откате списанное возвращается само.
+    Все или ничего: если какого-то товара не хватило, не списывается ничего и
+    возвращается id этого товара. None — списано все.
+    """
+    if not quantities or _take_all(quantities):
+        return None
+    counters = dict(FlashStock.objects.filter(pk__in=quantities).values_list('pk', 'remaining'))
+    if len(counters) < len(quantities):
+        # Первый заказ после включения распродажи: счетчика еще нет
+        _ensure(quantities)
+        if _take_all(quantities):
+            return None
+        counters = dict(FlashStock.objects.filter(pk__in=quantities).values_list('pk', 'remaining'))
+    return next(pk for pk, quantity in quantities.items() if counters.get(pk, 0) < quantity)
+
+
+def give_back(quantities):
+    """Возвращает списанное на счетчики (отмена заказа); вызывается в ее транзакции"""
+    if quantities:
+        FlashStock.objects.filter(pk__in=quantities).update(remaining=F('remaining') + per_product(quantities))
+
+
+def flush(product_ids=None, batch_size=FLUSH_BATCH_SIZE):
+    """Переносит списания из несписанных позиций заказов в Product.stock.
+
+    Возвращает число перенесенных позиций.
+    """
+    pending = OrderItem.objects.filter(stock_flushed=False)
+    if product_ids is not None:
+        pending = pending.filter(product_id__in=product_ids)
+
+    total = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                pending.select_for_update(skip_locked=True)
+                .order_by('pk')
+                .values_list('pk', 'product_id', 'quantity')[:batch_size]
+            )
+            totals = Counter()
+            for _, product_id, quantity in batch:
+                totals[product_id] += quantity
+            if totals:
+                OrderItem.objects.filter(pk__in=[pk for pk, _, _ in batch]).update(stock_flushed=True)
+                taken = per_product(totals)
+                Product.objects.filter(pk__in=totals).update(
+                    stock=F('stock') - taken,
+                    available=Case(When(stock=taken, then=Value(False)), default=F('available')),
+                    updated=timezone.now(),
+                )
+        total += len(batch)
+        if len(batch) < batch_size:
+            return total
+
+
+def product_saved(product):
+    """Синхронизирует счетчик после сохранения товара (админка, поступление)"""
+    if product.flash_sale:
+        reconcile([product.pk])
+    else:
+        # Распродажа выключена: несписанное переносим в базу, счетчик больше не нужен
+        flush([product.pk])
+        FlashStock.objects.filter(pk=product.pk).delete()
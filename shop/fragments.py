@@ -0,0 +1,45 @@
+"""Кэш HTML карточек товаров в списках (каталог, главная).
+
+Карточка кэшируется по шаблону, id товара и Product.updated: любое изменение
+строки товара (правка, продажа, холд, пересчет рейтинга) меняет updated, и
+карточка перерисовывается. Все карточки страницы читаются одним get_many,
+рендерятся только промахи, и они же пишутся одним set_many.
+
+Остаток флеш-товара живет в счетчике FlashStock (shop/flash.py) и меняется
+без записи в строку товара, поэтому такие карточки рендерятся каждый раз.
+
+В карточке вместо CSRF-токена стоит метка кэша страниц: токен посетителя
+подставляет shop/pagecache.py при отдаче страницы.
+"""
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .pagecache import CSRF_MARKER
+
+CARD_CACHE_KEY = 'card:{}:{}:{}'
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def card_key(template_name, product):
+    return CARD_CACHE_KEY.format(template_name, product.pk, product.updated.timestamp())
+
+
+def render_cards(products, template_name):
+    """HTML карточек products в том же порядке"""
+    products = list(products)
+    keys = [None if product.flash_sale else card_key(template_name, product) for product in products]
+    cards = cache.get_many([key for key in keys if key])
+
+    missing = {}
+    result = []
+    for key, product in zip(keys, products):
+        card = cards.get(key) if key else None
+        if card is None:
+            card = render_to_string(template_name, {'product': product, 'csrf_token': CSRF_MARKER})
+            if key:
+                missing[key] = card
+        result.append(mark_safe(card))
+    if missing:
+        cache.set_many(missing, CARD_CACHE_TIMEOUT)
+    return result
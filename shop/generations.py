@@ -0,0 +1,104 @@
+"""Поколения кэшей в памяти процесса: сброс во всех воркерах через базу.
+
+Индекс локаций, список категорий и метки кэша страниц живут в памяти каждого
+процесса gunicorn. Изменение данных меняет метку своего пространства имен в
+таблице CacheGeneration (сигналы моделей, shop/signals.py). Процесс, прежде
+чем взять что-то из своего кэша, проверяет метки: не чаще раза в
+CHECK_INTERVAL секунд читает таблицу одним запросом и сбрасывает кэши
+пространств, чья метка сменилась. Запросы, которые таких кэшей не касаются,
+таблицу не читают. Общий сервер кэша для этого не нужен; другие процессы
+видят правку с задержкой до CHECK_INTERVAL.
+
+Метка — time.time_ns() последней смены, а не счетчик: после отката
+транзакции следующая смена не повторит значение, уже увиденное процессами.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import CacheGeneration
+
+CHECK_INTERVAL = 1.0
+
+
+class Generations:
+    def __init__(self):
+        self._versions = {}
+        self._callbacks = defaultdict(list)
+        # None — при следующей проверке прочитать таблицу сразу
+        self._checked_at = None
+
+    def on_change(self, namespace, callback):
+        """Регистрирует сброс кэша процесса при смене метки namespace"""
+        self._callbacks[namespace].append(callback)
+
+    def check(self):
+        """Сбрасывает кэши, чьи метки сменились; таблица читается не чаще CHECK_INTERVAL"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < CHECK_INTERVAL:
+            return
+        versions = dict(CacheGeneration.objects.values_list('namespace', 'version'))
+        for namespace in set(versions) | set(self._callbacks):
+            version = versions.get(namespace, 0)
+            if self._versions.get(namespace) != version:
+                self._versions[namespace] = version
+                for callback in self._callbacks[namespace]:
+                    callback()
+        # Время проверки ставится после чтения: иначе соседний поток, пока таблица
+        # читается, пропустил бы проверку и взял старую метку
+        self._checked_at = now
+
+    def version(self, namespace):
+        """Метка namespace, которую сейчас видит процесс"""
+        self.check()
+        return self._versions.get(namespace, 0)
+
+    def bump(self, namespace):
+        """Меняет метку namespace для всех процессов, кэши этого сбрасываются сразу"""
+        CacheGeneration.objects.bulk_create(
+            [CacheGeneration(namespace=namespace, version=time.time_ns())],
+            update_conflicts=True, unique_fields=['namespace'], update_fields=['version'],
+        )
+        for callback in self._callbacks[namespace]:
+            callback()
+        self.expire()
+        # Повторно после коммита: другой поток мог прочитать старую метку и старые данные
+        transaction.on_commit(self.expire)
+
+    def expire(self):
+        """Следующая проверка прочитает таблицу, не дожидаясь CHECK_INTERVAL"""
+        self._checked_at = None
+
+
+generations = Generations()
+
+
+class LocalCache:
+    """Значение, вычисляемое раз на процесс и сбрасываемое при смене метки namespace"""
+
+    def __init__(self, namespace, build):
+        self._build = build
+        self._lock = threading.Lock()
+        self._value = None
+        # Растет при каждом сбросе: значение, построенное до сброса, не сохраняется
+        self._generation = 0
+        generations.on_change(namespace, self.invalidate)
+
+    def get(self):
+        generations.check()
+        value = self._value
+        if value is None:
+            with self._lock:
+                value = self._value
+                if value is None:
+                    generation = self._generation
+                    value = self._build()
+                    if generation == self._generation:
+                        self._value = value
+        return value
+
+    def invalidate(self):
+        self._generation += 1
+        self._value = None
\ No newline at end of file
@@ -0,0 +1,139 @@
+"""Временные резервы (холды) товара на время оформления заказа.
+
+Открытие order_create ставит на позиции корзины холды с TTL, чтобы товар не
+ушел другому покупателю, пока заполняется форма. Сумма холдов товара хранится
+в Product.held и меняется условным UPDATE строк товаров (вся корзина — одним
+запросом): WHERE stock >= held + q. Тысячи холдов на один горячий товар конкурируют
+только за эту строку, а остаток для продажи (stock - held) читается без
+агрегатов.
+
+Товары флеш-распродажи не удерживаются: их остаток защищает счетчик
+(shop/flash.py), а холд писал бы в ту самую строку товара, которую счетчик
+разгружает.
+
+Просроченные холды учитываются в held, пока их не удалит release_expired
+(команда sweep_holds). Если товара не хватает, просроченные холды товаров
+корзины удаляются сразу и попытка повторяется. Число запросов hold_cart не
+зависит от размера корзины.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import Product, StockHold, per_product
+
+HOLD_TTL = timedelta(minutes=15)
+SWEEP_BATCH_SIZE = 1000
+
+
+def _release(holds):
+    """Удаляет холды [(pk, product_id, quantity)] и уменьшает held товаров"""
+    totals = Counter()
+    for _, product_id, quantity in holds:
+        totals[product_id] += quantity
+    if totals:
+        StockHold.objects.filter(pk__in=[pk for pk, _, _ in holds]).delete()
+        Product.objects.filter(pk__in=totals).update(
+            held=F('held') - per_product(totals), updated=timezone.now()
+        )
+    return totals
+
+
+def release_holds(user):
+    """Снимает все холды пользователя; вызывается внутри транзакции"""
+    holds = StockHold.objects.select_for_update().filter(user=user)
+    return _release(list(holds.values_list('pk', 'product_id', 'quantity')))
+
+
+def _try_hold_all(quantities):
+    """Увеличивает held всех товаров {id: количество} одним условным UPDATE.
+
+    Если хоть одного товара не хватило, не меняется ничего и возвращается False.
+    """
+    enough = Q()
+    for product_id, quantity in quantities.items():
+        enough |= Q(pk=product_id, stock__gte=F('held') + quantity)
+    with transaction.atomic():
+        updated = Product.objects.filter(enough).update(
+            held=F('held') + per_product(quantities), updated=timezone.now()
+        )
+        if updated != len(quantities):
+            transaction.set_rollback(True)
+            return False
+    return True
+
+
+def hold_cart(user, cart_items, ttl=HOLD_TTL):
+    """Ставит холды на позиции корзины взамен прежних холдов пользователя.
+
+    Холды ставятся все или ни одного. Возвращает позиции, которые удержать
+    не удалось: остаток за вычетом чужих холдов меньше количества в корзине.
+    """
+    quantities = Counter()
+    for cart_item in cart_items:
+        if not cart_item.product.flash_sale:
+            quantities[cart_item.product_id] += cart_item.quantity
+
+    with transaction.atomic():
+        release_holds(user)
+        # Обычно товара хватает, и вся корзина удерживается одним UPDATE
+        if quantities and not _try_hold_all(quantities):
+            # Товар могут держать просроченные холды: снимаем их и пробуем еще раз
+            release_expired(product_ids=list(quantities))
+            if not _try_hold_all(quantities):
+                return _missing(cart_items, quantities)
+        expires_at = timezone.now() + ttl
+        StockHold.objects.bulk_create([
+            StockHold(product_id=product_id, user=user, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in quantities.items()
+        ])
+    return []
+
+
+def _missing(cart_items, quantities):
+    """Позиции корзины, которых не хватает с учетом чужих холдов (один SELECT)"""
+    rows = Product.objects.filter(pk__in=quantities).values_list('pk', 'stock', 'held')
+    short = {pk for pk, stock, held in rows if stock - held < quantities[pk]}
+    return [cart_item for cart_item in cart_items if cart_item.product_id in short]
+
+
+def release_expired(product_ids=None, batch_size=SWEEP_BATCH_SIZE):
+    """Удаляет просроченные холды пачками по batch_size; возвращает их число"""
+    now = timezone.now()
+    expired = StockHold.objects.filter(expires_at__lte=now)
+    if product_ids is not None:
+        expired = expired.filter(product_id__in=product_ids)
+
+    total = 0
+    while True:
+        with transaction.atomic():
+            # Холды, которые сейчас снимает оформление заказа, пропускаются
+            batch = list(
+                expired.select_for_update(skip_locked=True)
+                .order_by('expires_at', 'pk')
+                .values_list('pk', 'product_id', 'quantity')[:batch_size]
+            )
+            _release(batch)
+        total += len(batch)
+        if len(batch) < batch_size:
+            return total
+
+
+def rebuild_held(product_ids=None):
+    """Пересчитывает Product.held по таблице холдов (например, после каскадного удаления)"""
+    holds = StockHold.objects.all()
+    products = Product.objects.all()
+    if product_ids is not None:
+        holds = holds.filter(product_id__in=product_ids)
+        products = products.filter(pk__in=product_ids)
+
+    totals = dict(holds.values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total'))
+    with transaction.atomic():
+        products.update(held=0, updated=timezone.now())
+        Product.objects.bulk_update(
+            [Product(pk=pk, held=total) for pk, total in totals.items()], ['held'], batch_size=500
+        )
+    return len(totals)
@@ -0,0 +1,152 @@
+"""Журнал движения товара: приход, продажа, отмена заказа, корректировка.
+
+Каждое изменение остатка пишет InventoryMovement со знаком: приход и отмена
+увеличивают остаток, продажа уменьшает. Журнал только дополняется, а
+compact() периодически сворачивает старые движения в InventorySnapshot
+товара и удаляет их. Остаток по журналу — снимок плюс короткий хвост
+движений после него.
+
+reconcile() сверяет журнал с Product.stock и с суммами позиций заказов
+(вместе с архивными, см. shop/archive.py), проходя товары кусками по
+chunk_size, так что память не зависит от размера таблиц.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, F, Sum, Value, When
+from django.utils import timezone
+
+from . import flash
+from .models import ArchivedOrderItem, InventoryMovement, InventorySnapshot, OrderItem, Product, per_product
+
+COMPACT_AFTER = timedelta(days=30)
+COMPACT_BATCH_SIZE = 5000
+RECONCILE_CHUNK_SIZE = 1000
+
+SALE_KINDS = [InventoryMovement.SALE, InventoryMovement.CANCEL]
+
+
+def record(movements):
+    """Записывает движения одним INSERT"""
+    InventoryMovement.objects.bulk_create(list(movements), batch_size=1000)
+
+
+def adjust_stock(product_id, delta, kind=InventoryMovement.ADJUSTMENT, note='', make_available=False):
+    """Меняет остаток на delta F-выражением и пишет движение.
+
+    Остаток не уходит в минус: тогда ничего не меняется и возвращается False.
+    Товар, распроданный до нуля, снимается с продажи, а пополненный с нуля
+    (или любой пополненный при make_available) — возвращается в продажу.
+    """
+    if not delta:
+        return True
+    if delta < 0:
+        available = Case(When(stock=-delta, then=Value(False)), default=F('available'))
+    elif make_available:
+        available = Value(True)
+    else:
+        available = Case(When(stock=0, then=Value(True)), default=F('available'))
+
+    with transaction.atomic():
+        updated = Product.objects.filter(pk=product_id, stock__gte=-delta).update(
+            stock=F('stock') + delta,
+            available=available,
+            updated=timezone.now(),
+        )
+        if updated:
+            record([InventoryMovement(product_id=product_id, kind=kind, quantity=delta, note=note)])
+            # Счетчик флеш-распродажи выставляется по новому остатку в той же транзакции
+            flash.reconcile([product_id])
+    return bool(updated)
+
+
+def ledger_totals(product_ids):
+    """{id товара: (остаток, продано)} по снимкам и хвосту журнала"""
+    totals = defaultdict(lambda: [0, 0])
+    snapshots = InventorySnapshot.objects.filter(pk__in=product_ids).values_list('pk', 'quantity', 'sold')
+    for pk, quantity, sold in snapshots:
+        totals[pk] = [quantity, sold]
+    rows = (
+        InventoryMovement.objects.filter(product_id__in=product_ids)
+        .values('product_id', 'kind').annotate(total=Sum('quantity')).values_list('product_id', 'kind', 'total')
+    )
+    for product_id, kind, total in rows:
+        totals[product_id][0] += total
+        if kind in SALE_KINDS:
+            totals[product_id][1] -= total
+    return {pk: tuple(values) for pk, values in totals.items()}
+
+
+def compact(older_than=COMPACT_AFTER, batch_size=COMPACT_BATCH_SIZE):
+    """Сворачивает движения старше older_than в снимки; возвращает их число"""
+    old = InventoryMovement.objects.filter(created__lt=timezone.now() - older_than)
+    total = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                old.select_for_update(skip_locked=True)
+                .order_by('pk')
+                .values_list('pk', 'product_id', 'kind', 'quantity')[:batch_size]
+            )
+            quantities = Counter()
+            sold = Counter()
+            for _, product_id, kind, quantity in batch:
+                quantities[product_id] += quantity
+                if kind in SALE_KINDS:
+                    sold[product_id] -= quantity
+            if batch:
+                InventorySnapshot.objects.bulk_create(
+                    [InventorySnapshot(product_id=pk) for pk in quantities], ignore_conflicts=True
+                )
+                InventorySnapshot.objects.filter(pk__in=quantities).update(
+                    quantity=F('quantity') + per_product(quantities),
+                    sold=F('sold') + per_product(sold),
+                    updated=timezone.now(),
+                )
+                InventoryMovement.objects.filter(pk__in=[row[0] for row in batch]).delete()
+        total += len(batch)
+        if len(batch) < batch_size:
+            return total
+
+
+def reconcile(chunk_size=RECONCILE_CHUNK_SIZE):
+    """Сверяет журнал с остатками и заказами; возвращает (проверено товаров, расхождения).
+
+    Расхождение — кортеж (id товара, что сверялось, по журналу, фактически).
+    Несписанные продажи флеш-распродажи (shop/flash.py) уже есть в журнале,
+    но еще не в Product.stock, поэтому учитываются при сравнении остатка.
+    """
+    checked = 0
+    mismatches = []
+    last_pk = 0
+    while True:
+        chunk = list(
+            Product.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'stock')[:chunk_size]
+        )
+        if not chunk:
+            return checked, mismatches
+        product_ids = [pk for pk, _ in chunk]
+        last_pk = product_ids[-1]
+
+        ledger = ledger_totals(product_ids)
+        items = OrderItem.objects.filter(product_id__in=product_ids)
+        ordered = Counter()
+        for sold_items in (items, ArchivedOrderItem.objects.filter(product_id__in=product_ids)):
+            ordered.update(dict(
+                sold_items.exclude(order__status='cancelled')
+                .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+            ))
+        unflushed = dict(
+            items.filter(stock_flushed=False)
+            .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+        )
+
+        for pk, stock in chunk:
+            ledger_stock, ledger_sold = ledger.get(pk, (0, 0))
+            actual_stock = stock - unflushed.get(pk, 0)
+            if ledger_stock != actual_stock:
+                mismatches.append((pk, 'stock', ledger_stock, actual_stock))
+            if ledger_sold != ordered.get(pk, 0):
+                mismatches.append((pk, 'sold', ledger_sold, ordered.get(pk, 0)))
+        checked += len(chunk)
@@ -0,0 +1,159 @@
+"""Префиксный индекс названий локаций в памяти процесса.
+
+api_locations вызывается на каждое нажатие клавиши в поле города. Запрос
+name__istartswith на SQLite сканирует всю таблицу и не приводит кириллицу к
+одному регистру, поэтому подсказки отдаются из отсортированного списка
+нормализованных названий: поиск префикса — это bisect и срез.
+
+Индекс строится лениво при первом запросе и сбрасывается сигналами Location
+во всех процессах через метку поколения (shop/generations.py).
+
+Для опечаток есть нечеткий режим: триграммы названий хранятся в таблице
+LocationTrigram, кандидаты выбираются одним GROUP BY по покрывающему индексу
+и ранжируются по сходству Жаккара, как pg_trgm.
+"""
+import math
+import re
+import threading
+from bisect import bisect_left
+
+from django.db.models import Count
+
+from .generations import generations
+from .models import Location, LocationTrigram
+
+SPACES_RE = re.compile(r'\s+')
+
+LOCATIONS_NAMESPACE = 'locations'
+
+# Нечеткий поиск: короче этого термина работает обычный префиксный путь
+FUZZY_MIN_LENGTH = 3
+SIMILARITY_THRESHOLD = 0.3
+FUZZY_CANDIDATES = 50
+
+
+def clean_name(name):
+    """Название для хранения: без лишних пробелов"""
+    return SPACES_RE.sub(' ', (name or '').strip())
+
+
+def normalize_name(name):
+    """Ключ для сравнения: без регистра, ё -> е, одиночные пробелы"""
+    return clean_name(name).casefold().replace('ё', 'е')
+
+
+class LocationIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+        # Растет при каждом сбросе: индекс, построенный до сброса, не сохраняется
+        self._generation = 0
+
+    def _build(self):
+        rows = {False: [], True: []}
+        for name, is_country in Location.objects.values_list('name', 'is_country').iterator(chunk_size=5000):
+            rows[is_country].append((normalize_name(name), name))
+
+        entries = {}
+        for is_country, pairs in rows.items():
+            pairs.sort()
+            entries[is_country] = (
+                [key for key, _ in pairs],
+                [name for _, name in pairs],
+            )
+        return entries
+
+    def _get_entries(self):
+        generations.check()
+        entries = self._entries
+        if entries is None:
+            with self._lock:
+                entries = self._entries
+                if entries is None:
+                    generation = self._generation
+                    entries = self._build()
+                    if generation == self._generation:
+                        self._entries = entries
+        return entries
+
+    def invalidate(self):
+        self._generation += 1
+        self._entries = None
+
+    def fuzzy_search(self, term, is_country=False, limit=10):
+        """Названия, похожие на term, от самых похожих; для коротких term — префиксный поиск"""
+        key = normalize_name(term)
+        if len(key) < FUZZY_MIN_LENGTH:
+            return self.search(term, is_country=is_country, limit=limit)
+
+        query_trigrams = trigrams(key)
+        min_shared = max(1, math.ceil(SIMILARITY_THRESHOLD * len(query_trigrams) / (1 + SIMILARITY_THRESHOLD)))
+        candidates = (
+            LocationTrigram.objects
+            .filter(trigram__in=query_trigrams, is_country=bool(is_country))
+            .values('location_id')
+            .annotate(shared=Count('location_id'))
+            .filter(shared__gte=min_shared)
+            .order_by('-shared')[:FUZZY_CANDIDATES]
+        )
+        shared_by_id = {row['location_id']: row['shared'] for row in candidates}
+        names = Location.objects.filter(pk__in=shared_by_id).values_list('pk', 'name')
+
+        ranked = []
+        for pk, name in names:
+            shared = shared_by_id[pk]
+            total = len(query_trigrams) + len(trigrams(normalize_name(name))) - shared
+            similarity = shared / total if total else 0
+            if similarity >= SIMILARITY_THRESHOLD:
+                ranked.append((-similarity, normalize_name(name), name))
+        ranked.sort()
+        return [name for _, _, name in ranked[:limit]]
+
+    def search(self, term, is_country=False, limit=10):
+        """Первые limit названий, начинающихся с term, по алфавиту"""
+        keys, names = self._get_entries()[bool(is_country)]
+        prefix = normalize_name(term)
+        position = bisect_left(keys, prefix)
+        result = []
+        while position < len(keys) and len(result) < limit and keys[position].startswith(prefix):
+            result.append(names[position])
+            position += 1
+        return result
+
+
+location_index = LocationIndex()
+generations.on_change(LOCATIONS_NAMESPACE, location_index.invalidate)
+
+
+def trigrams(key):
+    """Множество триграмм нормализованного названия; слова дополняются пробелами"""
+    result = set()
+    for word in key.split():
+        padded = f'  {word} '
+        for position in range(len(padded) - 2):
+            result.add(padded[position:position + 3])
+    return result
+
+
+def index_trigrams(locations, batch_size=5000):
+    """Перестраивает строки LocationTrigram для переданных (сохраненных) локаций"""
+    locations = list(locations)
+    # У триграмм нет сигналов и зависимых строк: delete() — один DELETE без загрузки объектов
+    LocationTrigram.objects.filter(location__in=[location.pk for location in locations]).delete()
+    rows = [
+        LocationTrigram(trigram=trigram, location_id=location.pk, is_country=location.is_country)
+        for location in locations
+        for trigram in trigrams(normalize_name(location.name))
+    ]
+    LocationTrigram.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
+
+
+def locations_version():
+    """Метка версии таблицы локаций для ETag ответов api_locations"""
+    return str(generations.version(LOCATIONS_NAMESPACE))
+
+
+def locations_changed():
+    """Сбрасывает индекс и метку версии во всех процессах после изменения таблицы локаций"""
+    generations.bump(LOCATIONS_NAMESPACE)
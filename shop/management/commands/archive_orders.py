@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from shop.archive import ARCHIVE_AFTER, ARCHIVE_BATCH_SIZE, archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Переносит старые доставленные и отмененные заказы в архивные таблицы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER.days,
+                            help='архивировать заказы старше стольких дней')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                            help='сколько заказов переносить за одну транзакцию')
+
+    def handle(self, *args, **options):
+        archived = archive_orders(
+            older_than=timedelta(days=options['older_than_days']),
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Перенесено в архив заказов: {archived}'))
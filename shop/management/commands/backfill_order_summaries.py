@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop.checkout import SUMMARY_BATCH_SIZE, backfill_summaries
+
+
+class Command(BaseCommand):
+    help = 'Заполняет сводку заказов (число позиций и превью товаров) для истории и админки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SUMMARY_BATCH_SIZE,
+                            help='сколько заказов обновлять за один запрос')
+        parser.add_argument('--all', action='store_true',
+                            help='пересчитать сводку всех заказов, а не только незаполненных')
+
+    def handle(self, *args, **options):
+        updated = backfill_summaries(batch_size=options['batch_size'], missing_only=not options['all'])
+        self.stdout.write(self.style.SUCCESS(f'Обновлена сводка заказов: {updated}'))
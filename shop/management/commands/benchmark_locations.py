@@ -0,0 +1,98 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from shop.locations import index_trigrams, location_index
+from shop.models import Location
+from shop.views import api_locations
+
+# Буквы с частотами русского языка: распределение триграмм ближе к настоящим названиям
+LETTERS = 'оеаинтсрвлкмдпуяыьгзбчйхжшюцщэфё'
+LETTER_WEIGHTS = [10.9, 8.5, 8.0, 7.4, 6.7, 6.3, 5.5, 4.7, 4.5, 4.4, 3.5, 3.2, 3.0, 2.8, 2.6, 2.0,
+                  1.9, 1.7, 1.7, 1.6, 1.6, 1.2, 1.0, 0.9, 0.7, 0.6, 0.5, 0.4, 0.4, 0.3, 0.3, 0.1]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ('Замеряет задержку api_locations на синтетической таблице локаций. '
+            'Данные создаются внутри транзакции и откатываются в конце.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000)
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        factory = RequestFactory()
+
+        with transaction.atomic():
+            names = []
+            for _ in range(options['rows']):
+                name = ''.join(rng.choices(LETTERS, LETTER_WEIGHTS, k=rng.randint(5, 12)))
+                names.append(name.capitalize())
+            locations = Location.objects.bulk_create(
+                [Location(name=name, is_country=False) for name in names], batch_size=5000
+            )
+            for start in range(0, len(locations), 5000):
+                index_trigrams(locations[start:start + 5000])
+            location_index.invalidate()
+
+            terms = []
+            for _ in range(options['queries']):
+                name = rng.choice(names)
+                terms.append(name[:rng.randint(1, min(5, len(name)))].lower())
+
+            started = time.perf_counter()
+            location_index.search('', is_country=False)
+            self.stdout.write(f'Построение индекса: {(time.perf_counter() - started) * 1000:.1f} мс')
+
+            self._report('Индекс в памяти', [
+                self._time(api_locations, factory.get('/shop/api/locations/', {'term': term, 'type': 'city'}))
+                for term in terms
+            ])
+            self._report('Нечеткий поиск', [
+                self._time(api_locations, factory.get(
+                    '/shop/api/locations/', {'term': self._typo(rng, rng.choice(names)), 'mode': 'fuzzy'}
+                ))
+                for _ in range(min(options['queries'], 500))
+            ])
+            # Старый путь для сравнения: istartswith по таблице
+            self._report('istartswith в БД', [
+                self._time(self._db_lookup, term) for term in terms[:200]
+            ])
+
+            transaction.set_rollback(True)
+        location_index.invalidate()
+
+    @staticmethod
+    def _typo(rng, name):
+        """Название с одной заменой буквы"""
+        position = rng.randrange(len(name))
+        return name[:position] + rng.choice('аеиоу') + name[position + 1:]
+
+    @staticmethod
+    def _time(func, arg):
+        started = time.perf_counter()
+        func(arg)
+        return (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def _db_lookup(term):
+        return list(Location.objects.filter(name__istartswith=term, is_country=False)
+                    .order_by('name').values_list('name', flat=True)[:10])
+
+    def _report(self, title, timings):
+        self.stdout.write(
+            f'{title}: запросов {len(timings)}, '
+            f'p50 {percentile(timings, 0.5):.3f} мс, '
+            f'p99 {percentile(timings, 0.99):.3f} мс, '
+            f'max {max(timings):.3f} мс'
+        )
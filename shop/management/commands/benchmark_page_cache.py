@@ -0,0 +1,114 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test import RequestFactory
+
+from shop import pagecache
+from shop.models import Category, Product
+from shop.views import product_list
+
+from .benchmark_locations import percentile
+
+SLUG = 'benchmark-page-cache'
+# Запросы, начатые в этом окне после правки, считаются пришедшими на инвалидацию
+AFTER_EDIT_WINDOW = 0.3
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный замер кэша страниц: потоки читают каталог, пока другой поток правит товар. '
+            'Сравнивает single-flight с построением страницы каждым промахом. '
+            'Созданные товары удаляются в конце.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=5.0)
+        parser.add_argument('--edit-interval', type=float, default=0.5,
+                            help='как часто правится товар, секунд')
+        parser.add_argument('--products', type=int, default=200)
+        parser.add_argument('--pause', type=float, default=0.002,
+                            help='пауза потока между запросами, секунд: без нее правящий поток не получает GIL')
+
+    def handle(self, *args, **options):
+        category = Category.objects.create(name='Замер кэша страниц', slug=SLUG)
+        Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'{SLUG}-{i}', description='Хлопковая футболка свободного кроя',
+                    price=Decimal('100.00') + i, category=category, stock=100)
+            for i in range(options['products'])
+        ])
+        pagecache.catalog_changed()
+        try:
+            for single_flight in (False, True):
+                pagecache.SINGLE_FLIGHT = single_flight
+                self._run('single-flight' if single_flight else 'Без single-flight', category, options)
+        finally:
+            pagecache.SINGLE_FLIGHT = True
+            Product.objects.filter(category=category).delete()
+            category.delete()
+
+    def _run(self, title, category, options):
+        factory = RequestFactory()
+        deadline = time.monotonic() + options['seconds']
+        timings = []
+        edits = []
+        errors = []
+
+        def read():
+            try:
+                while time.monotonic() < deadline:
+                    request = factory.get('/shop/', {'category': SLUG})
+                    request.user = AnonymousUser()
+                    started = time.monotonic()
+                    try:
+                        response = product_list(request)
+                    except OperationalError:
+                        errors.append(1)
+                        continue
+                    timings.append((started, (time.monotonic() - started) * 1000, response['X-Page-Cache']))
+                    time.sleep(options['pause'])
+            finally:
+                connection.close()
+
+        def edit():
+            product = Product.objects.filter(category=category).first()
+            try:
+                while time.monotonic() < deadline:
+                    time.sleep(options['edit_interval'])
+                    product.description = f'Правка {len(edits)}'
+                    try:
+                        product.save()
+                    except OperationalError:
+                        continue
+                    edits.append(time.monotonic())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=read) for _ in range(options['threads'])]
+        threads.append(threading.Thread(target=edit))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        after_edit = [
+            latency for started, latency, _ in timings
+            if any(0 <= started - edited < AFTER_EDIT_WINDOW for edited in edits)
+        ]
+        builds = sum(1 for _, _, outcome in timings if outcome == 'miss')
+        self.stdout.write(f'{title}: правок {len(edits)}, построений страницы {builds}, ошибок базы {len(errors)}')
+        self._report('  все запросы', [latency for _, latency, _ in timings])
+        self._report('  после правки', after_edit)
+
+    def _report(self, title, timings):
+        if not timings:
+            self.stdout.write(f'{title}: запросов нет')
+            return
+        self.stdout.write(
+            f'{title}: запросов {len(timings)}, '
+            f'p50 {percentile(timings, 0.5):.3f} мс, '
+            f'p99 {percentile(timings, 0.99):.3f} мс, '
+            f'max {max(timings):.3f} мс'
+        )
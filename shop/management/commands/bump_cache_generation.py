@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from shop.generations import generations
+
+
+class Command(BaseCommand):
+    help = 'Сбрасывает кэши в памяти всех процессов сайта (например, после правки базы в обход моделей)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('namespaces', nargs='+',
+                            help='пространства имен: catalog, locations')
+
+    def handle(self, *args, **options):
+        for namespace in options['namespaces']:
+            generations.bump(namespace)
+        self.stdout.write(self.style.SUCCESS(f'Метки сменены: {", ".join(options["namespaces"])}'))
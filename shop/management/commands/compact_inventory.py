@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from shop.inventory import COMPACT_AFTER, COMPACT_BATCH_SIZE, compact
+
+
+class Command(BaseCommand):
+    help = 'Сворачивает старые движения журнала товара в снимки остатков'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=COMPACT_AFTER.days,
+                            help='сворачивать движения старше стольких дней')
+        parser.add_argument('--batch-size', type=int, default=COMPACT_BATCH_SIZE,
+                            help='сколько движений сворачивать за одну транзакцию')
+
+    def handle(self, *args, **options):
+        compacted = compact(
+            older_than=timedelta(days=options['older_than_days']),
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Свернуто движений: {compacted}'))
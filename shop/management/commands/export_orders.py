@@ -0,0 +1,45 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.exports import EXPORT_CHUNK_SIZE, FORMATS, export_lines, filter_orders
+from shop.models import ArchivedOrder, Order
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Неверная дата: {value} (нужен формат ГГГГ-ММ-ДД)')
+
+
+class Command(BaseCommand):
+    help = 'Выгружает позиции заказов в CSV или JSONL потоком, не загружая их в память'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv', help='формат выгрузки')
+        parser.add_argument('--status', choices=[code for code, _ in Order.STATUS_CHOICES],
+                            help='только заказы с этим статусом')
+        parser.add_argument('--date-from', help='заказы, созданные с этой даты (ГГГГ-ММ-ДД)')
+        parser.add_argument('--date-to', help='заказы, созданные по эту дату включительно (ГГГГ-ММ-ДД)')
+        parser.add_argument('--output', help='файл для выгрузки; по умолчанию stdout')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='сколько строк читать из базы за раз')
+        parser.add_argument('--no-archived', action='store_true',
+                            help='не выгружать заказы, перенесенные в архив')
+
+    def handle(self, *args, **options):
+        filters = {
+            'status': options['status'],
+            'date_from': _date(options['date_from']) if options['date_from'] else None,
+            'date_to': _date(options['date_to']) if options['date_to'] else None,
+        }
+        orders = filter_orders(Order.objects.all(), **filters)
+        archived = None if options['no_archived'] else filter_orders(ArchivedOrder.objects.all(), **filters)
+        lines = export_lines(orders, options['format'], chunk_size=options['chunk_size'], archived_orders=archived)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
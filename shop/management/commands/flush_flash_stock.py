@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from shop.flash import FLUSH_BATCH_SIZE, flush, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Переносит списания флеш-распродаж со счетчиков в остатки товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=FLUSH_BATCH_SIZE,
+                            help='сколько позиций заказов переносить за одну транзакцию')
+        parser.add_argument('--reconcile', action='store_true',
+                            help='выставить счетчики заново по базе (после правки таблиц в обход моделей)')
+
+    def handle(self, *args, **options):
+        flushed = flush(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Перенесено позиций заказов: {flushed}'))
+        if options['reconcile']:
+            products = reconcile()
+            self.stdout.write(self.style.SUCCESS(f'Счетчики выставлены, флеш-товаров: {products}'))
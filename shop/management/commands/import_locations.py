@@ -0,0 +1,175 @@
+import csv
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from shop.locations import clean_name, index_trigrams, locations_changed, normalize_name
+from shop.models import Location, LocationTrigram
+
+FORMATS = {'.csv': 'csv', '.tsv': 'tsv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+TRUE_VALUES = {'1', 'true', 'yes', 'да', 'country', 'страна'}
+
+
+class Command(BaseCommand):
+    help = ('Потоково загружает справочник городов и стран из CSV/TSV/JSONL. '
+            'Файл читается построчно, изменения пишутся пачками bulk_create/bulk_update.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу')
+        parser.add_argument('--format', choices=['csv', 'tsv', 'jsonl'],
+                            help='Формат файла (по умолчанию по расширению)')
+        parser.add_argument('--type', choices=['city', 'country'], default='city',
+                            help='Тип строк без колонки is_country/type')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--prune', action='store_true',
+                            help='Удалить локации загружаемых типов, которых нет в файле')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать изменения, ничего не записывать')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        if not path.exists():
+            raise CommandError(f'Файл {path} не найден')
+        file_format = options['format'] or FORMATS.get(path.suffix.lower())
+        if file_format is None:
+            raise CommandError('Не удалось определить формат, укажите --format')
+
+        self.chunk_size = options['chunk_size']
+        self.dry_run = options['dry_run']
+        default_is_country = options['type'] == 'country'
+        started = time.monotonic()
+
+        # Существующие строки: ключ -> (id, название); дубликаты сразу идут в кандидаты на удаление
+        existing = {}
+        duplicates = []
+        rows = Location.objects.values_list('id', 'name', 'is_country').order_by('id')
+        for pk, name, is_country in rows.iterator(chunk_size=self.chunk_size):
+            key = (normalize_name(name), is_country)
+            if key in existing:
+                duplicates.append((pk, is_country))
+            else:
+                existing[key] = (pk, name)
+
+        seen = set()
+        imported_types = set()
+        self.to_create = []
+        self.to_update = []
+        self.stats = {'read': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0, 'skipped': 0}
+
+        for name, is_country in self._read(path, file_format, default_is_country):
+            self.stats['read'] += 1
+            name = clean_name(name)
+            if not name:
+                self.stats['skipped'] += 1
+                continue
+            key = (normalize_name(name), is_country)
+            if key in seen:
+                self.stats['skipped'] += 1
+                continue
+            seen.add(key)
+            imported_types.add(is_country)
+
+            current = existing.get(key)
+            if current is None:
+                self.to_create.append(Location(name=name, is_country=is_country))
+            elif current[1] != name:
+                self.to_update.append(Location(pk=current[0], name=name, is_country=is_country))
+            else:
+                self.stats['unchanged'] += 1
+
+            if len(self.to_create) + len(self.to_update) >= self.chunk_size:
+                self._flush()
+        self._flush()
+
+        if options['prune']:
+            stale = [pk for key, (pk, _) in existing.items() if key[1] in imported_types and key not in seen]
+            stale += [pk for pk, is_country in duplicates if is_country in imported_types]
+            self._delete(stale)
+
+        if not self.dry_run and (self.stats['created'] or self.stats['updated'] or self.stats['deleted']):
+            locations_changed()
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        prefix = '[dry-run] ' if self.dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}Прочитано {self.stats["read"]} строк за {elapsed:.2f} с '
+            f'({self.stats["read"] / elapsed:.0f} строк/с): '
+            f'создано {self.stats["created"]}, обновлено {self.stats["updated"]}, '
+            f'без изменений {self.stats["unchanged"]}, удалено {self.stats["deleted"]}, '
+            f'пропущено {self.stats["skipped"]}'
+        ))
+
+    def _read(self, path, file_format, default_is_country):
+        """Построчно отдает пары (название, is_country)"""
+        with path.open(encoding='utf-8-sig', newline='') as handle:
+            if file_format == 'jsonl':
+                for line_number, line in enumerate(handle, start=1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError as exc:
+                        raise CommandError(f'Строка {line_number}: некорректный JSON ({exc})')
+                    if isinstance(record, str):
+                        yield record, default_is_country
+                    else:
+                        yield record.get('name', ''), self._is_country(record, default_is_country)
+                return
+
+            delimiter = '\t' if file_format == 'tsv' else ','
+            reader = csv.reader(handle, delimiter=delimiter)
+            header = next(reader, None)
+            if header is None:
+                return
+            columns = [column.strip().lower() for column in header]
+            if 'name' not in columns:
+                # Файл без заголовка: первая колонка — название
+                yield header[0], default_is_country
+                for row in reader:
+                    if row:
+                        yield row[0], default_is_country
+                return
+
+            for row in reader:
+                if row:
+                    yield row[columns.index('name')], self._is_country(dict(zip(columns, row)), default_is_country)
+
+    @staticmethod
+    def _is_country(record, default):
+        if 'is_country' in record:
+            value = record['is_country']
+        elif 'type' in record:
+            value = record['type']
+        else:
+            return default
+        return str(value).strip().lower() in TRUE_VALUES
+
+    def _flush(self):
+        if not self.to_create and not self.to_update:
+            return
+        if not self.dry_run:
+            with transaction.atomic():
+                Location.objects.bulk_create(self.to_create, batch_size=self.chunk_size)
+                Location.objects.bulk_update(self.to_update, ['name'], batch_size=self.chunk_size)
+                index_trigrams(self.to_create + self.to_update)
+        self.stats['created'] += len(self.to_create)
+        self.stats['updated'] += len(self.to_update)
+        self.to_create = []
+        self.to_update = []
+
+    def _delete(self, ids):
+        for start in range(0, len(ids), self.chunk_size):
+            chunk = ids[start:start + self.chunk_size]
+            if not self.dry_run:
+                with transaction.atomic():
+                    LocationTrigram.objects.filter(location__in=chunk).delete()
+                    # Явный DELETE: delete() загрузил бы локации и отправил post_delete на каждую,
+                    # а индекс сбрасывается один раз в конце импорта
+                    placeholders = ', '.join(['%s'] * len(chunk))
+                    with connection.cursor() as cursor:
+                        cursor.execute(f'DELETE FROM {Location._meta.db_table} WHERE id IN ({placeholders})', chunk)
+            self.stats['deleted'] += len(chunk)
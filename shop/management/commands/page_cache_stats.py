@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from shop.pagecache import reset_stats, stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает долю попаданий в кэш страниц каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='после вывода обнулить счетчики')
+
+    def handle(self, *args, **options):
+        hits, misses = stats()
+        total = hits + misses
+        ratio = hits / total * 100 if total else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Попаданий: {hits}, промахов: {misses}, доля попаданий: {ratio:.1f}%'
+        ))
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Счетчики обнулены'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from shop.ratings import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает агрегаты рейтингов товаров по таблице отзывов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int,
+                            help='id товаров (по умолчанию — все товары)')
+
+    def handle(self, *args, **options):
+        product_ids = options['product_ids'] or None
+        rated = rebuild_ratings(product_ids)
+        self.stdout.write(self.style.SUCCESS(f'Рейтинги пересчитаны, товаров с отзывами: {rated}'))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.search import fts_enabled, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает полнотекстовый индекс товаров (SQLite FTS5)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Сколько товаров вставлять за один executemany')
+
+    def handle(self, *args, **options):
+        if not fts_enabled():
+            self.stdout.write(self.style.WARNING('FTS5 доступен только на SQLite, индекс не нужен'))
+            return
+
+        started = time.monotonic()
+        total = rebuild_index(batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано товаров: {total} за {elapsed:.2f} с'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.inventory import RECONCILE_CHUNK_SIZE, reconcile
+
+CHECK_NAMES = {
+    'stock': 'остаток',
+    'sold': 'продано',
+}
+
+
+class Command(BaseCommand):
+    help = 'Сверяет журнал движения товара с остатками и позициями заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=RECONCILE_CHUNK_SIZE,
+                            help='сколько товаров сверять за один проход')
+
+    def handle(self, *args, **options):
+        checked, mismatches = reconcile(chunk_size=options['chunk_size'])
+        for product_id, check, ledger, actual in mismatches:
+            self.stdout.write(
+                f'Товар {product_id}: {CHECK_NAMES[check]} по журналу {ledger}, фактически {actual}'
+            )
+        if mismatches:
+            raise CommandError(f'Расхождений: {len(mismatches)} (проверено товаров: {checked})')
+        self.stdout.write(self.style.SUCCESS(f'Расхождений нет, проверено товаров: {checked}'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from shop.holds import SWEEP_BATCH_SIZE, rebuild_held, release_expired
+
+
+class Command(BaseCommand):
+    help = 'Удаляет просроченные холды товаров и возвращает их в остаток для продажи'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE,
+                            help='сколько холдов удалять за одну транзакцию')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='после очистки пересчитать held по таблице холдов')
+
+    def handle(self, *args, **options):
+        released = release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Удалено просроченных холдов: {released}'))
+        if options['rebuild']:
+            held = rebuild_held()
+            self.stdout.write(self.style.SUCCESS(f'held пересчитан, товаров с холдами: {held}'))
@@ -0,0 +1,67 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:32
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_rating_stats(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    Review = apps.get_model('shop', 'Review')
+
+    stats = {}
+    rows = (Review.objects.filter(approved=True)
+            .values('product_id', 'rating').annotate(total=Count('id')).order_by())
+    for row in rows:
+        fields = stats.setdefault(row['product_id'], {'rating_sum': 0, 'rating_count': 0})
+        fields['rating_sum'] += row['rating'] * row['total']
+        fields['rating_count'] += row['total']
+        fields[f'rating_{row["rating"]}'] = row['total']
+
+    for product_id, fields in stats.items():
+        Product.objects.filter(pk=product_id).update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_rating_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_product_rating_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(condition=models.Q(('approved', True)), fields=['product', 'created', 'id'], name='review_product_feed_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+def create_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Product = apps.get_model('shop', 'Product')
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS shop_product_fts USING fts5("
+        "name, description, category, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+
+    def normalize(text):
+        return (text or '').casefold().replace('ё', 'е')
+
+    rows = [
+        (product.pk, normalize(product.name), normalize(product.description), normalize(product.category.name))
+        for product in Product.objects.select_related('category')
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO shop_product_fts (rowid, name, description, category) VALUES (%s, %s, %s, %s)',
+            rows,
+        )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS shop_product_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_review_feed_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
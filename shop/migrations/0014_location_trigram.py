@@ -0,0 +1,50 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:40
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_trigrams(apps, schema_editor):
+    Location = apps.get_model('shop', 'Location')
+    LocationTrigram = apps.get_model('shop', 'LocationTrigram')
+
+    rows = []
+    for location in Location.objects.all().iterator(chunk_size=5000):
+        key = re.sub(r'\s+', ' ', location.name.strip()).casefold().replace('ё', 'е')
+        grams = set()
+        for word in key.split():
+            padded = f'  {word} '
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        rows.extend(
+            LocationTrigram(trigram=gram, location_id=location.pk, is_country=location.is_country)
+            for gram in grams
+        )
+        if len(rows) >= 50000:
+            LocationTrigram.objects.bulk_create(rows, batch_size=5000)
+            rows = []
+    LocationTrigram.objects.bulk_create(rows, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('is_country', models.BooleanField(default=False)),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='shop.location')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trigram', 'is_country', 'location'], name='location_trigram_idx')],
+            },
+        ),
+        migrations.RunPython(fill_trigrams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0.1 on 2026-10-18 04:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0015_stock_holds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='stock_flushed',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='flash_sale',
+            field=models.BooleanField(default=False, verbose_name='Флеш-распродажа'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(('stock_flushed', False)), fields=['product'], name='orderitem_unflushed_idx'),
+        ),
+    ]
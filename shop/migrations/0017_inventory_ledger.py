@@ -0,0 +1,56 @@
+# Generated by Django 6.0.1 on 2026-10-18 05:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def open_snapshots(apps, schema_editor):
+    # Начальный остаток журнала — текущий stock, продажи — уже оформленные заказы
+    Product = apps.get_model('shop', 'Product')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    InventorySnapshot = apps.get_model('shop', 'InventorySnapshot')
+
+    sold = dict(
+        OrderItem.objects.exclude(order__status='cancelled')
+        .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    InventorySnapshot.objects.bulk_create([
+        InventorySnapshot(product_id=pk, quantity=stock, sold=sold.get(pk, 0))
+        for pk, stock in Product.objects.values_list('pk', 'stock').iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0016_flash_sale'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventorySnapshot',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='inventory_snapshot', serialize=False, to='shop.product')),
+                ('quantity', models.IntegerField(default=0)),
+                ('sold', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InventoryMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('receipt', 'Приход'), ('sale', 'Продажа'), ('cancel', 'Отмена заказа'), ('adjustment', 'Корректировка')], max_length=20)),
+                ('quantity', models.IntegerField()),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='movements', to='shop.order')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='shop.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'kind'], name='movement_product_kind_idx'), models.Index(fields=['created', 'id'], name='movement_created_idx')],
+            },
+        ),
+        migrations.RunPython(open_snapshots, migrations.RunPython.noop),
+    ]
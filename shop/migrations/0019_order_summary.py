@@ -0,0 +1,23 @@
+# Generated by Django 6.0.1 on 2026-10-18 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0018_checkout_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='preview',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 6.0.1 on 2026-10-18 05:22
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0019_order_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('paid', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('pending', '🟡 Ожидает обработки'), ('processing', '🟠 В обработке'), ('shipped', '🔵 Отправлен'), ('delivered', '🟢 Доставлен'), ('cancelled', '🔴 Отменен')], default='pending', max_length=20)),
+                ('payment_method', models.CharField(choices=[('card', '💳 Банковская карта'), ('cash', '💵 Наличные при получении'), ('online', '🌐 Онлайн оплата')], default='card', max_length=20)),
+                ('total_price', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('shipping_address', models.TextField(blank=True)),
+                ('shipping_city', models.CharField(blank=True, max_length=100)),
+                ('shipping_zip_code', models.CharField(blank=True, max_length=20)),
+                ('shipping_country', models.CharField(default='Россия', max_length=100)),
+                ('customer_name', models.CharField(blank=True, max_length=100)),
+                ('customer_email', models.EmailField(blank=True, max_length=254)),
+                ('customer_phone', models.CharField(blank=True, max_length=20)),
+                ('notes', models.TextField(blank=True)),
+                ('tracking_number', models.CharField(blank=True, max_length=100)),
+                ('item_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('preview', models.JSONField(blank=True, default=list, editable=False)),
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('created', models.DateTimeField()),
+                ('updated', models.DateTimeField()),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrderItem',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('quantity', models.PositiveIntegerField(default=1)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='shop.archivedorder')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_order_items', to='shop.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['user', 'created', 'id'], name='archivedorder_user_idx'),
+        ),
+    ]
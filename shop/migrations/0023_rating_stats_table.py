@@ -0,0 +1,75 @@
+# Generated by Django 6.0.1 on 2026-10-18 06:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+RATING_FIELDS = ['rating_sum', 'rating_count', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5']
+
+
+def move_rating_stats(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    ProductRatingStats = apps.get_model('shop', 'ProductRatingStats')
+    rows = Product.objects.filter(rating_count__gt=0).values_list('pk', *RATING_FIELDS)
+    ProductRatingStats.objects.bulk_create(
+        [ProductRatingStats(product_id=row[0], **dict(zip(RATING_FIELDS, row[1:]))) for row in rows],
+        batch_size=500,
+    )
+
+
+def restore_rating_stats(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    ProductRatingStats = apps.get_model('shop', 'ProductRatingStats')
+    for row in ProductRatingStats.objects.values_list('product_id', *RATING_FIELDS):
+        Product.objects.filter(pk=row[0]).update(**dict(zip(RATING_FIELDS, row[1:])))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0022_cache_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRatingStats',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_stats', serialize=False, to='shop.product')),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('rating_count', models.IntegerField(default=0)),
+                ('rating_1', models.IntegerField(default=0)),
+                ('rating_2', models.IntegerField(default=0)),
+                ('rating_3', models.IntegerField(default=0)),
+                ('rating_4', models.IntegerField(default=0)),
+                ('rating_5', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(move_rating_stats, restore_rating_stats),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_1',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_2',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_3',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_4',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_5',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_count',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='rating_sum',
+        ),
+    ]
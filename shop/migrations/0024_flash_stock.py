@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-18 06:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def fill_flash_stock(apps, schema_editor):
+    # Счетчики жили в кэше: выставляем их по базе, stock минус несписанные позиции
+    Product = apps.get_model('shop', 'Product')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    FlashStock = apps.get_model('shop', 'FlashStock')
+    stocks = dict(Product.objects.filter(flash_sale=True).values_list('pk', 'stock'))
+    unflushed = dict(
+        OrderItem.objects.filter(stock_flushed=False, product_id__in=list(stocks))
+        .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    FlashStock.objects.bulk_create([
+        FlashStock(product_id=pk, remaining=max(stock - unflushed.get(pk, 0), 0)) for pk, stock in stocks.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0023_rating_stats_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlashStock',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='flash_stock', serialize=False, to='shop.product')),
+                ('remaining', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_flash_stock, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,19 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 
+def per_product(quantities):
+    """CASE id WHEN ... THEN количество — значение для пакетного UPDATE по товарам"""
+    return models.Case(
+        *[models.When(pk=pk, then=models.Value(quantity)) for pk, quantity in quantities.items()],
+        default=models.Value(0),
+        output_field=models.IntegerField(),
+    )
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True)
@@ -23,39 +34,141 @@ class Product(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     stock = models.PositiveIntegerField(default=10, verbose_name='Количество на складе')
+    # Остаток списывается через счетчик FlashStock (см. shop/flash.py)
+    flash_sale = models.BooleanField(default=False, verbose_name='Флеш-распродажа')
+
+    # Сумма холдов покупателей, оформляющих заказ (см. shop/holds.py)
+    held = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # Ключи для курсорной пагинации каталога (см. shop/pagination.py), весь каталог и
+            # категория. Частичные: Django пишет filter(available=True) как WHERE "available",
+            # а SQLite не может взять такое условие ведущей колонкой индекса
+            models.Index(fields=['created', 'id'], condition=models.Q(available=True),
+                         name='product_avail_created_idx'),
+            models.Index(fields=['price', 'id'], condition=models.Q(available=True),
+                         name='product_avail_price_idx'),
+            models.Index(fields=['category', 'created', 'id'], condition=models.Q(available=True),
+                         name='product_cat_created_idx'),
+            models.Index(fields=['category', 'price', 'id'], condition=models.Q(available=True),
+                         name='product_cat_price_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @property
+    def ratings(self):
+        """Агрегаты рейтинга; у товара без одобренных отзывов строки нет, и все они нулевые"""
+        try:
+            return self.rating_stats
+        except ObjectDoesNotExist:
+            return ProductRatingStats()
+
     def average_rating(self):
-        reviews = self.reviews.all()
-        if reviews:
-            return sum(review.rating for review in reviews) / len(reviews)
+        stats = self.ratings
+        if stats.rating_count:
+            return stats.rating_sum / stats.rating_count
         return 0
 
     def review_count(self):
-        return self.reviews.count()
+        return self.ratings.rating_count
+
+    def rating_histogram(self):
+        """Количество отзывов по звездам: [(5, n), (4, n), ..., (1, n)]"""
+        stats = self.ratings
+        return [(stars, getattr(stats, f'rating_{stars}')) for stars in range(5, 0, -1)]
 
     def is_in_stock(self):
         """Проверяет, есть ли товар в наличии"""
         return self.stock > 0 and self.available
 
-    def reduce_stock(self, quantity):
-        """Уменьшает количество товара на складе"""
-        if quantity <= self.stock:
-            self.stock -= quantity
-            if self.stock == 0:
-                self.available = False
-            self.save()
+    def available_to_sell(self):
+        """Остаток за вычетом холдов: столько можно положить в новый заказ"""
+        if self.flash_sale:
+            # Счетчик, подгруженный select_related('flash_stock'), читается без запроса
+            counter = self._state.fields_cache.get('flash_stock')
+            if counter is not None:
+                return max(counter.remaining, 0)
+            from .flash import stock_left
+            return stock_left(self.pk)
+        return max(self.stock - self.held, 0)
+
+    @classmethod
+    def take_stock(cls, quantities):
+        """Списывает остатки {id товара: количество} одним условным UPDATE.
+
+        Проверка и списание происходят в одном запросе, поэтому параллельные
+        заказы не могут продать больше, чем есть на складе. Товар, у которого
+        остаток дошел до нуля, снимается с продажи тем же запросом. Чужие холды
+        не списываются: свои покупатель снимает до вызова (release_holds). Если
+        хоть одного товара не хватило, не списывается ничего и возвращается False.
+        """
+        if not quantities:
             return True
-        return False
-
-    def add_stock(self, quantity):
+        taken = per_product(quantities)
+        enough = models.Q()
+        for pk, quantity in quantities.items():
+            enough |= models.Q(pk=pk, stock__gte=models.F('held') + quantity)
+
+        with transaction.atomic():
+            updated = cls.objects.filter(enough).update(
+                stock=models.F('stock') - taken,
+                available=models.Case(
+                    models.When(stock=taken, then=models.Value(False)),
+                    default=models.F('available'),
+                ),
+                updated=timezone.now(),
+            )
+            if updated != len(quantities):
+                transaction.set_rollback(True)
+                return False
+        return True
+
+    def reduce_stock(self, quantity, note=''):
+        """Уменьшает количество товара на складе"""
+        from .inventory import record
+        with transaction.atomic():
+            if not Product.take_stock({self.pk: quantity}):
+                return False
+            record([InventoryMovement(product=self, kind=InventoryMovement.ADJUSTMENT, quantity=-quantity, note=note)])
+        self.refresh_from_db(fields=['stock', 'available', 'updated'])
+        return True
+
+    def add_stock(self, quantity, note=''):
         """Увеличивает количество товара на складе"""
-        self.stock += quantity
-        if not self.available:
-            self.available = True
-        self.save()
+        from .inventory import adjust_stock
+        adjust_stock(self.pk, quantity, kind=InventoryMovement.RECEIPT, note=note, make_available=True)
+        self.refresh_from_db(fields=['stock', 'available', 'updated'])
+
+
+class ProductRatingStats(models.Model):
+    """Агрегаты одобренных отзывов товара, поддерживаются сигналами (см. shop/ratings.py).
+
+    Отдельная строка, а не поля Product: полное сохранение товара (админка,
+    устаревший экземпляр) не перезаписывает их старыми значениями.
+    """
+    product = models.OneToOneField(Product, primary_key=True, related_name='rating_stats', on_delete=models.CASCADE)
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_1 = models.IntegerField(default=0)
+    rating_2 = models.IntegerField(default=0)
+    rating_3 = models.IntegerField(default=0)
+    rating_4 = models.IntegerField(default=0)
+    rating_5 = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.product_id}: {self.rating_sum}/{self.rating_count}'
+
+
+class FlashStock(models.Model):
+    """Остаток для продажи товара флеш-распродажи: stock минус несписанные позиции (см. shop/flash.py)"""
+    product = models.OneToOneField(Product, primary_key=True, related_name='flash_stock', on_delete=models.CASCADE)
+    remaining = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.product_id}: {self.remaining}'
 
 
 class Cart(models.Model):
@@ -64,7 +177,8 @@ class Cart(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     def get_total_price(self):
-        return sum(item.get_total_price() for item in self.items.all())
+        # Товары позиций подтягиваются JOIN'ом: один запрос на всю корзину
+        return sum(item.get_total_price() for item in self.items.select_related('product'))
 
     def __str__(self):
         return f'Cart {self.user.username}'
@@ -75,6 +189,12 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        indexes = [
+            # add_to_cart ищет позицию по корзине и товару
+            models.Index(fields=['cart', 'product'], name='cartitem_cart_product_idx'),
+        ]
+
     def get_total_price(self):
         return self.product.price * self.quantity
 
@@ -82,7 +202,8 @@ class CartItem(models.Model):
         return f'{self.quantity} x {self.product.name}'
 
 
-class Order(models.Model):
+class OrderBase(models.Model):
+    """Общие поля и методы заказа и архивного заказа (ArchivedOrder)"""
     STATUS_CHOICES = [
         ('pending', '🟡 Ожидает обработки'),
         ('processing', '🟠 В обработке'),
@@ -97,14 +218,6 @@ class Order(models.Model):
         ('online', '🌐 Онлайн оплата'),
     ]
 
-    # ВАЖНО: Добавляем related_name='orders'
-    user = models.ForeignKey(
-        settings.AUTH_USER_MODEL,
-        on_delete=models.CASCADE,
-        related_name='orders'  # ДОБАВЛЕНО!
-    )
-    created = models.DateTimeField(auto_now_add=True)
-    updated = models.DateTimeField(auto_now=True)
     paid = models.BooleanField(default=False)
 
     # Статус и оплата
@@ -129,8 +242,15 @@ class Order(models.Model):
     # Трек номер для отслеживания
     tracking_number = models.CharField(max_length=100, blank=True)
 
+    # Сводка для карточек истории и списка в админке, чтобы не читать позиции:
+    # число позиций и первые PREVIEW_ITEMS товаров [{'id', 'name', 'image'}]
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    preview = models.JSONField(default=list, blank=True, editable=False)
+
+    PREVIEW_ITEMS = 3
+
     class Meta:
-        ordering = ('-created',)
+        abstract = True
 
     def __str__(self):
         return f'Order {self.id} - {self.user.username}'
@@ -157,12 +277,84 @@ class Order(models.Model):
     def get_payment_method_display_with_icon(self):
         return dict(self.PAYMENT_CHOICES).get(self.payment_method, self.payment_method)
 
+    def fill_summary(self, products):
+        """Заполняет item_count и preview по товарам позиций в порядке позиций (без сохранения)"""
+        self.item_count = len(products)
+        self.preview = [
+            {'id': product.id, 'name': product.name, 'image': product.image.url if product.image else ''}
+            for product in products[:self.PREVIEW_ITEMS]
+        ]
+
+
+class Order(OrderBase):
+    # ВАЖНО: Добавляем related_name='orders'
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='orders'  # ДОБАВЛЕНО!
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('-created',)
+        indexes = [
+            # История заказов покупателя: вся и с фильтром по статусу (курсор по -created, -id)
+            models.Index(fields=['user', 'created', 'id'], name='order_user_created_idx'),
+            models.Index(fields=['user', 'status', 'created', 'id'], name='order_user_status_idx'),
+        ]
+
+    def refresh_summary(self):
+        """Пересчитывает сводку по позициям из базы и сохраняет ее"""
+        self.fill_summary([item.product for item in self.items.select_related('product').order_by('id')])
+        self.save(update_fields=['item_count', 'preview'])
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity = models.PositiveIntegerField(default=1)
+    # False — товар флеш-распродажи, списанный со счетчика, но еще не из Product.stock
+    stock_flushed = models.BooleanField(default=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product'], condition=models.Q(stock_flushed=False),
+                         name='orderitem_unflushed_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product.name}'
+
+    def get_cost(self):
+        return self.price * self.quantity
+
+
+class ArchivedOrder(OrderBase):
+    """Старый завершенный заказ, перенесенный из Order (см. shop/archive.py); id сохраняется"""
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='archived_orders', on_delete=models.CASCADE)
+    # Даты переносятся из заказа как есть
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+    archived = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('-created',)
+        indexes = [
+            # История заказов покупателя (курсор по -created, -id)
+            models.Index(fields=['user', 'created', 'id'], name='archivedorder_user_idx'),
+        ]
+
+
+class ArchivedOrderItem(models.Model):
+    """Позиция архивного заказа"""
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, related_name='items', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='archived_order_items', on_delete=models.CASCADE)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField(default=1)
 
     def __str__(self):
         return f'{self.quantity} x {self.product.name}'
@@ -192,10 +384,24 @@ class Review(models.Model):
     class Meta:
         ordering = ('-created',)
         unique_together = ['product', 'user']
+        indexes = [
+            # Лента одобренных отзывов товара с курсорной пагинацией (частичный — см. Product)
+            models.Index(fields=['product', 'created', 'id'], condition=models.Q(approved=True),
+                         name='review_product_feed_idx'),
+        ]
 
     def __str__(self):
         return f'Review by {self.user.username} for {self.product.name}'
 
+    def save(self, *args, **kwargs):
+        # Агрегаты товара обновляются в post_save, в той же транзакции
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+
     def get_rating_stars(self):
         """Возвращает строку с звездами в зависимости от рейтинга"""
         return '⭐' * self.rating
@@ -219,6 +425,92 @@ class Wishlist(models.Model):
         return f'{self.user.username} - {self.product.name}'
 
 
+class StockHold(models.Model):
+    """Временный резерв товара на время оформления заказа"""
+    product = models.ForeignKey(Product, related_name='holds', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='stock_holds', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['user', 'product']
+        indexes = [
+            # Очистка просроченных холдов: вся таблица и по одному товару
+            models.Index(fields=['expires_at'], name='stockhold_expires_idx'),
+            models.Index(fields=['product', 'expires_at'], name='stockhold_product_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} до {self.expires_at:%H:%M}'
+
+
+class InventoryMovement(models.Model):
+    """Запись журнала движения товара (см. shop/inventory.py)"""
+    RECEIPT = 'receipt'
+    SALE = 'sale'
+    CANCEL = 'cancel'
+    ADJUSTMENT = 'adjustment'
+    KIND_CHOICES = [
+        (RECEIPT, 'Приход'),
+        (SALE, 'Продажа'),
+        (CANCEL, 'Отмена заказа'),
+        (ADJUSTMENT, 'Корректировка'),
+    ]
+
+    product = models.ForeignKey(Product, related_name='movements', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # Со знаком: приход и отмена увеличивают остаток, продажа уменьшает
+    quantity = models.IntegerField()
+    order = models.ForeignKey(Order, related_name='movements', null=True, blank=True, on_delete=models.SET_NULL)
+    note = models.CharField(max_length=200, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'kind'], name='movement_product_kind_idx'),
+            models.Index(fields=['created', 'id'], name='movement_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.quantity:+d} x {self.product_id}'
+
+
+class InventorySnapshot(models.Model):
+    """Свернутые старые движения товара: остаток и продажи на момент сжатия журнала"""
+    product = models.OneToOneField(
+        Product, primary_key=True, related_name='inventory_snapshot', on_delete=models.CASCADE
+    )
+    quantity = models.IntegerField(default=0)
+    # Продано за вычетом отмен — для сверки с позициями заказов
+    sold = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.product_id}: {self.quantity}'
+
+
+class CheckoutToken(models.Model):
+    """Ключ идемпотентности формы оформления заказа (см. shop/checkout.py)"""
+    # Первичный ключ: из двух одновременных отправок формы заказ сохранит только одна
+    token = models.UUIDField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='checkout_tokens', on_delete=models.CASCADE)
+    order = models.OneToOneField(Order, related_name='checkout_token', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.token} -> {self.order_id}'
+
+
+class CacheGeneration(models.Model):
+    """Метка версии кэшей в памяти процессов (см. shop/generations.py)"""
+    namespace = models.CharField(max_length=50, primary_key=True)
+    # time.time_ns() последней смены: откаченная транзакция не вернет старую метку
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.namespace}: {self.version}'
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
@@ -248,4 +540,20 @@ class Location(models.Model):
     is_country = models.BooleanField(default=False)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+
+class LocationTrigram(models.Model):
+    """Инвертированный индекс триграмм названий локаций для нечеткого поиска"""
+    trigram = models.CharField(max_length=3)
+    location = models.ForeignKey(Location, related_name='trigrams', on_delete=models.CASCADE)
+    # Копия Location.is_country, чтобы фильтровать по типу без JOIN
+    is_country = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['trigram', 'is_country', 'location'], name='location_trigram_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.trigram} -> {self.location_id}'
\ No newline at end of file
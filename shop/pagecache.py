@@ -0,0 +1,192 @@
+"""Кэш целых страниц каталога (home, product_list, product_detail).
+
+Страница хранится в кэше по пути и строке запроса вместе с версией каталога,
+для которой она построена. Версия — метка поколения CATALOG_NAMESPACE
+(shop/generations.py), ее меняют сигналы сохранения и удаления Product,
+Category и Review (shop/signals.py). Страница чужой версии или старше
+PAGE_CACHE_TIMEOUT устарела и строится заново.
+
+Перестраивает страницу один запрос (single-flight): он берет блокировку
+cache.add, а одновременные запросы того же адреса получают устаревшую копию
+(X-Page-Cache: stale) — так правка товара не превращается в волну одинаковых
+запросов к SQLite. Если старой копии нет, они ждут новую до LOCK_WAIT секунд.
+Устаревшая копия хранится еще STALE_TIMEOUT секунд и отдается, пока строится
+новая, а также когда база заблокирована или недоступна (OperationalError).
+
+Тело страницы общее для всех посетителей. Зависящее от пользователя
+подставляется при каждой отдаче: ссылки входа или профиля в шапке
+(auth_links.html) и CSRF-токен форм «В корзину». В кэше вместо них стоят метки
+AUTH_MARKER и CSRF_MARKER. Страницы, где от пользователя зависит больше
+(product_detail с его отзывом), кэшируются только для анонимов.
+
+Остаток товара меняется UPDATE'ами холдов и заказов без сигналов, поэтому
+число «В наличии» на закэшированной странице может отставать, но не дольше
+PAGE_CACHE_TIMEOUT. Корзина и оформление заказа проверяют остаток сами.
+
+Попадания (вместе с устаревшими копиями) и промахи считаются счетчиками в кэше
+(команда page_cache_stats); с LocMemCache у каждого процесса свои страницы и
+свои счетчики. Нагрузочный замер — команда benchmark_page_cache.
+"""
+import hashlib
+import logging
+import time
+from functools import partial, wraps
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.db import OperationalError
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
+from django.utils.safestring import mark_safe
+
+from .generations import generations
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAMESPACE = 'catalog'
+PAGE_CACHE_KEY = 'page:{}'
+LOCK_CACHE_KEY = 'page:lock:{}'
+PAGE_CACHE_TIMEOUT = 300
+# Сколько устаревшая страница еще хранится после PAGE_CACHE_TIMEOUT
+STALE_TIMEOUT = 600
+# Блокировка упавшего запроса снимется сама через LOCK_TIMEOUT секунд
+LOCK_TIMEOUT = 30
+LOCK_WAIT = 3.0
+LOCK_POLL_INTERVAL = 0.05
+# False — каждый промах строит страницу сам (для сравнения в benchmark_page_cache)
+SINGLE_FLIGHT = True
+HITS_CACHE_KEY = 'page:hits'
+MISSES_CACHE_KEY = 'page:misses'
+
+AUTH_MARKER = '<!--page-cache:auth-links-->'
+CSRF_MARKER = 'page-cache-csrf-token'
+
+
+def catalog_version():
+    """Метка версии каталога, с которой сверяются закэшированные страницы"""
+    return generations.version(CATALOG_NAMESPACE)
+
+
+def catalog_changed():
+    """Помечает страницы каталога устаревшими после изменения товара, категории или отзыва"""
+    generations.bump(CATALOG_NAMESPACE)
+
+
+def page_digest(request):
+    """Хэш пути и параметров запроса в порядке имен"""
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    return hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+
+
+def render_page(request, template_name, context):
+    """Рендерит страницу для кэша: с метками вместо пользовательских частей"""
+    context = dict(context, auth_links=mark_safe(AUTH_MARKER), csrf_token=CSRF_MARKER)
+    response = HttpResponse(render_to_string(template_name, context, request))
+    response.page_cache = True
+    return response
+
+
+def _fill(request, body):
+    auth_links = render_to_string('auth_links.html', {'user': request.user}, request)
+    body = body.replace(AUTH_MARKER, auth_links).replace(CSRF_MARKER, get_token(request))
+    response = HttpResponse(body)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def _serve(request, body, outcome):
+    _count(MISSES_CACHE_KEY if outcome == 'miss' else HITS_CACHE_KEY)
+    response = _fill(request, body)
+    response['X-Page-Cache'] = outcome
+    return response
+
+
+def _is_fresh(entry, version):
+    return entry is not None and entry[0] == version and time.time() - entry[1] < PAGE_CACHE_TIMEOUT
+
+
+def _wait_for_page(key, version):
+    """Ждет страницу, которую строит запрос, взявший блокировку"""
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if _is_fresh(entry, version):
+            return entry
+    return None
+
+
+def cached_page(view=None, *, anonymous_only=False):
+    """Отдает GET-ответы представления из кэша страниц.
+
+    Кэшируются только ответы render_page; JSON, редиректы и ошибки проходят
+    как есть. Заголовок X-Page-Cache: hit, stale, miss или bypass (запрос мимо
+    кэша: не GET или, при anonymous_only, вошедший пользователь).
+    """
+    if view is None:
+        return partial(cached_page, anonymous_only=anonymous_only)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or (anonymous_only and request.user.is_authenticated):
+            response = view(request, *args, **kwargs)
+            if not getattr(response, 'page_cache', False):
+                return response
+            response = _fill(request, response.content.decode(response.charset))
+            response['X-Page-Cache'] = 'bypass'
+            return response
+
+        digest = page_digest(request)
+        key = PAGE_CACHE_KEY.format(digest)
+        version = catalog_version()
+        entry = cache.get(key)
+        if _is_fresh(entry, version):
+            return _serve(request, entry[2], 'hit')
+
+        lock_key = LOCK_CACHE_KEY.format(digest)
+        locked = SINGLE_FLIGHT and cache.add(lock_key, 1, LOCK_TIMEOUT)
+        if SINGLE_FLIGHT and not locked:
+            # Страницу уже строит другой запрос
+            if entry is not None:
+                return _serve(request, entry[2], 'stale')
+            entry = _wait_for_page(key, version)
+            if entry is not None:
+                return _serve(request, entry[2], 'hit')
+
+        try:
+            response = view(request, *args, **kwargs)
+        except OperationalError:
+            if entry is None:
+                raise
+            logger.warning('%s: база недоступна, отдана устаревшая страница', request.path, exc_info=True)
+            return _serve(request, entry[2], 'stale')
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+        if not getattr(response, 'page_cache', False):
+            return response
+        body = response.content.decode(response.charset)
+        cache.set(key, (version, time.time(), body), PAGE_CACHE_TIMEOUT + STALE_TIMEOUT)
+        return _serve(request, body, 'miss')
+    return wrapper
+
+
+def stats():
+    """(попадания, промахи) с последнего сброса счетчиков"""
+    counters = cache.get_many([HITS_CACHE_KEY, MISSES_CACHE_KEY])
+    return counters.get(HITS_CACHE_KEY, 0), counters.get(MISSES_CACHE_KEY, 0)
+
+
+def reset_stats():
+    cache.delete_many([HITS_CACHE_KEY, MISSES_CACHE_KEY])
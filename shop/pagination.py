@@ -0,0 +1,121 @@
+"""Keyset (курсорная) пагинация.
+
+Вместо OFFSET страница продолжается с последней показанной строки:
+WHERE (key, id) > (последний key, последний id). Поэтому глубокие страницы
+стоят столько же, сколько первая, если есть индекс по (key, id).
+"""
+import base64
+import json
+from operator import attrgetter
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPage:
+    """Одна страница результатов и курсор на следующую"""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Упаковывает значения ключа в непрозрачную строку для URL"""
+    raw = json.dumps([str(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Распаковывает курсор; для мусора возвращает None"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        return None
+    return values
+
+
+def _field_name(order_field):
+    return order_field.lstrip('-')
+
+
+def _keyset_filter(model, ordering, raw_values):
+    """Строит условие «строго после (v1, v2, ...)» для заданной сортировки"""
+    values = []
+    for order_field, raw in zip(ordering, raw_values):
+        field = model._meta.get_field(_field_name(order_field))
+        values.append(field.to_python(raw))
+
+    condition = Q()
+    for position, order_field in enumerate(ordering):
+        lookup = 'lt' if order_field.startswith('-') else 'gt'
+        step = Q(**{f'{_field_name(order_field)}__{lookup}': values[position]})
+        for previous_field, previous_value in zip(ordering[:position], values[:position]):
+            step &= Q(**{_field_name(previous_field): previous_value})
+        condition |= step
+    return condition
+
+
+def _after_cursor(queryset, ordering, values):
+    queryset = queryset.order_by(*ordering)
+    if values is not None and len(values) == len(ordering):
+        try:
+            queryset = queryset.filter(_keyset_filter(queryset.model, ordering, values))
+        except ValidationError:
+            # Подделанный или устаревший курсор — начинаем с первой страницы
+            pass
+    return queryset
+
+
+def _make_page(items, ordering, page_size):
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor(
+            getattr(last, _field_name(order_field)) for order_field in ordering
+        )
+    return KeysetPage(items, next_cursor)
+
+
+def keyset_paginate(queryset, ordering, cursor=None, page_size=12):
+    """Возвращает KeysetPage для queryset, отсортированного по ordering.
+
+    ordering — кортеж полей, последним должен идти уникальный ключ (обычно id),
+    чтобы порядок был стабильным.
+    """
+    queryset = _after_cursor(queryset, ordering, decode_cursor(cursor))
+    return _make_page(list(queryset[:page_size + 1]), ordering, page_size)
+
+
+def keyset_paginate_merged(querysets, ordering, cursor=None, page_size=12):
+    """KeysetPage по объединению нескольких querysets с общими полями ordering.
+
+    Например, рабочая и архивная таблицы заказов: из каждой берется до
+    page_size + 1 строк после курсора, и страница собирается слиянием в
+    Python. Ключ (последнее поле ordering) должен быть уникален во всех
+    querysets вместе.
+    """
+    values = decode_cursor(cursor)
+    items = []
+    for queryset in querysets:
+        items.extend(_after_cursor(queryset, ordering, values)[:page_size + 1])
+    # Устойчивая сортировка по полям с конца дает порядок ORDER BY ordering
+    for order_field in reversed(ordering):
+        items.sort(key=attrgetter(_field_name(order_field)), reverse=order_field.startswith('-'))
+    return _make_page(items[:page_size + 1], ordering, page_size)
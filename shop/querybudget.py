@@ -0,0 +1,78 @@
+"""Бюджет запросов к базе на запрос к сайту.
+
+QueryBudgetMiddleware считает запросы ORM и суммарное время в базе за
+время работы представления, отдает их в заголовках X-DB-Queries и
+X-DB-Time-Ms и пишет в лог shop.querybudget. Представление объявляет свой
+бюджет декоратором @query_budget(n). Превышение пишется в лог
+предупреждением, а при QUERY_BUDGET_STRICT = True бросается
+QueryBudgetExceeded — новый N+1 в шаблоне роняет тест, а не замедляет сайт.
+Тесты запускаются с этим режимом для всего набора (TEST_RUNNER в settings,
+shop/testrunner.py).
+
+Бюджет включает запросы сессии и пользователя. Запросы, которые делает
+StreamingHttpResponse уже после возврата из представления, не считаются.
+"""
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """Представление сделало больше запросов, чем объявлено в @query_budget"""
+
+
+def query_budget(max_queries):
+    """Объявляет, сколько запросов к базе может сделать представление"""
+    def decorator(view):
+        # Атрибут переживает внешние декораторы (login_required и т.п. копируют __dict__)
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = _QueryCounter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+
+        response['X-DB-Queries'] = str(counter.count)
+        response['X-DB-Time-Ms'] = f'{counter.duration * 1000:.1f}'
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None and counter.count > budget:
+            message = (f'{request.method} {request.path}: {counter.count} запросов к базе '
+                       f'при бюджете {budget}')
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        else:
+            logger.debug('%s %s: %d запросов, %.1f мс', request.method, request.path,
+                         counter.count, counter.duration * 1000)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, 'query_budget', None)
@@ -0,0 +1,102 @@
+"""Денормализованные агрегаты рейтинга товара.
+
+В строке ProductRatingStats товара хранятся rating_sum, rating_count и
+гистограмма rating_1..rating_5 по одобренным отзывам. Сигналы отзыва
+применяют к ним дельты F-выражениями, а rebuild_ratings() пересчитывает все
+заново одним GROUP BY. Строка создается с первым одобренным отзывом.
+
+Каждое изменение трогает и Product.updated: по нему кэшируются карточки
+товаров (shop/fragments.py).
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import Product, ProductRatingStats, Review
+
+RATING_FIELDS = ['rating_sum', 'rating_count'] + [f'rating_{stars}' for stars in range(1, 6)]
+
+
+def review_state(review):
+    """Снимок полей отзыва, влияющих на агрегаты, или None для отложенных полей"""
+    data = review.__dict__
+    if any(name not in data for name in ('product_id', 'rating', 'approved')):
+        return None
+    return data['product_id'], data['rating'], data['approved']
+
+
+def _add_review(deltas, state, sign):
+    product_id, rating, approved = state
+    if not approved or product_id is None or rating not in range(1, 6):
+        return
+    fields = deltas[product_id]
+    fields['rating_sum'] += sign * rating
+    fields['rating_count'] += sign
+    fields[f'rating_{rating}'] += sign
+
+
+def apply_review_change(old_state, new_state):
+    """Переносит изменение отзыва old_state -> new_state в агрегаты товаров.
+
+    Состояние — кортеж (product_id, rating, approved) или None, если отзыва
+    не было (создание) или он удален.
+    """
+    if old_state == new_state:
+        return
+
+    deltas = defaultdict(lambda: defaultdict(int))
+    if old_state is not None:
+        _add_review(deltas, old_state, -1)
+    if new_state is not None:
+        _add_review(deltas, new_state, 1)
+
+    for product_id, fields in deltas.items():
+        changes = {name: F(name) + delta for name, delta in fields.items() if delta}
+        if not changes:
+            continue
+        stats = ProductRatingStats.objects.filter(pk=product_id)
+        if not stats.update(**changes):
+            if fields['rating_count'] <= 0:
+                # Строки нет, а отзыв убывает: товар удаляется каскадом, и строка
+                # агрегатов уже удалена раньше его отзывов. Создавать ее нельзя
+                continue
+            # Первый отзыв товара: строки еще нет. ignore_conflicts — ее мог создать
+            # одновременный отзыв, и тогда его дельта не затирается
+            ProductRatingStats.objects.bulk_create([ProductRatingStats(product_id=product_id)], ignore_conflicts=True)
+            stats.update(**changes)
+        Product.objects.filter(pk=product_id).update(updated=timezone.now())
+
+
+def rebuild_ratings(product_ids=None):
+    """Пересчитывает агрегаты по таблице отзывов.
+
+    Без product_ids пересчитываются все товары. Возвращает число товаров,
+    у которых есть одобренные отзывы.
+    """
+    reviews = Review.objects.filter(approved=True)
+    products = Product.objects.all()
+    old_stats = ProductRatingStats.objects.all()
+    if product_ids is not None:
+        reviews = reviews.filter(product_id__in=product_ids)
+        products = products.filter(pk__in=product_ids)
+        old_stats = old_stats.filter(pk__in=product_ids)
+
+    stats = defaultdict(lambda: dict.fromkeys(RATING_FIELDS, 0))
+    rows = reviews.values('product_id', 'rating').annotate(total=Count('id')).order_by()
+    for row in rows:
+        fields = stats[row['product_id']]
+        fields['rating_sum'] += row['rating'] * row['total']
+        fields['rating_count'] += row['total']
+        fields[f'rating_{row["rating"]}'] += row['total']
+
+    with transaction.atomic():
+        old_stats.delete()
+        ProductRatingStats.objects.bulk_create(
+            [ProductRatingStats(product_id=product_id, **fields) for product_id, fields in stats.items()],
+            batch_size=500,
+        )
+        products.update(updated=timezone.now())
+
+    return len(stats)
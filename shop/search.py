@@ -0,0 +1,145 @@
+"""Полнотекстовый поиск товаров на SQLite FTS5.
+
+Виртуальная таблица shop_product_fts хранит нормализованные название,
+описание и категорию товара; rowid совпадает с id товара. Индекс обновляется
+сигналами Product/Category (см. shop/signals.py) и пересобирается командой
+rebuild_search_index.
+
+Морфологию русского языка FTS5 не знает, поэтому слова запроса обрезаются до
+основы простым стеммером и ищутся по префиксу: «футболки» -> «футболк*».
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Product
+
+FTS_TABLE = 'shop_product_fts'
+
+# Веса колонок для bm25: название важнее категории, категория важнее описания
+BM25_WEIGHTS = (10.0, 1.0, 3.0)
+
+INSERT_SQL = f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) VALUES (%s, %s, %s, %s)'
+
+WORD_RE = re.compile(r'\w+')
+
+# Окончания, которые отрезаются от слов запроса (самые длинные проверяются первыми)
+RUSSIAN_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ую', 'юю', 'ом', 'ем', 'ам', 'ям',
+    'ах', 'ях', 'ов', 'ев', 'ия', 'ию', 'ые', 'ие', 'ых', 'их',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+MIN_STEM_LENGTH = 3
+
+
+def fts_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def normalize_text(text):
+    """Приводит текст к виду, в котором он лежит в индексе"""
+    return (text or '').casefold().replace('ё', 'е')
+
+
+def stem(word):
+    """Грубая основа русского слова для префиксного поиска"""
+    if not re.search('[а-я]', word):
+        return word
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def build_match_query(query):
+    """Строит выражение MATCH из пользовательского запроса; None — искать нечего"""
+    words = WORD_RE.findall(normalize_text(query))
+    terms = [f'"{stem(word)}"*' for word in words]
+    return ' '.join(terms) or None
+
+
+def _row(product):
+    return (
+        product.pk,
+        normalize_text(product.name),
+        normalize_text(product.description),
+        normalize_text(product.category.name),
+    )
+
+
+def index_products(products):
+    """Добавляет или обновляет товары в индексе"""
+    if not fts_enabled():
+        return
+    rows = [_row(product) for product in products]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(INSERT_SQL, rows)
+
+
+def remove_products(product_ids):
+    if not fts_enabled() or not product_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+
+def rebuild_index(batch_size=1000):
+    """Полностью пересобирает индекс пачками; возвращает число товаров"""
+    if not fts_enabled():
+        return 0
+    total = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        batch = []
+        products = Product.objects.select_related('category').only(
+            'name', 'description', 'category__name'
+        ).order_by('pk').iterator(chunk_size=batch_size)
+        for product in products:
+            batch.append(_row(product))
+            if len(batch) >= batch_size:
+                cursor.executemany(INSERT_SQL, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(INSERT_SQL, batch)
+            total += len(batch)
+        # Сливаем сегменты b-дерева после массовой вставки
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return total
+
+
+def search_product_ids(query, limit=48):
+    """id доступных товаров, отсортированные по релевантности"""
+    match = build_match_query(query)
+    if match is None:
+        return []
+
+    if not fts_enabled():
+        # Запасной вариант для других СУБД: без ранжирования
+        products = Product.objects.filter(available=True).filter(
+            Q(name__icontains=query) | Q(description__icontains=query) | Q(category__name__icontains=query)
+        )
+        return list(products.values_list('pk', flat=True)[:limit])
+
+    weights = ', '.join(str(weight) for weight in BM25_WEIGHTS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT p.id FROM {FTS_TABLE} '
+            f'JOIN {Product._meta.db_table} p ON p.id = {FTS_TABLE}.rowid '
+            f'WHERE {FTS_TABLE} MATCH %s AND p.available '
+            f'ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s',
+            [match, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_products(query, limit=48):
+    """Товары по запросу в порядке релевантности"""
+    ids = search_product_ids(query, limit)
+    products = Product.objects.select_related('category').in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
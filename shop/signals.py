@@ -0,0 +1,106 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .flash import product_saved
+from .inventory import record
+from .locations import index_trigrams, locations_changed
+from .models import Category, InventoryMovement, Location, Product, Review
+from .pagecache import catalog_changed
+from .ratings import apply_review_change, rebuild_ratings, review_state
+from .search import index_products, remove_products
+
+
+# Рейтинги товаров
+@receiver(post_init, sender=Review)
+def remember_review_state(sender, instance, **kwargs):
+    """Запоминаем состояние отзыва из базы, чтобы при сохранении знать дельту"""
+    instance._rating_state = review_state(instance) if instance.pk else None
+
+
+@receiver(post_save, sender=Review)
+def update_ratings_on_review_save(sender, instance, created, **kwargs):
+    new_state = review_state(instance)
+    old_state = None if created else instance._rating_state
+
+    if new_state is None or (not created and old_state is None):
+        # Отзыв загружен с отложенными полями — дельту не посчитать
+        rebuild_ratings([instance.product_id])
+    else:
+        apply_review_change(old_state, new_state)
+    instance._rating_state = review_state(instance)
+
+
+@receiver(post_delete, sender=Review)
+def update_ratings_on_review_delete(sender, instance, **kwargs):
+    if instance._rating_state is None:
+        rebuild_ratings([instance.product_id])
+    else:
+        apply_review_change(instance._rating_state, None)
+
+
+# Префиксный и триграммный индексы локаций
+@receiver(post_save, sender=Location)
+def reindex_location_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_trigrams([instance])
+    locations_changed()
+
+
+@receiver(post_delete, sender=Location)
+def invalidate_location_index(sender, **kwargs):
+    # Строки триграмм удаляются каскадом
+    locations_changed()
+
+
+# Полнотекстовый индекс товаров
+@receiver(post_save, sender=Product)
+def index_product_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_products([instance])
+
+
+# Журнал движения товара: начальный остаток нового товара — приход
+@receiver(post_save, sender=Product)
+def record_initial_stock(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.stock:
+        record([InventoryMovement(product=instance, kind=InventoryMovement.RECEIPT, quantity=instance.stock)])
+
+
+# Счетчики флеш-распродаж
+@receiver(post_save, sender=Product)
+def sync_flash_counter(sender, instance, created, raw=False, **kwargs):
+    if raw or (created and not instance.flash_sale):
+        return
+    product_saved(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product_on_delete(sender, instance, **kwargs):
+    remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, raw=False, **kwargs):
+    # Название категории индексируется вместе с товаром
+    if created or raw:
+        return
+    products = Product.objects.filter(category=instance).only('name', 'description', 'category')
+    batch = []
+    for product in products.iterator(chunk_size=500):
+        product.category = instance
+        batch.append(product)
+        if len(batch) >= 500:
+            index_products(batch)
+            batch = []
+    index_products(batch)
+
+
+# Кэш страниц каталога
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_page_cache(sender, **kwargs):
+    catalog_changed()
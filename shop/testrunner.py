@@ -0,0 +1,11 @@
+"""Тестовый раннер проекта (TEST_RUNNER в settings)"""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class StrictQueryBudgetRunner(DiscoverRunner):
+    """Запускает тесты с QUERY_BUDGET_STRICT = True: любое превышение бюджета роняет тест"""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        settings.QUERY_BUDGET_STRICT = True
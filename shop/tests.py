@@ -1,8 +1,33 @@
 # shop/tests.py
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.urls import reverse
-from .models import Category, Product, Cart, CartItem, Order, OrderItem, Review
+from django.utils import timezone
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection
+from datetime import datetime, timedelta
+from io import StringIO
+import csv
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
+from .models import Category, Product, Cart, CartItem, Order, OrderItem, Review, Location, StockHold
+from .models import ArchivedOrder, ArchivedOrderItem, CacheGeneration, CheckoutToken, InventoryMovement, InventorySnapshot
+from .models import FlashStock, LocationTrigram, ProductRatingStats
+from . import archive, exports, flash, fragments, generations, inventory, pagecache, views
+from .checkout import DuplicateCheckout, InsufficientStock, cancel_order, place_order
+from .pagination import keyset_paginate
+from .holds import hold_cart
+from .querybudget import QueryBudgetExceeded
+from .locations import location_index, locations_version
 from .forms import OrderCreateForm, ReviewForm
 from decimal import Decimal
 
@@ -378,4 +403,2416 @@ class IntegrationTests(TestCase):
         # Проверяем
         self.assertEqual(order.items.count(), 1)
         self.assertEqual(order.total_price, Decimal('3000.00'))
-        self.assertEqual(order.status, 'pending')
\ No newline at end of file
+        self.assertEqual(order.status, 'pending')
+
+
+class ProductListPaginationTests(TestCase):
+    """Тесты курсорной пагинации каталога"""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.other_category = Category.objects.create(name='Аксессуары', slug='accessories')
+        for i in range(30):
+            Product.objects.create(
+                name=f'Товар {i}',
+                slug=f'product-{i}',
+                description='Описание',
+                price=Decimal(1000 + (i % 7) * 100),
+                category=self.category if i % 3 else self.other_category,
+                available=True
+            )
+        self.url = reverse('shop:product_list')
+
+    def _collect(self, params):
+        """Проходит все страницы JSON-варианта и собирает id товаров"""
+        ids = []
+        cursor = None
+        while True:
+            query = dict(params, format='json')
+            if cursor:
+                query['cursor'] = cursor
+            data = self.client.get(self.url, query).json()
+            ids.extend(item['id'] for item in data['results'])
+            cursor = data['next_cursor']
+            if not cursor:
+                return ids
+
+    def test_first_page_is_limited(self):
+        """Первая страница содержит не больше PRODUCTS_PAGE_SIZE товаров"""
+        from .views import PRODUCTS_PAGE_SIZE
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.context['products']), PRODUCTS_PAGE_SIZE)
+        self.assertTrue(response.context['page'].has_next)
+
+    def test_pages_cover_catalog_without_duplicates(self):
+        """Проход по курсорам возвращает каждый товар ровно один раз"""
+        ids = self._collect({})
+        self.assertEqual(len(ids), 30)
+        self.assertEqual(len(set(ids)), 30)
+
+    def test_price_sort_is_stable(self):
+        """Сортировка по цене с одинаковыми ценами не теряет товары"""
+        ids = self._collect({'sort': 'price'})
+        expected = list(Product.objects.order_by('price', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_category_filter_with_cursor(self):
+        """Фильтр по категории сохраняется на всех страницах"""
+        ids = self._collect({'category': 'accessories'})
+        expected = set(Product.objects.filter(category=self.other_category).values_list('id', flat=True))
+        self.assertEqual(set(ids), expected)
+
+    def test_invalid_cursor_returns_first_page(self):
+        """Испорченный курсор не ломает страницу"""
+        from .views import PRODUCTS_PAGE_SIZE
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['products']), PRODUCTS_PAGE_SIZE)
+
+    def _page_plan(self, params):
+        """План запроса товаров страницы каталога (EXPLAIN QUERY PLAN)"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, dict(params, format='json'))
+        sql = next(query['sql'] for query in queries if query['sql'].startswith('SELECT') and 'FROM "shop_product"' in query['sql'])
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_deep_pages_use_index(self):
+        """Страница по курсору идет по частичному индексу, без сортировки всей выборки"""
+        for params, index_name in (({}, 'product_avail_created_idx'), ({'sort': 'price'}, 'product_avail_price_idx')):
+            cursor = self.client.get(self.url, dict(params, format='json')).json()['next_cursor']
+            plan = self._page_plan(dict(params, cursor=cursor))
+            self.assertTrue(any(index_name in line for line in plan), plan)
+            self.assertFalse(any(line.startswith('USE TEMP B-TREE') for line in plan), plan)
+
+
+class RatingStatsTests(TestCase):
+    """Тесты денормализованных агрегатов рейтинга"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reviewer', password='TestPass123')
+        self.other = User.objects.create_user(username='other', password='TestPass123')
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка',
+            slug='t-shirt',
+            description='Описание',
+            price=Decimal('1000.00'),
+            category=self.category,
+            available=True
+        )
+
+    def _stats(self):
+        self.product = Product.objects.select_related('rating_stats').get(pk=self.product.pk)
+        stats = self.product.ratings
+        return stats.rating_sum, stats.rating_count, dict(self.product.rating_histogram())
+
+    def test_create_updates_stats(self):
+        """Новый отзыв увеличивает сумму, количество и гистограмму"""
+        Review.objects.create(product=self.product, user=self.user, rating=5)
+        Review.objects.create(product=self.product, user=self.other, rating=3)
+        rating_sum, rating_count, histogram = self._stats()
+        self.assertEqual((rating_sum, rating_count), (8, 2))
+        self.assertEqual(histogram[5], 1)
+        self.assertEqual(histogram[3], 1)
+        self.assertEqual(self.product.average_rating(), 4)
+
+    def test_edit_and_unapprove(self):
+        """Изменение оценки и снятие одобрения переносятся в агрегаты"""
+        review = Review.objects.create(product=self.product, user=self.user, rating=5)
+        review = Review.objects.get(pk=review.pk)
+        review.rating = 2
+        review.save()
+        self.assertEqual(self._stats()[:2], (2, 1))
+        self.assertEqual(self._stats()[2][5], 0)
+
+        review.approved = False
+        review.save()
+        self.assertEqual(self._stats()[:2], (0, 0))
+
+        review.approved = True
+        review.save()
+        self.assertEqual(self._stats()[:2], (2, 1))
+
+    def test_review_views_update_stats(self):
+        """add_review, edit_review и delete_review поддерживают агрегаты"""
+        self.client.login(username='reviewer', password='TestPass123')
+        self.client.post(reverse('shop:add_review', args=[self.product.id]), {'rating': '4'})
+        self.assertEqual(self._stats()[:2], (4, 1))
+
+        review = Review.objects.get(product=self.product, user=self.user)
+        self.client.post(reverse('shop:edit_review', args=[review.id]), {'rating': '1'})
+        self.assertEqual(self._stats()[:2], (1, 1))
+
+        self.client.post(reverse('shop:delete_review', args=[review.id]))
+        self.assertEqual(self._stats()[:2], (0, 0))
+
+    def test_bulk_delete_updates_stats(self):
+        """Удаление через queryset тоже учитывается"""
+        Review.objects.create(product=self.product, user=self.user, rating=5)
+        Review.objects.create(product=self.product, user=self.other, rating=4)
+        Review.objects.filter(product=self.product).delete()
+        self.assertEqual(self._stats()[:2], (0, 0))
+
+    def test_rebuild_command(self):
+        """Команда rebuild_ratings восстанавливает рассинхронизированные агрегаты"""
+        Review.objects.create(product=self.product, user=self.user, rating=5)
+        Review.objects.create(product=self.product, user=self.other, rating=2)
+        ProductRatingStats.objects.filter(pk=self.product.pk).update(rating_sum=0, rating_count=0, rating_5=0)
+
+        call_command('rebuild_ratings', stdout=StringIO())
+        rating_sum, rating_count, histogram = self._stats()
+        self.assertEqual((rating_sum, rating_count), (7, 2))
+        self.assertEqual(histogram[5], 1)
+        self.assertEqual(histogram[2], 1)
+
+    def test_stale_product_save_keeps_stats(self):
+        """Полное сохранение устаревшего экземпляра товара не откатывает новые отзывы"""
+        Review.objects.create(product=self.product, user=self.user, rating=5)
+        stale = Product.objects.select_related('rating_stats').get(pk=self.product.pk)
+        Review.objects.create(product=self.product, user=self.other, rating=3)
+        stale.price = Decimal('900.00')
+        stale.save()
+        self.assertEqual(self._stats()[:2], (8, 2))
+        self.assertEqual(self.product.price, Decimal('900.00'))
+
+    def test_delete_reviewed_product_and_category(self):
+        """Товар и категорию с одобренными отзывами можно удалить: строка агрегатов не воскресает"""
+        Review.objects.create(product=self.product, user=self.user, rating=5)
+        self.product.delete()
+        other = Product.objects.create(
+            name='Рубашка', slug='shirt', description='Описание', price=Decimal('2000.00'), category=self.category
+        )
+        Review.objects.create(product=other, user=self.other, rating=4)
+        self.category.delete()
+
+        # SQLite проверяет внешние ключи только при коммите — проверяем явно
+        connection.check_constraints()
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(ProductRatingStats.objects.exists())
+
+
+class ProductReviewsPaginationTests(TestCase):
+    """Тесты постраничной загрузки отзывов"""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка',
+            slug='t-shirt',
+            description='Описание',
+            price=Decimal('1000.00'),
+            category=self.category,
+            available=True
+        )
+        self.users = [User.objects.create(username=f'user{i}') for i in range(24)]
+        self.users.append(User.objects.create_user(username='user24', password='TestPass123'))
+        for i, user in enumerate(self.users):
+            Review.objects.create(product=self.product, user=user, rating=i % 5 + 1, comment=f'Отзыв номер {i}')
+
+    def test_detail_renders_first_page_in_constant_queries(self):
+        """Первая страница отзывов рендерится без N+1 по пользователям"""
+        from .views import REVIEWS_PAGE_SIZE
+        # Метки поколений после setUp перечитываются до замера: считаем только рендер страницы
+        generations.generations.check()
+        # ETag товара, сам товар и первая страница отзывов с авторами
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('shop:product_detail', args=[self.product.id]))
+        self.assertEqual(len(response.context['reviews']), REVIEWS_PAGE_SIZE)
+        self.assertIsNotNone(response.context['reviews_next_cursor'])
+        self.assertContains(response, 'Показать еще отзывы')
+
+    def test_json_endpoint_pages_through_all_reviews(self):
+        """JSON-эндпоинт отдает остальные отзывы по курсору"""
+        first = self.client.get(reverse('shop:product_detail', args=[self.product.id]))
+        seen = [review.id for review in first.context['reviews']]
+        cursor = first.context['reviews_next_cursor']
+        url = reverse('shop:product_reviews', args=[self.product.id])
+        while cursor:
+            data = self.client.get(url, {'cursor': cursor}).json()
+            seen.extend(review['id'] for review in data['results'])
+            cursor = data['next_cursor']
+        expected = list(Review.objects.filter(product=self.product).order_by('-created', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_json_marks_own_reviews(self):
+        """Свой отзыв приходит со ссылками на редактирование"""
+        self.client.login(username='user24', password='TestPass123')
+        data = self.client.get(reverse('shop:product_reviews', args=[self.product.id])).json()
+        own = [review for review in data['results'] if review['username'] == 'user24']
+        others = [review for review in data['results'] if review['username'] != 'user24']
+        self.assertEqual(len(own), 1)
+        self.assertTrue(own[0]['is_own'])
+        self.assertIsNotNone(own[0]['edit_url'])
+        self.assertTrue(all(review['edit_url'] is None for review in others))
+
+    def test_deep_pages_use_index(self):
+        """Страница отзывов по курсору идет по частичному индексу, без сортировки всех отзывов"""
+        url = reverse('shop:product_reviews', args=[self.product.id])
+        cursor = self.client.get(url).json()['next_cursor']
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {'cursor': cursor})
+        sql = next(query['sql'] for query in queries if query['sql'].startswith('SELECT') and 'FROM "shop_review"' in query['sql'])
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            plan = [row[-1] for row in db_cursor.fetchall()]
+        self.assertTrue(any('review_product_feed_idx' in line for line in plan), plan)
+        self.assertFalse(any(line.startswith('USE TEMP B-TREE') for line in plan), plan)
+
+
+class ProductSearchTests(TestCase):
+    """Тесты полнотекстового поиска"""
+
+    def setUp(self):
+        self.clothing = Category.objects.create(name='Одежда', slug='clothing')
+        self.jewelry = Category.objects.create(name='Украшения', slug='jewelry')
+        self.tshirt = Product.objects.create(
+            name='Футболка Nilan', slug='t-shirt', description='Хлопковая футболка с принтом',
+            price=Decimal('1500.00'), category=self.clothing, available=True
+        )
+        self.hedgehog = Product.objects.create(
+            name='Свитер Ёжик', slug='sweater', description='Теплый свитер',
+            price=Decimal('3000.00'), category=self.clothing, available=True
+        )
+        self.ring = Product.objects.create(
+            name='Кольцо', slug='ring', description='Серебряное кольцо, подходит к футболке',
+            price=Decimal('2000.00'), category=self.jewelry, available=True
+        )
+        self.url = reverse('shop:product_search')
+
+    def _ids(self, query):
+        return [item['id'] for item in self.client.get(self.url, {'q': query, 'format': 'json'}).json()['results']]
+
+    def test_morphology_and_ranking(self):
+        """Словоформа находит товар, совпадение в названии ранжируется выше описания"""
+        self.assertEqual(self._ids('футболки'), [self.tshirt.id, self.ring.id])
+
+    def test_case_folding_and_yo(self):
+        """Кириллица ищется без учета регистра и разницы е/ё"""
+        self.assertEqual(self._ids('ЕЖИК'), [self.hedgehog.id])
+        self.assertEqual(self._ids('кол'), [self.ring.id])
+
+    def test_category_name_is_indexed(self):
+        """Поиск по названию категории"""
+        self.assertEqual(self._ids('украшения'), [self.ring.id])
+
+    def test_index_follows_product_changes(self):
+        """Сигналы обновляют индекс при изменении и удалении товара"""
+        self.ring.name = 'Браслет'
+        self.ring.save()
+        self.assertEqual(self._ids('браслет'), [self.ring.id])
+        self.assertEqual(self._ids('кольцо'), [self.ring.id])  # осталось в описании
+
+        self.jewelry.name = 'Бижутерия'
+        self.jewelry.save()
+        self.assertEqual(self._ids('бижутерия'), [self.ring.id])
+
+        self.ring.delete()
+        self.assertEqual(self._ids('браслет'), [])
+
+    def test_unavailable_products_are_hidden(self):
+        Product.objects.filter(pk=self.tshirt.pk).update(available=False)
+        self.assertEqual(self._ids('футболка'), [self.ring.id])
+
+    def test_rebuild_command(self):
+        """Команда пересобирает индекс с нуля"""
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM shop_product_fts')
+        self.assertEqual(self._ids('свитер'), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self._ids('свитер'), [self.hedgehog.id])
+
+    def test_search_page_renders(self):
+        response = self.client.get(self.url, {'q': 'свитер'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'shop/search.html')
+        self.assertContains(response, 'Свитер Ёжик')
+
+
+class LocationsApiTests(TestCase):
+    """Тесты подсказок городов из префиксного индекса"""
+
+    def setUp(self):
+        location_index.invalidate()
+        for name in ['Москва', 'Мосальск', 'Мурманск', 'Орёл', 'Омск']:
+            Location.objects.create(name=name)
+        Location.objects.create(name='Монголия', is_country=True)
+        self.url = reverse('shop:api_locations')
+
+    def tearDown(self):
+        location_index.invalidate()
+
+    def test_cyrillic_case_folding(self):
+        """Строчный префикс находит город с заглавной буквы"""
+        response = self.client.get(self.url, {'term': 'моск', 'type': 'city'})
+        self.assertEqual(response.json(), ['Москва'])
+
+    def test_yo_is_normalized(self):
+        """ё и е не различаются"""
+        self.assertEqual(self.client.get(self.url, {'term': 'орел'}).json(), ['Орёл'])
+
+    def test_order_and_type_filter(self):
+        """Результаты по алфавиту, страны отдельно от городов"""
+        self.assertEqual(self.client.get(self.url, {'term': 'мо', 'type': 'city'}).json(), ['Мосальск', 'Москва'])
+        self.assertEqual(self.client.get(self.url, {'term': 'мо', 'type': 'country'}).json(), ['Монголия'])
+
+    def test_limit(self):
+        """Не больше десяти подсказок"""
+        for i in range(15):
+            Location.objects.create(name=f'Новгород {i:02d}')
+        self.assertEqual(len(self.client.get(self.url, {'term': 'нов'}).json()), 10)
+
+    def test_etag_and_not_modified(self):
+        """Ответ кэшируется браузером и перепроверяется по ETag"""
+        response = self.client.get(self.url, {'term': 'мо'})
+        self.assertIn('max-age', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = self.client.get(self.url, {'term': 'мо'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_changes_when_locations_change(self):
+        """Изменение справочника меняет ETag"""
+        etag = self.client.get(self.url, {'term': 'мо'})['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Location.objects.create(name='Можайск')
+        response = self.client.get(self.url, {'term': 'мо'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Можайск', response.json())
+
+    def test_index_invalidated_on_save(self):
+        """Сохранение локации сбрасывает индекс"""
+        self.assertEqual(self.client.get(self.url, {'term': 'тул'}).json(), [])
+        Location.objects.create(name='Тула')
+        self.assertEqual(self.client.get(self.url, {'term': 'тул'}).json(), ['Тула'])
+
+
+class ImportLocationsTests(TestCase):
+    """Тесты потоковой загрузки справочника локаций"""
+
+    def setUp(self):
+        location_index.invalidate()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        location_index.invalidate()
+
+    def _write(self, filename, content):
+        path = os.path.join(self.tmpdir.name, filename)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(content)
+        return path
+
+    def _import(self, path, *args):
+        out = StringIO()
+        call_command('import_locations', path, *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv_import_normalizes_and_deduplicates(self):
+        """Пробелы схлопываются, дубликаты в файле пропускаются"""
+        path = self._write('cities.csv', 'name,type\n  Москва ,city\nмосква,city\nРоссия,country\nНижний   Новгород,city\n')
+        self._import(path)
+        self.assertEqual(
+            sorted(Location.objects.filter(is_country=False).values_list('name', flat=True)),
+            ['Москва', 'Нижний Новгород']
+        )
+        self.assertTrue(Location.objects.filter(name='Россия', is_country=True).exists())
+
+    def test_reimport_diffs_against_existing(self):
+        """Повторная загрузка обновляет только изменившиеся строки"""
+        Location.objects.create(name='Орел')
+        existing = Location.objects.create(name='САМАРА')
+        path = self._write('cities.tsv', 'Орел\nСамара\nТула\n')
+        output = self._import(path)
+        self.assertIn('создано 1, обновлено 1, без изменений 1', output)
+        existing.refresh_from_db()
+        self.assertEqual(existing.name, 'Самара')
+
+    def test_prune_removes_missing_rows_of_imported_type(self):
+        """--prune удаляет отсутствующие в файле строки только загружаемого типа"""
+        Location.objects.create(name='Старый город')
+        Location.objects.create(name='Франция', is_country=True)
+        path = self._write('cities.jsonl', '{"name": "Казань"}\n"Омск"\n')
+        self._import(path, '--prune')
+        self.assertEqual(
+            sorted(Location.objects.filter(is_country=False).values_list('name', flat=True)),
+            ['Казань', 'Омск']
+        )
+        self.assertTrue(Location.objects.filter(name='Франция').exists())
+        # Триграммы удаленных локаций удаляются вместе с ними
+        self.assertFalse(LocationTrigram.objects.exclude(location__in=Location.objects.all()).exists())
+
+    def test_import_refreshes_suggestions(self):
+        """После загрузки подсказки видят новые города"""
+        url = reverse('shop:api_locations')
+        self.assertEqual(self.client.get(url, {'term': 'каз'}).json(), [])
+        self._import(self._write('cities.csv', 'name\nКазань\n'))
+        self.assertEqual(self.client.get(url, {'term': 'каз'}).json(), ['Казань'])
+
+    def test_dry_run_writes_nothing(self):
+        self._import(self._write('cities.csv', 'name\nКазань\n'), '--dry-run')
+        self.assertFalse(Location.objects.exists())
+
+
+class LocationFuzzyTests(TestCase):
+    """Тесты нечетких подсказок городов по триграммам"""
+
+    def setUp(self):
+        location_index.invalidate()
+        for name in ['Москва', 'Мосальск', 'Мурманск', 'Орёл', 'Омск']:
+            Location.objects.create(name=name)
+        Location.objects.create(name='Монголия', is_country=True)
+        self.url = reverse('shop:api_locations')
+
+    def tearDown(self):
+        location_index.invalidate()
+
+    def _fuzzy(self, term, type_='city'):
+        return self.client.get(self.url, {'term': term, 'type': type_, 'mode': 'fuzzy'}).json()
+
+    def test_typo_finds_city(self):
+        """Опечатка в названии все равно находит город"""
+        self.assertEqual(self._fuzzy('Масква')[0], 'Москва')
+        self.assertEqual(self._fuzzy('мурманк')[0], 'Мурманск')
+
+    def test_results_ranked_by_similarity(self):
+        """Более похожее название идет первым"""
+        Location.objects.create(name='Москвитино')
+        self.assertEqual(self._fuzzy('москва')[:2], ['Москва', 'Москвитино'])
+
+    def test_unrelated_term_returns_nothing(self):
+        """Непохожие названия не попадают в подсказки"""
+        self.assertEqual(self._fuzzy('Владивосток'), [])
+
+    def test_short_term_uses_prefix_search(self):
+        """Для коротких запросов работает обычный префиксный поиск"""
+        self.assertEqual(self._fuzzy('мо'), ['Мосальск', 'Москва'])
+
+    def test_type_filter(self):
+        """Страны ищутся отдельно от городов"""
+        self.assertEqual(self._fuzzy('Монголя', 'country'), ['Монголия'])
+        self.assertNotIn('Монголия', self._fuzzy('Монголя'))
+
+    def test_trigrams_follow_changes(self):
+        """Триграммы обновляются при переименовании и удалении"""
+        location = Location.objects.get(name='Омск')
+        location.name = 'Томск'
+        location.save()
+        self.assertEqual(self._fuzzy('Томкс')[0], 'Томск')
+        location.delete()
+        self.assertNotIn('Томск', self._fuzzy('Томкс'))
+
+    def test_import_indexes_trigrams(self):
+        """Загруженные командой города доступны нечеткому поиску"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cities.csv')
+            with open(path, 'w', encoding='utf-8') as handle:
+                handle.write('name\nЕкатеринбург\n')
+            call_command('import_locations', path, stdout=StringIO())
+        self.assertEqual(self._fuzzy('Екатеренбург'), ['Екатеринбург'])
+
+
+ORDER_FORM_DATA = {
+    'customer_name': 'Иван Иванов',
+    'customer_email': 'ivan@example.com',
+    'customer_phone': '+79123456789',
+    'shipping_address': 'ул. Примерная, д. 1',
+    'shipping_city': 'Москва',
+    'shipping_zip_code': '123456',
+    'shipping_country': 'Россия',
+    'payment_method': 'card'
+}
+
+
+class CheckoutTests(TestCase):
+    """Тесты оформления заказа и списания остатков"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.shirt = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=self.category, stock=5
+        )
+        self.cap = Product.objects.create(
+            name='Кепка', slug='cap', description='Описание',
+            price=Decimal('700.00'), category=self.category, stock=1
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        self.url = reverse('shop:order_create')
+
+    def test_order_reduces_stock_and_clears_cart(self):
+        """Заказ списывает остатки, снимает закончившийся товар с продажи и очищает корзину"""
+        CartItem.objects.create(cart=self.cart, product=self.shirt, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.cap, quantity=1)
+        response = self.client.post(self.url, ORDER_FORM_DATA)
+
+        order = Order.objects.get(user=self.user)
+        self.assertRedirects(response, reverse('shop:order_detail', args=[order.id]))
+        self.assertEqual(order.total_price, Decimal('3700.00'))
+        self.assertEqual(order.items.count(), 2)
+        self.shirt.refresh_from_db()
+        self.cap.refresh_from_db()
+        self.assertEqual((self.shirt.stock, self.shirt.available), (3, True))
+        self.assertEqual((self.cap.stock, self.cap.available), (0, False))
+        self.assertFalse(self.cart.items.exists())
+
+    def test_insufficient_stock_rolls_back_everything(self):
+        """Если одной позиции не хватает, не меняется ничего"""
+        CartItem.objects.create(cart=self.cart, product=self.shirt, quantity=2)
+        item = CartItem.objects.create(cart=self.cart, product=self.cap, quantity=1)
+        # Кепку выкупили после того, как она попала в корзину
+        Product.objects.filter(pk=self.cap.pk).update(stock=0)
+
+        order = Order(user=self.user)
+        with self.assertRaises(InsufficientStock) as raised:
+            place_order(order, self.cart.items.all())
+        self.assertEqual(raised.exception.product, item.product)
+
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        self.shirt.refresh_from_db()
+        self.assertEqual(self.shirt.stock, 5)
+        self.assertEqual(self.cart.items.count(), 2)
+
+    def test_view_reports_insufficient_stock(self):
+        """Представление возвращает в корзину с сообщением об остатке"""
+        CartItem.objects.create(cart=self.cart, product=self.shirt, quantity=5)
+
+        def place_order_after_competitor(order, cart_items, token=None):
+            # Форма прошла предварительную проверку, но остаток успел уменьшиться
+            Product.objects.filter(pk=self.shirt.pk).update(stock=3)
+            return place_order(order, cart_items, token=token)
+
+        with mock.patch('shop.views.place_order', place_order_after_competitor):
+            response = self.client.post(self.url, ORDER_FORM_DATA, follow=True)
+
+        self.assertRedirects(response, reverse('shop:cart_detail'))
+        self.assertContains(response, 'Доступно: 3 шт.')
+        self.assertFalse(Order.objects.exists())
+
+    def test_reduce_stock(self):
+        """reduce_stock не уходит в минус и обновляет экземпляр"""
+        self.assertFalse(self.cap.reduce_stock(2))
+        self.assertTrue(self.cap.reduce_stock(1))
+        self.assertEqual((self.cap.stock, self.cap.available), (0, False))
+
+
+class CheckoutConcurrencyTests(TransactionTestCase):
+    """Нагрузочный тест: параллельные заказы не продают больше остатка"""
+
+    ORDERS = 2000
+    THREADS = 4
+    STOCKS = {'shirt': 300, 'cap': 200, 'socks': 100}
+
+    def setUp(self):
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.products = [
+            Product.objects.create(
+                name=slug, slug=slug, description='Описание',
+                price=Decimal('100.00'), category=category, stock=stock
+            )
+            for slug, stock in self.STOCKS.items()
+        ]
+        users = User.objects.bulk_create([User(username=f'buyer{i}') for i in range(self.ORDERS)])
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+
+        rng = random.Random(42)
+        items = []
+        for cart in carts:
+            for product in rng.sample(self.products, rng.randint(1, len(self.products))):
+                items.append(CartItem(cart=cart, product=product, quantity=rng.randint(1, 3)))
+        CartItem.objects.bulk_create(items)
+
+    def _checkout_worker(self, carts, results):
+        try:
+            for cart in carts:
+                while True:
+                    try:
+                        place_order(Order(user_id=cart.user_id), cart.items.select_related('product'))
+                        results.append(True)
+                    except InsufficientStock:
+                        results.append(False)
+                    except OperationalError as error:
+                        # SQLite блокирует таблицу целиком; повторяем заказ
+                        if 'locked' not in str(error):
+                            raise
+                        time.sleep(0.001)
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_no_oversell_under_concurrency(self):
+        """Заказы из нескольких потоков не уводят остаток в минус и не теряют единиц товара"""
+        carts = list(Cart.objects.all())
+        results = []
+        threads = [
+            threading.Thread(target=self._checkout_worker, args=(carts[i::self.THREADS], results))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), self.ORDERS)
+        self.assertEqual(Order.objects.count(), results.count(True))
+        for product in self.products:
+            product.refresh_from_db()
+            sold = sum(OrderItem.objects.filter(product=product).values_list('quantity', flat=True))
+            self.assertGreaterEqual(product.stock, 0)
+            self.assertEqual(sold + product.stock, self.STOCKS[product.slug])
+            self.assertEqual(product.available, product.stock > 0)
+        # Спрос заведомо больше остатков: склад должен быть распродан почти полностью
+        self.assertLess(sum(product.stock for product in self.products), 3)
+
+
+class CheckoutQueryCountTests(TestCase):
+    """Число запросов при оформлении заказа не зависит от размера корзины"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'item-{i}', description='Описание',
+                    price=Decimal('100.00'), category=category, stock=10)
+            for i in range(20)
+        ])
+        self.cart = Cart.objects.create(user=self.user)
+
+    def _fill_cart(self, size):
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.cart, product=product, quantity=2) for product in self.products[:size]
+        ])
+
+    def _post_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('shop:order_create'), ORDER_FORM_DATA)
+        self.assertEqual(response.status_code, 302)
+        return len(queries)
+
+    def test_place_order_queries(self):
+        """Списание, позиции и очистка корзины — по одному запросу на 20 строк"""
+        # SELECT холдов, UPDATE остатков, INSERT заказа, позиций и журнала, DELETE корзины и две пары SAVEPOINT
+        self._fill_cart(20)
+        cart_items = list(self.cart.items.select_related('product'))
+        with self.assertNumQueries(10):
+            place_order(Order(user=self.user), cart_items)
+        self.assertEqual(OrderItem.objects.count(), 20)
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {8})
+
+    def test_view_queries_do_not_grow_with_cart(self):
+        """Заказ из одной и из двадцати позиций стоит одинаковое число запросов"""
+        self._fill_cart(1)
+        single = self._post_order()
+        self._fill_cart(20)
+        self.assertEqual(self._post_order(), single)
+
+
+class StockHoldTests(TestCase):
+    """Тесты холдов товара на время оформления заказа"""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=self.category, stock=5
+        )
+        self.alice = User.objects.create_user(username='alice', password='TestPass123')
+        self.bob = User.objects.create_user(username='bob', password='TestPass123')
+        self.url = reverse('shop:order_create')
+
+    def _cart(self, user, quantity):
+        cart, _ = Cart.objects.get_or_create(user=user)
+        CartItem.objects.update_or_create(cart=cart, product=self.product, defaults={'quantity': quantity})
+        return list(cart.items.select_related('product'))
+
+    def _open_checkout(self, user, quantity):
+        self._cart(user, quantity)
+        self.client.force_login(user)
+        return self.client.get(self.url)
+
+    def test_opening_checkout_holds_cart(self):
+        """Форма заказа резервирует товар, остаток для продажи уменьшается"""
+        response = self._open_checkout(self.alice, 3)
+        self.assertContains(response, 'зарезервированы')
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.held, self.product.available_to_sell()), (3, 2))
+        self.assertContains(self.client.get(reverse('shop:product_detail', args=[self.product.id])), 'В наличии: 2 шт.')
+
+    def test_reopening_replaces_holds(self):
+        """Повторное открытие формы не суммирует холды"""
+        self._open_checkout(self.alice, 3)
+        self._open_checkout(self.alice, 2)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.held, 2)
+        self.assertEqual(StockHold.objects.get().quantity, 2)
+
+    def test_held_stock_is_not_available_to_others(self):
+        """Чужой холд не дает открыть форму на зарезервированный товар"""
+        self._open_checkout(self.alice, 4)
+        response = self._open_checkout(self.bob, 2)
+        self.assertRedirects(response, reverse('shop:cart_detail'))
+        self.assertFalse(StockHold.objects.filter(user=self.bob).exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.held, 4)
+
+    def test_hold_protects_stock_at_submit(self):
+        """Покупатель без холда не может купить товар, зарезервированный другим"""
+        self._open_checkout(self.alice, 4)
+        with self.assertRaises(InsufficientStock):
+            place_order(Order(user=self.bob), self._cart(self.bob, 2))
+
+        place_order(Order(user=self.alice), self._cart(self.alice, 4))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.held), (1, 0))
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_expired_hold_is_reclaimed_on_demand(self):
+        """Просроченный холд освобождает товар, даже если очистка еще не прошла"""
+        self._open_checkout(self.alice, 4)
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(hold_cart(self.bob, self._cart(self.bob, 3)), [])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.held, 3)
+
+    def test_checkout_reclaims_expired_holds(self):
+        """Заказ проходит, если товар держат только просроченные чужие холды"""
+        self._open_checkout(self.alice, 4)
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        place_order(Order(user=self.bob), self._cart(self.bob, 3))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.held), (2, 0))
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_cart_respects_others_holds(self):
+        """В корзину нельзя положить товар, зарезервированный другим; свой холд не мешает"""
+        self._open_checkout(self.alice, 3)
+
+        self.client.force_login(self.bob)
+        bob_item = self._cart(self.bob, 2)[0]
+        response = self.client.post(reverse('shop:update_cart_item', args=[bob_item.id]), {'quantity': 3}, follow=True)
+        self.assertContains(response, 'Доступно: 2 шт.')
+        bob_item.refresh_from_db()
+        self.assertEqual(bob_item.quantity, 2)
+        self.client.post(reverse('shop:add_to_cart', args=[self.product.id]))
+        bob_item.refresh_from_db()
+        self.assertEqual(bob_item.quantity, 2)
+
+        self.client.force_login(self.alice)
+        alice_item = CartItem.objects.get(cart__user=self.alice)
+        self.client.post(reverse('shop:update_cart_item', args=[alice_item.id]), {'quantity': 5})
+        alice_item.refresh_from_db()
+        self.assertEqual(alice_item.quantity, 5)
+
+    def test_cart_reclaims_expired_holds(self):
+        """Просроченный чужой холд не мешает добавить товар в корзину"""
+        self._open_checkout(self.alice, 5)
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.client.force_login(self.bob)
+        self.client.post(reverse('shop:add_to_cart', args=[self.product.id]))
+        self.assertEqual(CartItem.objects.get(cart__user=self.bob).quantity, 1)
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_sweep_holds_in_batches(self):
+        """Команда sweep_holds удаляет только просроченные холды и возвращает их в продажу"""
+        users = User.objects.bulk_create([User(username=f'user{i}') for i in range(5)])
+        for user in users:
+            hold_cart(user, self._cart(user, 1))
+        StockHold.objects.filter(user__in=users[:4]).update(expires_at=timezone.now() - timedelta(minutes=1))
+
+        out = StringIO()
+        call_command('sweep_holds', '--batch-size', '2', stdout=out)
+        self.assertIn('Удалено просроченных холдов: 4', out.getvalue())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.held, 1)
+        self.assertEqual(StockHold.objects.get().user, users[4])
+
+    def test_rebuild_held(self):
+        """held пересчитывается по таблице холдов"""
+        hold_cart(self.alice, self._cart(self.alice, 2))
+        Product.objects.update(held=0)
+        call_command('sweep_holds', '--rebuild', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.held, 2)
+
+
+class StockHoldConcurrencyTests(TransactionTestCase):
+    """Нагрузочный тест: холды на горячий товар из нескольких потоков"""
+
+    USERS = 1000
+    THREADS = 4
+    STOCK = 300
+
+    def setUp(self):
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('100.00'), category=category, stock=self.STOCK
+        )
+        users = User.objects.bulk_create([User(username=f'buyer{i}') for i in range(self.USERS)])
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=self.product, quantity=1) for cart in carts])
+
+    def _hold_worker(self, carts, results):
+        try:
+            for cart in carts:
+                while True:
+                    try:
+                        results.append(not hold_cart(cart.user, list(cart.items.all())))
+                    except OperationalError as error:
+                        # SQLite блокирует таблицу целиком; повторяем попытку
+                        if 'locked' not in str(error):
+                            raise
+                        time.sleep(0.001)
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_hot_product_is_never_overheld(self):
+        """Холдов ровно столько, сколько товара на складе"""
+        carts = list(Cart.objects.select_related('user'))
+        results = []
+        threads = [
+            threading.Thread(target=self._hold_worker, args=(carts[i::self.THREADS], results))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), self.USERS)
+        self.assertEqual(results.count(True), self.STOCK)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.held, self.STOCK)
+        self.assertEqual(StockHold.objects.count(), self.STOCK)
+
+
+class FlashSaleTests(TestCase):
+    """Тесты счетчиков остатка флеш-распродажи"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Мерч', slug='merch')
+        self.product = Product.objects.create(
+            name='Худи дропа', slug='drop-hoodie', description='Описание',
+            price=Decimal('5000.00'), category=self.category, stock=5, flash_sale=True
+        )
+        self.regular = Product.objects.create(
+            name='Носки', slug='socks', description='Описание',
+            price=Decimal('300.00'), category=self.category, stock=1
+        )
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    def _order(self, **quantities):
+        self.cart.items.all().delete()
+        for slug, quantity in quantities.items():
+            CartItem.objects.create(cart=self.cart, product=Product.objects.get(slug=slug), quantity=quantity)
+        return place_order(Order(user=self.user), self.cart.items.select_related('product'))
+
+    def test_order_uses_counter_without_touching_product_row(self):
+        """Заказ флеш-товара списывает счетчик и не пишет в строку товара"""
+        with CaptureQueriesContext(connection) as queries:
+            self._order(**{'drop-hoodie': 2})
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE "shop_product"')])
+        self.assertEqual(flash.stock_left(self.product.pk), 3)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertFalse(OrderItem.objects.get().stock_flushed)
+
+    def test_flush_moves_sales_to_stock(self):
+        """flush_flash_stock переносит списания в Product.stock"""
+        self._order(**{'drop-hoodie': 5})
+        out = StringIO()
+        call_command('flush_flash_stock', stdout=out)
+        self.assertIn('Перенесено позиций заказов: 1', out.getvalue())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.available), (0, False))
+        self.assertTrue(OrderItem.objects.get().stock_flushed)
+
+    def test_counter_prevents_oversell(self):
+        """Больше счетчика не продается, неудачная попытка ничего не списывает"""
+        with self.assertRaises(InsufficientStock):
+            self._order(**{'drop-hoodie': 6})
+        self.assertEqual(flash.stock_left(self.product.pk), 5)
+
+    def test_failed_order_gives_counter_back(self):
+        """Если заказ откатился из-за обычного товара, счетчик восстанавливается"""
+        with self.assertRaises(InsufficientStock):
+            self._order(**{'drop-hoodie': 2, 'socks': 2})
+        self.assertEqual(flash.stock_left(self.product.pk), 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_counter_is_shared_and_reconciled(self):
+        """Счетчик живет в базе, а не в кэше процесса; reconcile выставляет его по несписанным позициям"""
+        self._order(**{'drop-hoodie': 2})
+        cache.clear()
+        self.assertEqual(flash.stock_left(self.product.pk), 3)
+
+        FlashStock.objects.filter(pk=self.product.pk).update(remaining=100)
+        call_command('flush_flash_stock', '--reconcile', stdout=StringIO())
+        self.assertEqual(flash.stock_left(self.product.pk), 3)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+        # Пропавшая строка создается заново по базе
+        FlashStock.objects.all().delete()
+        self.assertEqual(flash.stock_left(self.product.pk), 3)
+
+    def test_product_save_keeps_unflushed_sales(self):
+        """Сохранение товара в админке пересчитывает счетчик без потери несписанных продаж"""
+        self._order(**{'drop-hoodie': 2})
+        self.product.refresh_from_db()
+        self.product.price = Decimal('4500.00')
+        self.product.save()
+        self.assertEqual(flash.stock_left(self.product.pk), 3)
+        with self.assertRaises(InsufficientStock):
+            self._order(**{'drop-hoodie': 4})
+        self.assertEqual(flash.stock_left(self.product.pk), 3)
+
+    def test_product_page_reads_counter(self):
+        """Страница товара показывает остаток по счетчику"""
+        self._order(**{'drop-hoodie': 4})
+        response = self.client.get(reverse('shop:product_detail', args=[self.product.id]))
+        self.assertContains(response, 'В наличии: 1 шт.')
+
+    def test_restock_and_disable(self):
+        """Поступление обновляет счетчик, выключение распродажи переносит списания в базу"""
+        self._order(**{'drop-hoodie': 2})
+        self.product.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.add_stock(10)
+        self.assertEqual(flash.stock_left(self.product.pk), 13)
+
+        self.product.flash_sale = False
+        self.product.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 13)
+        self.assertFalse(FlashStock.objects.filter(pk=self.product.pk).exists())
+
+
+class FlashSaleConcurrencyTests(TransactionTestCase):
+    """Нагрузочный тест: заказы флеш-товара из нескольких потоков"""
+
+    ORDERS = 1000
+    THREADS = 4
+    STOCK = 300
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Мерч', slug='merch')
+        self.product = Product.objects.create(
+            name='Худи дропа', slug='drop-hoodie', description='Описание',
+            price=Decimal('5000.00'), category=category, stock=self.STOCK, flash_sale=True
+        )
+        users = User.objects.bulk_create([User(username=f'buyer{i}') for i in range(self.ORDERS)])
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+        CartItem.objects.bulk_create([CartItem(cart=cart, product=self.product, quantity=1) for cart in carts])
+
+    def tearDown(self):
+        cache.clear()
+
+    def _checkout_worker(self, carts, results):
+        try:
+            for cart in carts:
+                while True:
+                    try:
+                        place_order(Order(user_id=cart.user_id), cart.items.select_related('product'))
+                        results.append(True)
+                    except InsufficientStock:
+                        results.append(False)
+                    except OperationalError as error:
+                        # SQLite блокирует таблицу целиком; повторяем заказ
+                        if 'locked' not in str(error):
+                            raise
+                        time.sleep(0.001)
+                        continue
+                    break
+        finally:
+            connection.close()
+
+    def test_counter_never_oversells(self):
+        """Продано ровно столько, сколько было на складе"""
+        carts = list(Cart.objects.all())
+        results = []
+        threads = [
+            threading.Thread(target=self._checkout_worker, args=(carts[i::self.THREADS], results))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(True), self.STOCK)
+        self.assertEqual(flash.stock_left(self.product.pk), 0)
+        flash.flush()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.available), (0, False))
+
+
+class InventoryLedgerTests(TestCase):
+    """Тесты журнала движения товара"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=self.category, stock=10
+        )
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.cart = Cart.objects.create(user=self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    def _order(self, quantity):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=quantity)
+        return place_order(Order(user=self.user), self.cart.items.select_related('product'))
+
+    def _reconcile(self):
+        return inventory.reconcile()[1]
+
+    def _kinds(self):
+        return list(self.product.movements.order_by('pk').values_list('kind', 'quantity'))
+
+    def test_order_and_cancel_are_recorded(self):
+        """Продажа и отмена попадают в журнал, отмена возвращает товар на склад"""
+        order = self._order(3)
+        self.assertEqual(self._kinds(), [('receipt', 10), ('sale', -3)])
+        self.assertEqual(self._reconcile(), [])
+
+        self.assertTrue(cancel_order(order))
+        self.assertFalse(cancel_order(order))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+        self.assertEqual(self._kinds(), [('receipt', 10), ('sale', -3), ('cancel', 3)])
+        self.assertEqual(self._reconcile(), [])
+
+    def test_cancel_returns_sold_out_product_to_sale(self):
+        """Отмена заказа возвращает распроданный товар в продажу"""
+        order = self._order(10)
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.available)
+        cancel_order(order)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.available), (10, True))
+
+    def test_manual_stock_changes_are_recorded(self):
+        """add_stock и reduce_stock пишут приход и корректировку"""
+        self.product.add_stock(5, note='Поставка')
+        self.assertTrue(self.product.reduce_stock(2))
+        self.assertEqual(self.product.stock, 13)
+        self.assertEqual(self._kinds(), [('receipt', 10), ('receipt', 5), ('adjustment', -2)])
+        self.assertEqual(self._reconcile(), [])
+
+    def _admin_login(self):
+        # Изображение обязательно в форме товара; файл для сохранения не нужен
+        Product.objects.filter(pk=self.product.pk).update(image='products/t-shirt.jpg')
+        User.objects.create_superuser(username='manager', email='manager@example.com', password='TestPass123')
+        self.client.login(username='manager', password='TestPass123')
+
+    def _assert_sale_kept(self):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 11)
+        self.assertEqual(self._kinds()[-1], ('adjustment', 5))
+        self.assertEqual(self._reconcile(), [])
+
+    def test_admin_edit_applies_delta(self):
+        """Правка остатка в форме товара не затирает продажу, случившуюся пока форма была открыта"""
+        self._admin_login()
+        url = reverse('admin:shop_product_change', args=[self.product.id])
+        self.assertContains(self.client.get(url), 'name="initial-stock" value="10"')
+        self._order(4)
+
+        response = self.client.post(url, {
+            'name': 'Футболка', 'slug': 't-shirt', 'description': 'Описание', 'category': self.category.id,
+            'price': '1500.00', 'stock': '15', 'initial-stock': '10', 'available': 'on',
+        })
+        self.assertEqual(response.status_code, 302)
+        self._assert_sale_kept()
+
+    def test_admin_list_edit_applies_delta(self):
+        """То же для правки остатка прямо в списке товаров (list_editable)"""
+        self._admin_login()
+        url = reverse('admin:shop_product_changelist')
+        self.assertContains(self.client.get(url), 'name="initial-form-0-stock" value="10"')
+        self._order(4)
+
+        response = self.client.post(url, {
+            'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1', 'form-MIN_NUM_FORMS': '0', 'form-MAX_NUM_FORMS': '1000',
+            'form-0-id': self.product.id, 'form-0-price': '1500.00', 'form-0-stock': '15',
+            'initial-form-0-stock': '10', 'form-0-available': 'on', '_save': 'Сохранить',
+        })
+        self.assertEqual(response.status_code, 302)
+        self._assert_sale_kept()
+
+    def test_admin_cancel_is_final(self):
+        """Отмена в списке заказов возвращает товар, а вернуть отмененный заказ в работу нельзя"""
+        self._admin_login()
+        order = self._order(4)
+        url = reverse('admin:shop_order_changelist')
+
+        def set_status(status):
+            return self.client.post(url, {
+                'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1', 'form-MIN_NUM_FORMS': '0',
+                'form-MAX_NUM_FORMS': '1000', 'form-0-id': order.id, 'form-0-status': status, '_save': 'Сохранить',
+            })
+
+        self.assertEqual(set_status('cancelled').status_code, 302)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+
+        response = set_status('pending')
+        self.assertContains(response, 'Отмененный заказ нельзя вернуть в работу')
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+        self.assertEqual(self._kinds(), [('receipt', 10), ('sale', -4), ('cancel', 4)])
+        self.assertEqual(self._reconcile(), [])
+
+    def test_admin_untouched_stock_keeps_sale(self):
+        """Сохранение формы без правки остатка не возвращает проданное на склад"""
+        self._admin_login()
+        self._order(4)
+        self.client.post(reverse('admin:shop_product_change', args=[self.product.id]), {
+            'name': 'Футболка', 'slug': 't-shirt', 'description': 'Описание', 'category': self.category.id,
+            'price': '1400.00', 'stock': '10', 'initial-stock': '10', 'available': 'on',
+        })
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.price), (6, Decimal('1400.00')))
+        self.assertEqual(self._reconcile(), [])
+
+    def test_compaction_keeps_totals(self):
+        """Сжатие переносит старые движения в снимок, остаток по журналу не меняется"""
+        for _ in range(3):
+            self._order(1)
+        InventoryMovement.objects.update(created=timezone.now() - timedelta(days=40))
+        self._order(2)
+
+        out = StringIO()
+        call_command('compact_inventory', '--batch-size', '2', stdout=out)
+        self.assertIn('Свернуто движений: 4', out.getvalue())
+        snapshot = InventorySnapshot.objects.get(product=self.product)
+        self.assertEqual((snapshot.quantity, snapshot.sold), (7, 3))
+        self.assertEqual(self._kinds(), [('sale', -2)])
+        self.assertEqual(inventory.ledger_totals([self.product.pk]), {self.product.pk: (5, 5)})
+        self.assertEqual(self._reconcile(), [])
+
+    def test_reconcile_reports_drift(self):
+        """Изменение остатка мимо журнала находится сверкой"""
+        self._order(2)
+        Product.objects.filter(pk=self.product.pk).update(stock=100)
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('reconcile_inventory', '--chunk-size', '1', stdout=out)
+        self.assertIn(f'Товар {self.product.pk}: остаток по журналу 8, фактически 100', out.getvalue())
+
+    def test_unflushed_flash_sales_reconcile(self):
+        """Несписанные продажи флеш-распродажи не считаются расхождением"""
+        Product.objects.filter(pk=self.product.pk).update(flash_sale=True)
+        self.product.refresh_from_db()
+        self._order(3)
+        self.assertEqual(self._reconcile(), [])
+        flash.flush()
+        self.assertEqual(self._reconcile(), [])
+
+
+class CheckoutIdempotencyTests(TestCase):
+    """Повторная отправка формы заказа не создает второй заказ"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=category, stock=10
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        self.data = {**ORDER_FORM_DATA, 'checkout_token': str(uuid.uuid4())}
+
+    def test_form_carries_token(self):
+        """Форма заказа выдается с ключом идемпотентности"""
+        response = self.client.get(reverse('shop:order_create'))
+        token = response.context['checkout_token']
+        self.assertContains(response, f'name="checkout_token" value="{token}"')
+
+    def test_replay_redirects_to_existing_order(self):
+        """Повтор после коммита ведет на тот же заказ и не запускает оформление"""
+        first = self.client.post(reverse('shop:order_create'), self.data)
+        order = Order.objects.get()
+        self.assertRedirects(first, reverse('shop:order_detail', args=[order.id]))
+
+        with mock.patch('shop.views.place_order') as placed:
+            replay = self.client.post(reverse('shop:order_create'), self.data)
+        placed.assert_not_called()
+        self.assertRedirects(replay, reverse('shop:order_detail', args=[order.id]))
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 8)
+
+    def test_concurrent_duplicate_is_rolled_back(self):
+        """Дубль, не заставший первый заказ, откатывается на ограничении ключа"""
+        token = uuid.UUID(self.data['checkout_token'])
+        # Первый запрос сохраняет заказ, пока второй уже прочитал корзину
+        cart_items = list(self.cart.items.select_related('product'))
+        order = place_order(Order(user=self.user), cart_items, token=token)
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+
+        with mock.patch('shop.views.find_order', side_effect=[None, order]):
+            response = self.client.post(reverse('shop:order_create'), self.data)
+        self.assertRedirects(response, reverse('shop:order_detail', args=[order.id]))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.cart.items.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.held), (8, 0))
+
+    def test_token_of_another_user(self):
+        """Чужой ключ не открывает чужой заказ"""
+        other = User.objects.create_user(username='other')
+        other_order = Order.objects.create(user=other)
+        CheckoutToken.objects.create(token=self.data['checkout_token'], user=other, order=other_order)
+
+        response = self.client.post(reverse('shop:order_create'), self.data)
+        self.assertRedirects(response, reverse('shop:cart_detail'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+
+
+class CheckoutIdempotencyConcurrencyTests(TransactionTestCase):
+    """Одновременные отправки одной формы дают ровно один заказ"""
+
+    THREADS = 4
+
+    def setUp(self):
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('100.00'), category=category, stock=100
+        )
+        self.user = User.objects.create_user(username='buyer')
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=3)
+        self.cart_items = list(cart.items.select_related('product'))
+
+    def _submit(self, token, results, ready):
+        try:
+            ready.wait()
+            while True:
+                try:
+                    place_order(Order(user_id=self.user.pk), self.cart_items, token=token)
+                    results.append('placed')
+                except DuplicateCheckout:
+                    results.append('duplicate')
+                except OperationalError as error:
+                    if 'locked' not in str(error):
+                        raise
+                    time.sleep(0.001)
+                    continue
+                break
+        finally:
+            connection.close()
+
+    def test_single_order_per_token(self):
+        """Из одновременных дублей заказ сохраняет один, остальные откатываются"""
+        token = uuid.uuid4()
+        results = []
+        ready = threading.Barrier(self.THREADS)
+        threads = [
+            threading.Thread(target=self._submit, args=(token, results, ready))
+            for _ in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), ['duplicate'] * (self.THREADS - 1) + ['placed'])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(CheckoutToken.objects.get().order, Order.objects.get())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 97)
+
+
+class OrderHistoryTests(TestCase):
+    """История заказов: счетчики статусов, страницы и превью позиций"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'item-{i}', description='Описание',
+                    price=Decimal('100.00'), category=category, stock=10)
+            for i in range(5)
+        ])
+        self.url = reverse('shop:order_history')
+
+    def _create_orders(self, count, items=1, status='pending'):
+        orders = [Order(user=self.user, status=status) for _ in range(count)]
+        for order in orders:
+            order.fill_summary(self.products[:items])
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=1)
+            for order in orders for product in self.products[:items]
+        ])
+        return orders
+
+    def _get(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_status_counters(self):
+        """Счетчики по статусам считаются одним запросом, пустые статусы — нули"""
+        self._create_orders(3)
+        self._create_orders(2, status='delivered')
+        response, _ = self._get()
+        self.assertEqual(response.context['all_orders_count'], 5)
+        self.assertEqual(response.context['orders_by_status'], {
+            'pending': 3, 'processing': 0, 'shipped': 0, 'delivered': 2, 'cancelled': 0,
+        })
+
+    def test_queries_do_not_grow_with_orders(self):
+        """Страница стоит одинаково для одного заказа и для сотни заказов по пять позиций"""
+        self._create_orders(1)
+        _, single = self._get()
+        self._create_orders(100, items=5, status='shipped')
+        response, many = self._get()
+        self.assertEqual(many, single)
+        self.assertEqual(len(response.context['orders']), 10)
+
+    def test_preview_is_limited(self):
+        """В карточке первые три товара и число остальных"""
+        order = self._create_orders(1, items=5)[0]
+        response, _ = self._get()
+        card = response.context['orders'][0]
+        self.assertEqual(card.item_count, 5)
+        self.assertEqual([item['name'] for item in card.preview], ['Товар 0', 'Товар 1', 'Товар 2'])
+        self.assertContains(response, '+2 ещё')
+        self.assertContains(response, reverse('shop:order_detail', args=[order.id]))
+
+    def test_pages_follow_cursor_with_filter(self):
+        """Курсор листает заказы выбранного статуса без пропусков и повторов"""
+        self._create_orders(5, status='cancelled')
+        pending = self._create_orders(23)
+        seen = []
+        params = {'status': 'pending'}
+        while True:
+            response, _ = self._get(**params)
+            seen.extend(order.id for order in response.context['orders'])
+            page = response.context['page']
+            if not page.has_next:
+                break
+            self.assertContains(response, f'status=pending&cursor={page.next_cursor}')
+            params = {'status': 'pending', 'cursor': page.next_cursor}
+        self.assertEqual(seen, sorted((order.id for order in pending), reverse=True))
+
+
+class OrderSummaryTests(TestCase):
+    """Сводка заказа (число позиций и превью) на самом заказе"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'item-{i}', description='Описание',
+                    price=Decimal('100.00'), category=category, stock=10, image=f'products/{i}.jpg' if i else '')
+            for i in range(4)
+        ])
+        self.cart = Cart.objects.create(user=self.user)
+
+    def test_place_order_fills_summary(self):
+        """Сводка заполняется при оформлении заказа из товаров корзины"""
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=product) for product in self.products])
+        order = place_order(Order(user=self.user), self.cart.items.select_related('product').order_by('id'))
+        order.refresh_from_db()
+        self.assertEqual(order.item_count, 4)
+        self.assertEqual(order.preview, [
+            {'id': self.products[0].id, 'name': 'Товар 0', 'image': ''},
+            {'id': self.products[1].id, 'name': 'Товар 1', 'image': '/media/products/1.jpg'},
+            {'id': self.products[2].id, 'name': 'Товар 2', 'image': '/media/products/2.jpg'},
+        ])
+
+    def test_backfill_command(self):
+        """Команда заполняет сводку старых заказов пачками и не трогает заполненные"""
+        orders = Order.objects.bulk_create([Order(user=self.user) for _ in range(5)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=1)
+            for order in orders[:4] for product in self.products[:2]
+        ])
+        Order.objects.filter(pk=orders[0].pk).update(item_count=7)
+
+        out = StringIO()
+        call_command('backfill_order_summaries', '--batch-size', '2', stdout=out)
+        self.assertIn('Обновлена сводка заказов: 3', out.getvalue())
+        counts = dict(Order.objects.values_list('pk', 'item_count'))
+        self.assertEqual([counts[order.pk] for order in orders], [7, 2, 2, 2, 0])
+        self.assertEqual([item['name'] for item in Order.objects.get(pk=orders[1].pk).preview], ['Товар 0', 'Товар 1'])
+
+        call_command('backfill_order_summaries', '--all', stdout=StringIO())
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).item_count, 2)
+
+
+class OrderExportTests(TestCase):
+    """Потоковая выгрузка заказов в CSV и JSONL"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.shirt = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=category, stock=10
+        )
+        self.cap = Product.objects.create(
+            name='Кепка', slug='cap', description='Описание',
+            price=Decimal('700.00'), category=category, stock=10
+        )
+        self.old = self._order('delivered', timezone.make_aware(datetime(2026, 1, 10, 12, 0)), [self.shirt, self.cap])
+        self.new = self._order('pending', timezone.make_aware(datetime(2026, 2, 1, 0, 30)), [self.cap])
+
+    def _order(self, status, created, products):
+        order = Order.objects.create(user=self.user, status=status, customer_name='Иван Иванов', shipping_city='Москва')
+        Order.objects.filter(pk=order.pk).update(created=created)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=2) for product in products
+        ])
+        return order
+
+    def _export(self, *args):
+        out = StringIO()
+        call_command('export_orders', *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv_rows(self):
+        """Строка на позицию: поля заказа, товар, цена и количество"""
+        rows = list(csv.DictReader(StringIO(self._export())))
+        self.assertEqual(
+            [(int(row['order_id']), row['product_name'], row['price'], row['quantity']) for row in rows],
+            [(self.old.id, 'Футболка', '1500.00', '2'), (self.old.id, 'Кепка', '700.00', '2'), (self.new.id, 'Кепка', '700.00', '2')]
+        )
+        self.assertEqual(rows[0]['customer_name'], 'Иван Иванов')
+        self.assertEqual(rows[0]['created'], '2026-01-10T12:00:00+10:00')
+
+    def test_filters(self):
+        """Фильтры по статусу и датам (дата окончания включительно)"""
+        def order_ids(*args):
+            return {int(row['order_id']) for row in csv.DictReader(StringIO(self._export(*args)))}
+
+        self.assertEqual(order_ids('--status', 'pending'), {self.new.id})
+        self.assertEqual(order_ids('--date-to', '2026-01-10'), {self.old.id})
+        self.assertEqual(order_ids('--date-from', '2026-02-01'), {self.new.id})
+        self.assertEqual(order_ids('--date-from', '2026-01-11', '--date-to', '2026-01-31'), set())
+        with self.assertRaises(CommandError):
+            self._export('--date-from', '10.01.2026')
+
+    def test_jsonl_to_file(self):
+        """JSONL пишется в файл по строке на позицию"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'orders.jsonl')
+            self._export('--format', 'jsonl', '--status', 'delivered', '--output', path)
+            with open(path, encoding='utf-8') as output:
+                rows = [json.loads(line) for line in output]
+        self.assertEqual([row['product_name'] for row in rows], ['Футболка', 'Кепка'])
+        self.assertEqual(rows[0]['price'], '1500.00')
+        self.assertEqual(rows[0]['paid'], False)
+
+    def test_streaming_starts_before_query(self):
+        """Заголовок уходит без запросов, а все строки читаются одним запросом"""
+        lines = exports.export_lines(Order.objects.all(), 'csv', chunk_size=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(next(lines), ','.join(exports.HEADER) + '\r\n')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(lines)), 3)
+
+    def test_admin_action_streams(self):
+        """Действие админки отдает StreamingHttpResponse с выбранными заказами"""
+        User.objects.create_superuser(username='admin', password='AdminPass123')
+        self.client.login(username='admin', password='AdminPass123')
+        response = self.client.post(reverse('admin:shop_order_changelist'), {
+            'action': 'export_csv',
+            '_selected_action': [self.new.id],
+        })
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment; filename="orders-', response['Content-Disposition'])
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row['order_id']) for row in rows], [self.new.id])
+
+    def test_archived_orders_exported(self):
+        """Заказы из архива выгружаются вместе с живыми в порядке id и помечены колонкой archived"""
+        self.assertEqual(archive.archive_orders(), 1)
+        rows = list(csv.DictReader(StringIO(self._export())))
+        self.assertEqual(
+            [(int(row['order_id']), row['product_name'], row['archived']) for row in rows],
+            [(self.old.id, 'Футболка', 'True'), (self.old.id, 'Кепка', 'True'), (self.new.id, 'Кепка', 'False')]
+        )
+        self.assertEqual(rows[0]['created'], '2026-01-10T12:00:00+10:00')
+        self.assertEqual({int(row['order_id']) for row in csv.DictReader(StringIO(self._export('--status', 'delivered')))},
+                         {self.old.id})
+        self.assertEqual({int(row['order_id']) for row in csv.DictReader(StringIO(self._export('--no-archived')))},
+                         {self.new.id})
+
+        User.objects.create_superuser(username='admin', password='AdminPass123')
+        self.client.login(username='admin', password='AdminPass123')
+        response = self.client.post(reverse('admin:shop_archivedorder_changelist'), {
+            'action': 'export_jsonl',
+            '_selected_action': [self.old.id],
+        })
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(row['product_name'], row['archived']) for row in rows], [('Футболка', True), ('Кепка', True)])
+
+
+class OrderArchiveTests(TestCase):
+    """Перенос старых заказов в архив и чтение истории из обеих таблиц"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=category, stock=100
+        )
+        self.cart = Cart.objects.create(user=self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    def _order(self, status='delivered', days_ago=365, quantity=1):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=quantity)
+        order = place_order(Order(user=self.user), self.cart.items.select_related('product'))
+        Order.objects.filter(pk=order.pk).update(
+            status=status, created=timezone.now() - timedelta(days=days_ago)
+        )
+        return order
+
+    def test_archives_old_finished_orders(self):
+        """В архив уходят только старые доставленные и отмененные заказы, id сохраняются"""
+        delivered = [self._order() for _ in range(3)]
+        cancelled = self._order()
+        cancel_order(cancelled)
+        recent = self._order(days_ago=10)
+        pending = self._order(status='pending')
+
+        out = StringIO()
+        call_command('archive_orders', '--batch-size', '2', stdout=out)
+        self.assertIn('Перенесено в архив заказов: 4', out.getvalue())
+
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)), {recent.pk, pending.pk})
+        archived = {order.pk: order for order in ArchivedOrder.objects.all()}
+        self.assertEqual(set(archived), {order.pk for order in delivered} | {cancelled.pk})
+        self.assertEqual(archived[cancelled.pk].status, 'cancelled')
+        self.assertEqual(archived[delivered[0].pk].total_price, Decimal('1500.00'))
+        self.assertEqual(ArchivedOrderItem.objects.filter(order_id=delivered[0].pk).get().quantity, 1)
+        self.assertFalse(OrderItem.objects.filter(order_id__in=archived).exists())
+        self.assertEqual(inventory.reconcile()[1], [])
+
+    def test_unflushed_flash_orders_wait(self):
+        """Заказ с несписанной позицией флеш-распродажи не архивируется до переноса остатков"""
+        Product.objects.filter(pk=self.product.pk).update(flash_sale=True)
+        order = self._order()
+        self.assertEqual(archive.archive_orders(), 0)
+        flash.flush()
+        self.assertEqual(archive.archive_orders(), 1)
+        self.assertTrue(ArchivedOrder.objects.filter(pk=order.pk).exists())
+        self.assertEqual(inventory.reconcile()[1], [])
+
+    def test_archived_order_detail(self):
+        """Архивный заказ открывается по прежнему адресу, но только владельцу"""
+        order = self._order(quantity=2)
+        archive.archive_orders()
+        response = self.client.get(reverse('shop:order_detail', args=[order.pk]))
+        self.assertContains(response, f'Заказ #{order.pk}')
+        self.assertContains(response, 'Футболка')
+
+        User.objects.create_user(username='other', password='TestPass123')
+        self.client.login(username='other', password='TestPass123')
+        response = self.client.get(reverse('shop:order_detail', args=[order.pk]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_history_merges_archive(self):
+        """История листает рабочие и архивные заказы одной лентой по дате"""
+        old = [self._order(days_ago=200 + i) for i in range(12)]
+        new = [self._order(status='shipped', days_ago=i) for i in range(1, 8)]
+        archive.archive_orders()
+        self.assertEqual(ArchivedOrder.objects.count(), 12)
+
+        url = reverse('shop:order_history')
+        response = self.client.get(url)
+        self.assertEqual(response.context['all_orders_count'], 19)
+        self.assertEqual(response.context['orders_by_status']['delivered'], 12)
+        self.assertEqual(response.context['orders_by_status']['shipped'], 7)
+
+        seen = []
+        params = {}
+        while True:
+            response = self.client.get(url, params)
+            seen.extend(order.pk for order in response.context['orders'])
+            page = response.context['page']
+            if not page.has_next:
+                break
+            params = {'cursor': page.next_cursor}
+        self.assertEqual(seen, [order.pk for order in new + old])
+
+        response = self.client.get(url, {'status': 'delivered'})
+        self.assertEqual([order.pk for order in response.context['orders']], [order.pk for order in old[:10]])
+
+
+class QueryPlanTests(TestCase):
+    """Горячие запросы представлений идут по индексам (EXPLAIN QUERY PLAN)"""
+
+    # Большие таблицы: полный проход по ним или сортировка всей выборки — регрессия
+    HOT_TABLES = {
+        'shop_product', 'shop_review', 'shop_cart', 'shop_cartitem', 'shop_order', 'shop_orderitem',
+        'shop_archivedorder', 'users_customuser',
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'item-{i}', description='Описание',
+                    price=Decimal('100.00') + i, category=self.category, stock=10)
+            for i in range(5)
+        ])
+        self.order = Order.objects.create(user=self.user, status='delivered')
+        Review.objects.create(product=self.products[0], user=self.user, rating=5, comment='Отлично')
+
+    def _plan(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def _regressions(self, plan):
+        """Строки плана с полным проходом большой таблицы или сортировкой для ORDER BY"""
+        bad = []
+        for line in plan:
+            words = line.split()
+            if words[0] == 'SCAN' and words[1] in self.HOT_TABLES and 'USING' not in words:
+                bad.append(line)
+            elif line.startswith('USE TEMP B-TREE FOR') and 'ORDER BY' in line:
+                bad.append(line)
+        return bad
+
+    def assertUsesIndex(self, queryset, index_name):
+        sql, params = queryset.query.sql_with_params()
+        plan = self._plan(sql, params)
+        self.assertTrue(any(index_name in line for line in plan), plan)
+        self.assertEqual(self._regressions(plan), [])
+
+    def test_views_use_indexes(self):
+        """Ни один SELECT горячих страниц не сканирует большие таблицы и не сортирует их целиком"""
+        product = self.products[0]
+        pages = [
+            ('get', reverse('shop:product_list'), {}),
+            ('get', reverse('shop:product_list'), {'sort': 'price'}),
+            ('get', reverse('shop:product_list'), {'category': 'clothing'}),
+            ('get', reverse('shop:product_list'), {'category': 'clothing', 'sort': 'price'}),
+            ('get', reverse('shop:product_detail', args=[product.id]), {}),
+            ('get', reverse('shop:product_reviews', args=[product.id]), {}),
+            ('post', reverse('shop:add_to_cart', args=[product.id]), {}),
+            ('get', reverse('shop:cart_detail'), {}),
+            ('get', reverse('shop:order_history'), {}),
+            ('get', reverse('shop:order_history'), {'status': 'delivered'}),
+            ('get', reverse('shop:order_detail', args=[self.order.id]), {}),
+        ]
+        regressions = []
+        for method, url, data in pages:
+            with CaptureQueriesContext(connection) as queries:
+                getattr(self.client, method)(url, data)
+            for query in queries:
+                if query['sql'].startswith('SELECT'):
+                    bad = self._regressions(self._plan(query['sql']))
+                    if bad:
+                        regressions.append((url, data, query['sql'], bad))
+        self.assertEqual(regressions, [])
+
+    def test_targeted_indexes(self):
+        """Каждый индекс пакета выбирается для своего запроса"""
+        catalog = Product.objects.filter(available=True)
+        self.assertUsesIndex(catalog.order_by('-created', '-id')[:13], 'product_avail_created_idx')
+        self.assertUsesIndex(catalog.order_by('price', 'id')[:13], 'product_avail_price_idx')
+        in_category = catalog.filter(category=self.category)
+        self.assertUsesIndex(in_category.order_by('-created', '-id')[:13], 'product_cat_created_idx')
+        self.assertUsesIndex(in_category.order_by('price', 'id')[:13], 'product_cat_price_idx')
+
+        reviews = Review.objects.filter(product=self.products[0], approved=True)
+        self.assertUsesIndex(reviews.order_by('-created', '-id')[:11], 'review_product_feed_idx')
+
+        orders = Order.objects.filter(user=self.user)
+        self.assertUsesIndex(orders.order_by('-created', '-id')[:11], 'order_user_created_idx')
+        self.assertUsesIndex(orders.filter(status='shipped').order_by('-created', '-id')[:11], 'order_user_status_idx')
+
+        self.assertUsesIndex(CartItem.objects.filter(cart_id=1, product=self.products[0]), 'cartitem_cart_product_idx')
+        self.assertUsesIndex(User.objects.only_deleted().order_by('deleted_at'), 'user_deleted_idx')
+
+
+class QueryBudgetTests(TestCase):
+    """Представления магазина укладываются в объявленный @query_budget на данных реального размера"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', password='TestPass123')
+        reviewers = User.objects.bulk_create([User(username=f'reviewer{i}') for i in range(20)])
+        categories = Category.objects.bulk_create([
+            Category(name=f'Категория {i}', slug=f'category-{i}') for i in range(3)
+        ])
+        # Каждый третий товар на флеш-распродаже: его карточка не кэшируется, а остаток в счетчике
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'item-{i}', description='Хлопковая футболка',
+                    price=Decimal('100.00') + i, category=categories[i % 3], stock=50, flash_sale=i % 3 == 1)
+            for i in range(30)
+        ])
+        flash.reconcile()
+        Review.objects.bulk_create([
+            Review(product=cls.products[0], user=reviewer, rating=4, comment='Хорошо') for reviewer in reviewers
+        ])
+        cls.review = Review.objects.create(product=cls.products[1], user=cls.user, rating=5, comment='Отлично')
+
+        cart = Cart.objects.create(user=cls.user)
+        cls.cart_items = CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=1) for product in cls.products[:10]
+        ])
+        orders = []
+        for _ in range(30):
+            order = Order(user=cls.user, status='delivered')
+            order.fill_summary(cls.products[:10])
+            orders.append(order)
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=1)
+            for order in orders for product in cls.products[:10]
+        ])
+        cls.order = orders[0]
+
+    def setUp(self):
+        cache.clear()
+        self.client.login(username='buyer', password='TestPass123')
+
+    def tearDown(self):
+        cache.clear()
+
+    def _check(self, view, method, url, data=None):
+        with self.settings(QUERY_BUDGET_STRICT=True):
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+        self.assertLessEqual(int(response['X-DB-Queries']), view.query_budget, url)
+        return response
+
+    def test_views_within_budget(self):
+        """Каждое представление магазина укладывается в свой бюджет"""
+        product = self.products[0]
+        cart_item = self.cart_items[0]
+        checks = [
+            (views.home, 'get', reverse('home'), None),
+            (views.product_list, 'get', reverse('shop:product_list'), None),
+            (views.product_list, 'get', reverse('shop:product_list'), {'category': 'category-1', 'sort': 'price'}),
+            (views.product_list, 'get', reverse('shop:product_list'), {'format': 'json'}),
+            (views.product_detail, 'get', reverse('shop:product_detail', args=[self.products[1].id]), None),
+            (views.product_search, 'get', reverse('shop:product_search'), {'q': 'футболка'}),
+            (views.product_detail, 'get', reverse('shop:product_detail', args=[product.id]), None),
+            (views.product_reviews, 'get', reverse('shop:product_reviews', args=[product.id]), None),
+            (views.cart_detail, 'get', reverse('shop:cart_detail'), None),
+            (views.add_to_cart, 'post', reverse('shop:add_to_cart', args=[product.id]), None),
+            (views.update_cart_item, 'post', reverse('shop:update_cart_item', args=[cart_item.id]), {'quantity': 2}),
+            (views.order_create, 'get', reverse('shop:order_create'), None),
+            (views.order_detail, 'get', reverse('shop:order_detail', args=[self.order.id]), None),
+            (views.order_history, 'get', reverse('shop:order_history'), None),
+            (views.order_history, 'get', reverse('shop:order_history'), {'status': 'delivered'}),
+            (views.add_review, 'get', reverse('shop:add_review', args=[self.products[2].id]), None),
+            (views.edit_review, 'get', reverse('shop:edit_review', args=[self.review.id]), None),
+            (views.delete_review, 'get', reverse('shop:delete_review', args=[self.review.id]), None),
+            (views.add_review, 'post', reverse('shop:add_review', args=[self.products[2].id]),
+             {'rating': 4, 'comment': 'Хорошая футболка, ношу каждый день'}),
+            (views.edit_review, 'post', reverse('shop:edit_review', args=[self.review.id]),
+             {'rating': 3, 'comment': 'После стирки села, но в целом неплохо'}),
+            (views.delete_review, 'post', reverse('shop:delete_review', args=[self.review.id]), None),
+            (views.api_locations, 'get', reverse('shop:api_locations'), {'term': 'Мос'}),
+            (views.api_locations, 'get', reverse('shop:api_locations'), {'term': 'Масква', 'mode': 'fuzzy'}),
+            (views.remove_from_cart, 'get', reverse('shop:remove_from_cart', args=[cart_item.id]), None),
+            (views.order_create, 'post', reverse('shop:order_create'), ORDER_FORM_DATA),
+        ]
+        for view, method, url, data in checks:
+            with self.subTest(view=view.__name__, method=method, data=data):
+                self._check(view, method, url, data)
+
+    def _hold_stock(self, product):
+        """Весь остаток товара держат чужие холды: 40 шт. — живой, 10 шт. — просроченный"""
+        holder, late = User.objects.bulk_create([User(username='holder'), User(username='late')])
+        now = timezone.now()
+        StockHold.objects.bulk_create([
+            StockHold(product=product, user=holder, quantity=40, expires_at=now + timedelta(minutes=15)),
+            StockHold(product=product, user=late, quantity=10, expires_at=now - timedelta(minutes=1)),
+        ])
+        Product.objects.filter(pk=product.pk).update(held=50)
+
+    def _assert_worst_path(self, view, method, url, data=None, queries=None):
+        """Самый дорогой путь представления расходует ровно его бюджет (или queries запросов)"""
+        with self.settings(QUERY_BUDGET_STRICT=True), self.assertNumQueries(queries or view.query_budget):
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+
+    def test_add_to_cart_worst_path(self):
+        """Новая корзина и снятие просроченных холдов при нехватке"""
+        Cart.objects.filter(user=self.user).delete()
+        self._hold_stock(self.products[0])
+        self._assert_worst_path(views.add_to_cart, 'post', reverse('shop:add_to_cart', args=[self.products[0].id]))
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 1)
+
+    def test_update_cart_item_worst_path(self):
+        """Снятие просроченных холдов при нехватке"""
+        self._hold_stock(self.products[0])
+        self._assert_worst_path(views.update_cart_item, 'post',
+                                reverse('shop:update_cart_item', args=[self.cart_items[0].id]), {'quantity': 5})
+        self.assertEqual(CartItem.objects.get(pk=self.cart_items[0].pk).quantity, 5)
+
+    def test_order_create_worst_paths(self):
+        """Товара не хватает и после снятия просроченных холдов — на открытии формы и на оформлении"""
+        CartItem.objects.filter(pk=self.cart_items[0].pk).update(quantity=11)
+        orders = Order.objects.count()
+        url = reverse('shop:order_create')
+        # Открытие формы дешевле (флеш-товары не удерживаются): бюджет задает оформление
+        for method, data, queries in [('get', None, 22), ('post', ORDER_FORM_DATA, None)]:
+            with self.subTest(method=method):
+                StockHold.objects.all().delete()
+                User.objects.filter(username__in=['holder', 'late']).delete()
+                self._hold_stock(self.products[0])
+                self._assert_worst_path(views.order_create, method, url, data, queries)
+        self.assertEqual(Order.objects.count(), orders)
+
+    def test_cart_page_does_not_grow_with_items(self):
+        """Корзина и детали заказа стоят одинаково для одной и для десяти позиций"""
+        full_cart = int(self.client.get(reverse('shop:cart_detail'))['X-DB-Queries'])
+        full_order = int(self.client.get(reverse('shop:order_detail', args=[self.order.id]))['X-DB-Queries'])
+        CartItem.objects.exclude(pk=self.cart_items[0].pk).delete()
+        OrderItem.objects.filter(order=self.order).exclude(product=self.products[0]).delete()
+        self.assertEqual(int(self.client.get(reverse('shop:cart_detail'))['X-DB-Queries']), full_cart)
+        self.assertEqual(
+            int(self.client.get(reverse('shop:order_detail', args=[self.order.id]))['X-DB-Queries']), full_order
+        )
+
+    def test_over_budget(self):
+        """Превышение бюджета роняет запрос в строгом режиме и пишется в лог без него"""
+        url = reverse('shop:cart_detail')
+        with mock.patch.object(views.cart_detail, 'query_budget', 1):
+            with self.settings(QUERY_BUDGET_STRICT=True):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(url)
+            with self.settings(QUERY_BUDGET_STRICT=False), self.assertLogs('shop.querybudget', 'WARNING') as logs:
+                response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/shop/cart/: 4 запросов к базе при бюджете 1', logs.output[0])
+        self.assertRegex(response['X-DB-Time-Ms'], r'^\d+\.\d$')
+
+
+class PageCacheTests(TestCase):
+    """Кэш страниц каталога: общее тело, своя шапка и CSRF-токен, сброс по сигналам"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Футболки', slug='t-shirts')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Хлопок', price=Decimal('500.00'),
+            category=self.category, stock=10,
+        )
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+
+    def test_anonymous_page_served_from_cache(self):
+        """Повторный запрос анонима отдается из кэша без запросов к базе"""
+        first = self.client.get(reverse('home'))
+        self.assertEqual(first['X-Page-Cache'], 'miss')
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('home'))
+        self.assertEqual(second['X-Page-Cache'], 'hit')
+        self.assertContains(second, 'Футболка')
+        self.assertContains(second, 'Войти')
+        self.assertNotContains(second, pagecache.AUTH_MARKER)
+        self.assertNotContains(second, pagecache.CSRF_MARKER)
+
+    def test_logged_in_user_gets_own_header(self):
+        """Вошедший пользователь получает то же тело, но со своей шапкой"""
+        self.client.get(reverse('shop:product_list'))
+        self.client.login(username='buyer', password='TestPass123')
+        response = self.client.get(reverse('shop:product_list'))
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, 'Личный кабинет')
+        self.assertNotContains(response, 'Регистрация')
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_cached_form_has_visitor_csrf_token(self):
+        """Форма «В корзину» с закэшированной страницы проходит проверку CSRF"""
+        self.client.get(reverse('shop:product_list'))
+        client = self.client_class(enforce_csrf_checks=True)
+        client.login(username='buyer', password='TestPass123')
+        page = client.get(reverse('shop:product_list'))
+        self.assertEqual(page['X-Page-Cache'], 'hit')
+        token = page.content.decode().split('name="csrfmiddlewaretoken" value="')[1].split('"')[0]
+        response = client.post(reverse('shop:add_to_cart', args=[self.product.id]), {
+            'csrfmiddlewaretoken': token, 'quantity': 1,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(CartItem.objects.filter(cart__user=self.user, product=self.product).exists())
+
+    def test_catalog_changes_invalidate_pages(self):
+        """Сохранение товара, отзыва и категории сбрасывает закэшированные страницы"""
+        url = reverse('shop:product_list')
+        self.client.get(url)
+
+        self.product.name = 'Лонгслив'
+        self.product.save()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Лонгслив')
+
+        Review.objects.create(product=self.product, user=self.user, rating=5, comment='Отлично')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'miss')
+
+        self.category.name = 'Майки'
+        self.category.save()
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Майки')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'hit')
+
+    def test_query_string_order_does_not_matter(self):
+        """Параметры в другом порядке дают ту же страницу, другие параметры — другую"""
+        url = reverse('shop:product_list')
+        self.client.get(url + '?category=t-shirts&sort=price')
+        self.assertEqual(self.client.get(url + '?sort=price&category=t-shirts')['X-Page-Cache'], 'hit')
+        self.assertEqual(self.client.get(url + '?sort=new&category=t-shirts')['X-Page-Cache'], 'miss')
+
+    def test_json_response_not_cached(self):
+        """JSON-вариант списка не проходит через кэш страниц"""
+        response = self.client.get(reverse('shop:product_list'), {'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Page-Cache', response)
+        self.assertEqual(pagecache.stats(), (0, 0))
+
+    def test_stats_command(self):
+        """page_cache_stats показывает долю попаданий и обнуляет счетчики"""
+        for _ in range(4):
+            self.client.get(reverse('home'))
+        self.assertEqual(pagecache.stats(), (3, 1))
+
+        out = StringIO()
+        call_command('page_cache_stats', '--reset', stdout=out)
+        self.assertIn('Попаданий: 3, промахов: 1, доля попаданий: 75.0%', out.getvalue())
+        self.assertEqual(pagecache.stats(), (0, 0))
+
+
+class ProductCardCacheTests(TestCase):
+    """Кэш карточек товаров: один get_many на страницу и перерисовка по Product.updated"""
+
+    template = 'shop/product_card.html'
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Футболки', slug='t-shirts')
+        self.products = [
+            Product.objects.create(
+                name=f'Футболка {i}', slug=f't-shirt-{i}', description='Хлопок', price=Decimal('500.00'),
+                category=self.category, stock=10,
+            )
+            for i in range(30)
+        ]
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+
+    def _render(self):
+        products = Product.objects.filter(pk__in=[product.pk for product in self.products]).order_by('pk')
+        with mock.patch.object(fragments, 'render_to_string', wraps=fragments.render_to_string) as render, \
+                mock.patch.object(fragments.cache, 'get_many', wraps=fragments.cache.get_many) as get_many:
+            cards = fragments.render_cards(products, self.template)
+        self.assertEqual(get_many.call_count, 1)
+        return cards, render.call_count
+
+    def test_only_misses_are_rendered(self):
+        """Второй рендер списка берет все карточки из кэша"""
+        cards, rendered = self._render()
+        self.assertEqual(rendered, 30)
+        self.assertIn('Футболка 0', cards[0])
+        self.assertIn('Футболка 29', cards[29])
+
+        cached_cards, rendered = self._render()
+        self.assertEqual(rendered, 0)
+        self.assertEqual(cached_cards, cards)
+
+    def test_changed_product_card_rerendered(self):
+        """Холд, продажа и новый отзыв меняют updated, и карточка перерисовывается"""
+        self._render()
+        product = self.products[0]
+
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=product, quantity=3)
+        self.assertEqual(hold_cart(self.user, cart.items.select_related('product')), [])
+        cards, rendered = self._render()
+        self.assertEqual(rendered, 1)
+        self.assertIn('В наличии: 7 шт.', cards[0])
+
+        Review.objects.create(product=product, user=self.user, rating=4, comment='Хорошо')
+        cards, rendered = self._render()
+        self.assertEqual(rendered, 1)
+        self.assertIn('4,0 (1)', cards[0])
+
+    def test_flash_sale_cards_not_cached(self):
+        """Остаток флеш-товара берется из счетчика, поэтому его карточка не кэшируется"""
+        product = self.products[0]
+        product.flash_sale = True
+        product.save()
+        self._render()
+        self.assertIsNone(flash.take({product.pk: 4}))
+
+        cards, rendered = self._render()
+        self.assertEqual(rendered, 1)
+        self.assertIn('В наличии: 6 шт.', cards[0])
+
+    def test_catalog_page_reuses_cards(self):
+        """Новая версия каталога перерисовывает страницу, но не карточки"""
+        self.client.get(reverse('shop:product_list'))
+        pagecache.catalog_changed()
+        with mock.patch.object(fragments, 'render_to_string', wraps=fragments.render_to_string) as render:
+            response = self.client.get(reverse('shop:product_list'))
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertEqual(render.call_count, 0)
+        self.assertContains(response, 'class="product-card"', count=views.PRODUCTS_PAGE_SIZE)
+        self.assertNotContains(response, pagecache.CSRF_MARKER)
+
+
+class CacheGenerationTests(TestCase):
+    """Метки поколений сбрасывают кэши процесса после правок из других процессов"""
+
+    def setUp(self):
+        cache.clear()
+        self.builds = 0
+        self.local = generations.LocalCache('test', self._build)
+
+    def _build(self):
+        self.builds += 1
+        return self.builds
+
+    def _bump_elsewhere(self, namespace):
+        # Другой процесс: строка меняется без вызова обработчиков этого процесса
+        CacheGeneration.objects.update_or_create(namespace=namespace, defaults={'version': time.time_ns()})
+
+    def test_other_process_change_seen_after_interval(self):
+        """Чужая смена метки видна не раньше CHECK_INTERVAL, после нее кэш строится заново"""
+        self.assertEqual(self.local.get(), 1)
+        self._bump_elsewhere('test')
+        self.assertEqual(self.local.get(), 1)
+        with mock.patch.object(generations, 'CHECK_INTERVAL', 0):
+            self.assertEqual(self.local.get(), 2)
+            self.assertEqual(self.local.get(), 2)
+
+    def test_table_read_at_most_once_per_interval(self):
+        """Пока интервал не истек, кэш процесса отдается без запросов"""
+        generations.generations.expire()
+        with self.assertNumQueries(1):
+            for _ in range(10):
+                self.local.get()
+
+    def test_local_bump_applies_immediately(self):
+        """Смена метки в своем процессе сбрасывает его кэши сразу"""
+        self.local.get()
+        generations.generations.bump('test')
+        self.assertEqual(self.local.get(), 2)
+        self.assertEqual(CacheGeneration.objects.filter(namespace='test').count(), 1)
+
+    def test_category_edit_from_other_process(self):
+        """Правка категории в другом процессе доходит до списка категорий каталога"""
+        category = Category.objects.create(name='Футболки', slug='t-shirts')
+        self.assertContains(self.client.get(reverse('shop:product_list')), 'Футболки')
+
+        Category.objects.filter(pk=category.pk).update(name='Майки')
+        self._bump_elsewhere(pagecache.CATALOG_NAMESPACE)
+        with mock.patch.object(generations, 'CHECK_INTERVAL', 0):
+            response = self.client.get(reverse('shop:product_list'))
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Майки')
+
+    def test_location_index_and_version(self):
+        """Сохранение локации меняет метку ETag и сбрасывает индекс"""
+        version = locations_version()
+        Location.objects.create(name='Казань')
+        self.assertNotEqual(locations_version(), version)
+        self.assertEqual(location_index.search('каз'), ['Казань'])
+
+    def test_bump_command(self):
+        """bump_cache_generation меняет метки указанных пространств"""
+        self.local.get()
+        out = StringIO()
+        call_command('bump_cache_generation', 'test', 'catalog', stdout=out)
+        self.assertEqual(self.local.get(), 2)
+        self.assertEqual(CacheGeneration.objects.filter(namespace__in=['test', 'catalog']).count(), 2)
+        self.assertIn('Метки сменены: test, catalog', out.getvalue())
+
+
+class StalePageCacheTests(TestCase):
+    """Single-flight кэша страниц: устаревшая копия, пока страницу строит другой запрос"""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Футболки', slug='t-shirts')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Хлопок', price=Decimal('500.00'),
+            category=self.category, stock=10,
+        )
+        self.url = reverse('shop:product_list')
+        digest = pagecache.page_digest(RequestFactory().get(self.url))
+        self.key = pagecache.PAGE_CACHE_KEY.format(digest)
+        self.lock_key = pagecache.LOCK_CACHE_KEY.format(digest)
+
+    def _rename(self, name):
+        self.product.name = name
+        self.product.save()
+
+    def test_stale_copy_while_page_is_rebuilt(self):
+        """Пока блокировку держит другой запрос, отдается устаревшая копия без рендера"""
+        self.client.get(self.url)
+        self._rename('Лонгслив')
+        cache.add(self.lock_key, 1)
+        with mock.patch.object(views, 'keyset_paginate', side_effect=AssertionError):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'stale')
+        self.assertContains(response, 'Футболка')
+
+        cache.delete(self.lock_key)
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Лонгслив')
+        self.assertIsNone(cache.get(self.lock_key))
+
+    def test_cold_page_waits_for_lock_holder(self):
+        """Без старой копии запрос ждет страницу, которую строит держатель блокировки"""
+        cache.add(self.lock_key, 1)
+        version = pagecache.catalog_version()
+
+        def page_built(_):
+            cache.set(self.key, (version, time.time(), '<p>Готово</p>'))
+
+        with mock.patch.object(pagecache.time, 'sleep', side_effect=page_built):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, 'Готово')
+
+    def test_cold_page_built_after_wait_timeout(self):
+        """Не дождавшись чужой страницы, запрос строит ее сам"""
+        cache.add(self.lock_key, 1)
+        with mock.patch.object(pagecache, 'LOCK_WAIT', 0.01):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Футболка')
+
+    def test_stale_copy_when_database_locked(self):
+        """Если база заблокирована, отдается устаревшая копия, а блокировка снимается"""
+        self.client.get(self.url)
+        self._rename('Лонгслив')
+        error = OperationalError('database is locked')
+        with mock.patch.object(views, 'keyset_paginate', side_effect=error), \
+                self.assertLogs('shop.pagecache', 'WARNING'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Page-Cache'], 'stale')
+        self.assertContains(response, 'Футболка')
+        self.assertIsNone(cache.get(self.lock_key))
+
+    def test_database_error_without_copy_raises(self):
+        """Без устаревшей копии ошибка базы не скрывается"""
+        with mock.patch.object(views, 'keyset_paginate', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                self.client.get(self.url)
+
+    def test_page_expires_after_timeout(self):
+        """Страница старше PAGE_CACHE_TIMEOUT строится заново и без правок каталога"""
+        self.client.get(self.url)
+        version, _, body = cache.get(self.key)
+        cache.set(self.key, (version, time.time() - pagecache.PAGE_CACHE_TIMEOUT - 1, body))
+        self.assertEqual(self.client.get(self.url)['X-Page-Cache'], 'miss')
+
+    def test_product_detail_cached_for_anonymous_only(self):
+        """Карточка товара кэшируется для анонимов, вошедшие видят свою страницу"""
+        url = reverse('shop:product_detail', args=[self.product.id])
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, 'Войти')
+
+        User.objects.create_user(username='buyer', password='TestPass123')
+        self.client.login(username='buyer', password='TestPass123')
+        response = self.client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'bypass')
+        self.assertContains(response, 'Личный кабинет')
+        self.assertNotContains(response, pagecache.CSRF_MARKER)
+
+
+class PageCacheSingleFlightTests(TransactionTestCase):
+    """Одновременные запросы после правки каталога строят страницу один раз"""
+
+    THREADS = 8
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Футболки', slug='t-shirts')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Хлопок', price=Decimal('500.00'),
+            category=category, stock=10,
+        )
+        self.url = reverse('shop:product_list')
+
+    def _get(self, outcomes, ready, answered):
+        try:
+            ready.wait()
+            outcomes.append(self.client_class().get(self.url)['X-Page-Cache'])
+            if len(outcomes) == self.THREADS - 1:
+                answered.set()
+        finally:
+            connection.close()
+
+    def test_one_rebuild_per_invalidation(self):
+        """Страницу строит один запрос, остальные получают устаревшую копию, а не строят ее заново"""
+        self.client.get(self.url)
+        self.product.name = 'Лонгслив'
+        self.product.save()
+
+        builds = []
+        outcomes = []
+        ready = threading.Barrier(self.THREADS)
+        answered = threading.Event()
+
+        def slow_paginate(*args, **kwargs):
+            builds.append(1)
+            # Строим страницу, пока остальные запросы не получат ответ (не дольше 5 с)
+            answered.wait(5)
+            return keyset_paginate(*args, **kwargs)
+
+        threads = [
+            threading.Thread(target=self._get, args=(outcomes, ready, answered)) for _ in range(self.THREADS)
+        ]
+        with mock.patch.object(views, 'keyset_paginate', side_effect=slow_paginate):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(outcomes.count('miss'), 1)
+        self.assertEqual(outcomes.count('stale'), self.THREADS - 1, outcomes)
+        self.assertContains(self.client.get(self.url), 'Лонгслив')
+
+
+class ConditionalGetTests(TestCase):
+    """Условные GET карточки товара и заказа: 304 по ETag и Last-Modified без рендера"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='TestPass123')
+        self.category = Category.objects.create(name='Одежда', slug='clothing')
+        self.product = Product.objects.create(
+            name='Футболка', slug='t-shirt', description='Описание',
+            price=Decimal('1500.00'), category=self.category, stock=10
+        )
+        self.url = reverse('shop:product_detail', args=[self.product.id])
+
+    def tearDown(self):
+        cache.clear()
+
+    def _etag(self, url=None):
+        return self.client.get(url or self.url)['ETag']
+
+    def test_product_validators_and_not_modified(self):
+        """Повтор с If-None-Match или If-Modified-Since стоит одного запроса и отдает 304"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(set(response['Cache-Control'].split(', ')), {'no-cache', 'private'})
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_changes_with_page_state(self):
+        """Новый отзыв, холд, переименование категории и вход пользователя меняют ETag"""
+        etags = [self._etag()]
+
+        Review.objects.create(product=self.product, user=self.user, rating=5, comment='Отлично')
+        etags.append(self._etag())
+
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        hold_cart(self.user, list(cart.items.select_related('product')))
+        etags.append(self._etag())
+
+        self.category.name = 'Верхняя одежда'
+        self.category.save()
+        etags.append(self._etag())
+
+        self.client.force_login(self.user)
+        etags.append(self._etag())
+        self.assertEqual(len(set(etags)), len(etags))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etags[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Верхняя одежда')
+
+    def test_unavailable_product_is_not_found(self):
+        """Снятый с продажи товар отдает 404 и на условный запрос"""
+        etag = self._etag()
+        self.product.available = False
+        self.product.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+    def test_order_not_modified_until_cancelled(self):
+        """Заказ отдает 304, пока его не изменили; отмена меняет ETag"""
+        self.client.force_login(self.user)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        order = place_order(Order(user=self.user), cart.items.select_related('product'))
+        url = reverse('shop:order_detail', args=[order.id])
+
+        etag = self._etag(url)
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        cancel_order(order)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_archived_order_not_modified(self):
+        """Заказ из архива тоже отвечает 304, а чужой заказ — 404"""
+        self.client.force_login(self.user)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        order = place_order(Order(user=self.user), cart.items.select_related('product'))
+        Order.objects.filter(pk=order.pk).update(status='delivered', created=timezone.now() - timedelta(days=365))
+        archive.archive_orders()
+        url = reverse('shop:order_detail', args=[order.id])
+
+        etag = self._etag(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        User.objects.create_user(username='other', password='TestPass123')
+        self.client.login(username='other', password='TestPass123')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 404)
@@ -5,7 +5,9 @@ app_name = 'shop'
 
 urlpatterns = [
     path('', views.product_list, name='product_list'),
+    path('search/', views.product_search, name='product_search'),
     path('<int:id>/', views.product_detail, name='product_detail'),
+    path('<int:id>/reviews/', views.product_reviews, name='product_reviews'),
     path('cart/', views.cart_detail, name='cart_detail'),
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:item_id>/', views.remove_from_cart, name='remove_from_cart'),
@@ -1,25 +1,73 @@
+import hashlib
+import uuid
+
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
-from .models import Product, Category, Cart, CartItem, Order, OrderItem, Review
+from django.db.models import Count, Max, Prefetch, Q
+from .models import Product, Category, Cart, CartItem, Order, OrderItem, ArchivedOrder, ArchivedOrderItem, Review
+from .models import StockHold
 from .forms import OrderCreateForm, ReviewForm
 from django.http import JsonResponse
-from .models import Location
-
-
+from django.middleware.csrf import get_token
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.utils import timezone
+from django.utils.formats import date_format
+from .checkout import DuplicateCheckout, InsufficientStock, find_order, place_order
+from .holds import HOLD_TTL, hold_cart, release_expired
+from .locations import location_index, locations_version
+from .fragments import render_cards
+from .generations import LocalCache
+from .pagecache import CATALOG_NAMESPACE, cached_page, render_page
+from .pagination import keyset_paginate, keyset_paginate_merged
+from .querybudget import query_budget
+from .search import search_products
+
+# Категорий немного, и меняются они только из админки
+catalog_categories = LocalCache(CATALOG_NAMESPACE, lambda: list(Category.objects.all()))
+
+
+@query_budget(5)
+@cached_page
 def home(request):
     products = Product.objects.filter(available=True)[:6]
-    categories = Category.objects.all()
+    categories = catalog_categories.get()
 
-    return render(request, 'index.html', {
+    return render_page(request, 'index.html', {
         'products': products,
+        'cards': render_cards(products, 'shop/product_card_home.html'),
         'categories': categories
     })
 
 
+# Сортировки каталога: последним полем всегда id, чтобы курсор был однозначным
+PRODUCT_SORTS = {
+    'new': ('-created', '-id'),
+    'price': ('price', 'id'),
+}
+PRODUCTS_PAGE_SIZE = 12
+
+
+def _product_to_json(product):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'price': str(product.price),
+        'stock': product.stock,
+        'available_to_sell': product.available_to_sell(),
+        'in_stock': product.is_in_stock(),
+        'image': product.image.url if product.image else None,
+        'url': reverse('shop:product_detail', args=[product.id]),
+    }
+
+
+@query_budget(6)
+@cached_page
 def product_list(request):
-    products = Product.objects.filter(available=True)
+    # Рейтинг и остаток флеш-товара карточки приходят JOIN'ом из ProductRatingStats и FlashStock
+    products = Product.objects.filter(available=True).select_related('rating_stats', 'flash_stock')
 
     category_slug = request.GET.get('category')
     if category_slug:
@@ -28,41 +76,201 @@ def product_list(request):
     else:
         current_category = None
 
-    return render(request, 'shop/product_list.html', {
-        'products': products,
-        'categories': Category.objects.all(),
+    sort = request.GET.get('sort')
+    if sort not in PRODUCT_SORTS:
+        sort = 'new'
+
+    page = keyset_paginate(
+        products,
+        PRODUCT_SORTS[sort],
+        cursor=request.GET.get('cursor'),
+        page_size=PRODUCTS_PAGE_SIZE,
+    )
+
+    # JSON-вариант того же списка для бесконечной прокрутки
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [_product_to_json(product) for product in page],
+            'next_cursor': page.next_cursor,
+        })
+
+    return render_page(request, 'shop/product_list.html', {
+        'products': page.items,
+        'cards': render_cards(page.items, 'shop/product_card.html'),
+        'page': page,
+        'sort': sort,
+        'categories': catalog_categories.get(),
         'current_category': current_category
     })
 
 
+REVIEW_ORDERING = ('-created', '-id')
+REVIEWS_PAGE_SIZE = 10
+
+
+def _product_reviews(product):
+    # Пользователь подтягивается JOIN'ом, чтобы шаблон не делал запрос на каждый отзыв
+    return Review.objects.filter(product=product, approved=True).select_related('user')
+
+
+def _review_to_json(review, user):
+    is_own = user.is_authenticated and review.user_id == user.id
+    return {
+        'id': review.id,
+        'username': review.user.username,
+        'rating': review.rating,
+        'stars': review.get_rating_stars(),
+        'comment': review.comment,
+        'created': date_format(timezone.localtime(review.created), 'd.m.Y H:i'),
+        'is_own': is_own,
+        'edit_url': reverse('shop:edit_review', args=[review.id]) if is_own else None,
+        'delete_url': reverse('shop:delete_review', args=[review.id]) if is_own else None,
+    }
+
+
+SEARCH_RESULTS_LIMIT = 48
+
+
+@query_budget(3)
+def product_search(request):
+    """Полнотекстовый поиск по каталогу"""
+    query = request.GET.get('q', '').strip()
+    products = search_products(query, limit=SEARCH_RESULTS_LIMIT) if query else []
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'query': query,
+            'results': [_product_to_json(product) for product in products],
+        })
+
+    return render(request, 'shop/search.html', {
+        'query': query,
+        'products': products,
+    })
+
+
+def _validator_etag(request, *parts):
+    """ETag из частей состояния страницы и посетителя.
+
+    Шапка зависит от пользователя, а формы страницы несут CSRF-токен: после
+    входа или смены токена браузер не должен получить 304 на старую копию.
+    """
+    get_token(request)
+    parts += (request.user.pk, request.META.get('CSRF_COOKIE'))
+    return hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest()
+
+
+def _product_validators(request, id):
+    """(ETag, Last-Modified) карточки товара одним запросом, без отзывов и рендера"""
+    if not hasattr(request, '_validators'):
+        approved = Q(reviews__approved=True)
+        rows = (
+            Product.objects.filter(id=id, available=True)
+            .annotate(
+                reviews_updated=Max('reviews__updated', filter=approved),
+                # Число отзывов замечает удаление отзыва, который не был последним
+                reviews_count=Count('reviews', filter=approved),
+            )
+            .values_list('updated', 'reviews_updated', 'reviews_count', 'flash_stock__remaining',
+                         'category__name', 'category__slug')
+        )
+        # Строка одна: first() добавил бы лишний ORDER BY к GROUP BY
+        row = next(iter(rows[:1]), None)
+        request._validators = (None, None)
+        if row is not None:
+            # Остаток флеш-товара живет в счетчике FlashStock и меняется без записи в строку
+            updated, reviews_updated, reviews_count, stock, category_name, category_slug = row
+            etag = _validator_etag(request, updated, reviews_updated, reviews_count, stock,
+                                   category_name, category_slug)
+            request._validators = (etag, max(filter(None, [updated, reviews_updated])))
+    return request._validators
+
+
+def _order_validators(request, order_id):
+    """(ETag, Last-Modified) заказа: его updated и последняя правка товаров в нем"""
+    if not hasattr(request, '_validators'):
+        request._validators = (None, None)
+        for model in (Order, ArchivedOrder):
+            rows = (
+                model.objects.filter(id=order_id, user=request.user)
+                .annotate(products_updated=Max('items__product__updated'))
+                .values_list('updated', 'products_updated')
+            )
+            row = next(iter(rows[:1]), None)
+            if row is not None:
+                updated, products_updated = row
+                etag = _validator_etag(request, model.__name__, updated, products_updated)
+                request._validators = (etag, max(filter(None, [updated, products_updated])))
+                break
+    return request._validators
+
+
+# Браузер всегда перепроверяет страницу, и повтор стоит одного запроса вместо рендера
+@query_budget(6)
+@cache_control(private=True, no_cache=True)
+@condition(
+    etag_func=lambda request, id: _product_validators(request, id)[0],
+    last_modified_func=lambda request, id: _product_validators(request, id)[1],
+)
+@cached_page(anonymous_only=True)
 def product_detail(request, id):
-    product = get_object_or_404(Product, id=id, available=True)
+    product = get_object_or_404(
+        Product.objects.select_related('category', 'rating_stats', 'flash_stock'), id=id, available=True
+    )
 
-    # Получаем ВСЕ отзывы, не только approved (для тестирования)
-    reviews = Review.objects.filter(product=product)
-    # Или для продакшена: reviews = Review.objects.filter(product=product, approved=True)
+    # Первая страница отзывов рендерится сразу, остальные подгружаются из product_reviews
+    reviews = keyset_paginate(_product_reviews(product), REVIEW_ORDERING, page_size=REVIEWS_PAGE_SIZE)
 
-    # Рассчитываем средний рейтинг
-    if reviews:
-        average_rating = sum(review.rating for review in reviews) / len(reviews)
-    else:
-        average_rating = 0
+    # Средний рейтинг хранится в ProductRatingStats и обновляется сигналами отзывов
+    average_rating = product.average_rating()
 
     # Проверяем, оставлял ли текущий пользователь отзыв
     user_review = None
     if request.user.is_authenticated:
         user_review = Review.objects.filter(product=product, user=request.user).first()
 
-    print(f"DEBUG: Product {product.id}, Reviews: {reviews.count()}, Avg rating: {average_rating}")  # Для отладки
-
-    return render(request, 'shop/product_detail.html', {
+    return render_page(request, 'shop/product_detail.html', {
         'product': product,
-        'reviews': reviews,
+        'reviews': reviews.items,
+        'reviews_next_cursor': reviews.next_cursor,
         'average_rating': average_rating,
         'user_review': user_review
     })
 
 
+@query_budget(4)
+def product_reviews(request, id):
+    """Следующие страницы отзывов товара в JSON"""
+    product = get_object_or_404(Product, id=id, available=True)
+    page = keyset_paginate(
+        _product_reviews(product),
+        REVIEW_ORDERING,
+        cursor=request.GET.get('cursor'),
+        page_size=REVIEWS_PAGE_SIZE,
+    )
+    return JsonResponse({
+        'results': [_review_to_json(review, request.user) for review in page],
+        'next_cursor': page.next_cursor,
+    })
+
+
+def _available_to_user(user, product, quantity):
+    """Сколько товара пользователь может положить в корзину: остаток без чужих холдов.
+
+    Обычно хватает остатка для продажи (available_to_sell). При нехватке, как в
+    hold_cart, снимаются просроченные холды товара, а свой холд пользователя
+    (открытое оформление заказа) прибавляется к доступному.
+    """
+    available = product.available_to_sell()
+    if quantity > available and product.held:
+        release_expired(product_ids=[product.pk])
+        product.refresh_from_db(fields=['stock', 'held'])
+        own = StockHold.objects.filter(user=user, product=product).values_list('quantity', flat=True)
+        available = product.available_to_sell() + sum(own)
+    return available
+
+
+@query_budget(16)
 def add_to_cart(request, product_id):
     if not request.user.is_authenticated:
         messages.error(request, 'Войдите в систему чтобы добавлять товары в корзину')
@@ -76,33 +284,34 @@ def add_to_cart(request, product_id):
         return redirect('shop:product_list')
 
     cart, created = Cart.objects.get_or_create(user=request.user)
+    cart_item = CartItem.objects.filter(cart=cart, product=product).first()
+    quantity = cart_item.quantity + 1 if cart_item else 1
 
-    cart_item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': 1}
-    )
-
-    if not created:
-        # Проверяем, достаточно ли товара на складе для увеличения количества
-        if cart_item.quantity + 1 > product.stock:
-            messages.error(request, f'Недостаточно товара на складе. Доступно: {product.stock} шт.')
-            return redirect('shop:cart_detail')
+    # Проверяем, достаточно ли товара с учетом чужих холдов
+    available = _available_to_user(request.user, product, quantity)
+    if quantity > available:
+        messages.error(request, f'Недостаточно товара на складе. Доступно: {available} шт.')
+        return redirect('shop:cart_detail')
 
-        cart_item.quantity += 1
+    if cart_item:
+        cart_item.quantity = quantity
         cart_item.save()
+    else:
+        CartItem.objects.create(cart=cart, product=product, quantity=quantity)
 
     messages.success(request, f'{product.name} добавлен в корзину')
     return redirect('shop:cart_detail')
 
 
+@query_budget(4)
 def cart_detail(request):
     if not request.user.is_authenticated:
         return render(request, 'shop/cart.html', {'cart_empty': True})
 
     try:
         cart = Cart.objects.get(user=request.user)
-        cart_items = cart.items.all()
+        # Шаблон показывает товар каждой позиции — подтягиваем их JOIN'ом
+        cart_items = list(cart.items.select_related('product'))
         total_price = sum(item.get_total_price() for item in cart_items)
     except Cart.DoesNotExist:
         cart_items = []
@@ -115,6 +324,7 @@ def cart_detail(request):
     })
 
 
+@query_budget(4)
 def remove_from_cart(request, item_id):
     if not request.user.is_authenticated:
         return redirect('users:login')
@@ -125,17 +335,19 @@ def remove_from_cart(request, item_id):
     return redirect('shop:cart_detail')
 
 
+@query_budget(11)
 def update_cart_item(request, item_id):
     if not request.user.is_authenticated:
         return redirect('users:login')
 
     if request.method == 'POST':
         quantity = int(request.POST.get('quantity', 1))
-        cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
+        cart_item = get_object_or_404(CartItem.objects.select_related('product'), id=item_id, cart__user=request.user)
 
-        # Проверяем, достаточно ли товара на складе
-        if quantity > cart_item.product.stock:
-            messages.error(request, f'Недостаточно товара на складе. Доступно: {cart_item.product.stock} шт.')
+        # Проверяем, достаточно ли товара с учетом чужих холдов
+        available = _available_to_user(request.user, cart_item.product, quantity)
+        if quantity > available:
+            messages.error(request, f'Недостаточно товара на складе. Доступно: {available} шт.')
             return redirect('shop:cart_detail')
 
         if quantity > 0:
@@ -149,12 +361,30 @@ def update_cart_item(request, item_id):
     return redirect('shop:cart_detail')
 
 
+def _checkout_token(request):
+    """Ключ идемпотентности из формы заказа или None"""
+    try:
+        return uuid.UUID(request.POST.get('checkout_token', ''))
+    except ValueError:
+        return None
+
+
+@query_budget(26)
 @login_required
 def order_create(request):
     """Оформление заказа"""
+    token = _checkout_token(request) if request.method == 'POST' else None
+    if token is not None:
+        # Повторная отправка уже оформленной формы: корзина пуста, заказ есть
+        order = find_order(request.user, token)
+        if order is not None:
+            messages.info(request, f'Заказ #{order.id} уже оформлен')
+            return redirect('shop:order_detail', order_id=order.id)
+
     try:
         cart = Cart.objects.get(user=request.user)
-        cart_items = cart.items.all()
+        # Товары подтягиваются JOIN'ом: проверка, сумма и заказ не делают запросов на позицию
+        cart_items = list(cart.items.select_related('product'))
     except Cart.DoesNotExist:
         messages.error(request, 'Ваша корзина пуста')
         return redirect('shop:cart_detail')
@@ -163,7 +393,7 @@ def order_create(request):
         messages.error(request, 'Ваша корзина пуста')
         return redirect('shop:cart_detail')
 
-    # Проверяем наличие всех товаров перед оформлением заказа
+    # Предварительная проверка для сообщения пользователю; окончательная — в place_order
     for cart_item in cart_items:
         if cart_item.quantity > cart_item.product.stock:
             messages.error(request,
@@ -179,23 +409,24 @@ def order_create(request):
         if form.is_valid():
             order = form.save(commit=False)
             order.user = request.user
-            order.total_price = total_price
-            order.save()
-
-            # Создаем OrderItem'ы из CartItem'ов и уменьшаем количество на складе
-            for cart_item in cart_items:
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    price=cart_item.product.price,
-                    quantity=cart_item.quantity
-                )
-
-                # Уменьшаем количество товара на складе
-                cart_item.product.reduce_stock(cart_item.quantity)
-
-            # Очищаем корзину
-            cart.items.all().delete()
+            try:
+                # Заказ, списание остатков и очистка корзины — одна транзакция
+                place_order(order, cart_items, token=token)
+            except DuplicateCheckout:
+                # Ту же форму одновременно отправили дважды, и другой запрос успел первым
+                order = find_order(request.user, token)
+                if order is None:
+                    messages.error(request, 'Форма заказа устарела, попробуйте еще раз')
+                    return redirect('shop:cart_detail')
+                messages.info(request, f'Заказ #{order.id} уже оформлен')
+                return redirect('shop:order_detail', order_id=order.id)
+            except InsufficientStock as error:
+                error.product.refresh_from_db(fields=['stock', 'held'])
+                messages.error(request,
+                               f'Недостаточно товара "{error.product.name}" на складе. '
+                               f'Доступно: {error.product.available_to_sell()} шт., в корзине: {error.requested} шт.'
+                               )
+                return redirect('shop:cart_detail')
 
             messages.success(request, f'Заказ #{order.id} успешно оформлен!')
             return redirect('shop:order_detail', order_id=order.id)
@@ -207,51 +438,89 @@ def order_create(request):
         }
         form = OrderCreateForm(initial=initial_data)
 
+        # Резервируем товары, пока покупатель заполняет форму
+        missing = hold_cart(request.user, cart_items)
+        if missing:
+            cart_item = missing[0]
+            cart_item.product.refresh_from_db(fields=['stock', 'held'])
+            messages.error(request,
+                           f'Товар "{cart_item.product.name}" сейчас оформляют другие покупатели. '
+                           f'Доступно: {cart_item.product.available_to_sell()} шт., в корзине: {cart_item.quantity} шт.'
+                           )
+            return redirect('shop:cart_detail')
+
     return render(request, 'shop/order_create.html', {
         'form': form,
         'cart_items': cart_items,
-        'total_price': total_price
+        'total_price': total_price,
+        'hold_minutes': int(HOLD_TTL.total_seconds() // 60),
+        'checkout_token': token or uuid.uuid4()
     })
 
 
+@query_budget(7)
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(
+    etag_func=lambda request, order_id: _order_validators(request, order_id)[0],
+    last_modified_func=lambda request, order_id: _order_validators(request, order_id)[1],
+)
 def order_detail(request, order_id):
     """Детали заказа"""
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    # Позиции с товарами приходят одним запросом, а не запросом на каждую строку шаблона
+    items = Prefetch('items', queryset=OrderItem.objects.select_related('product').order_by('id'))
+    order = Order.objects.filter(id=order_id, user=request.user).prefetch_related(items).first()
+    if order is None:
+        # Старые завершенные заказы перенесены в архив с теми же id (см. shop/archive.py)
+        items = Prefetch('items', queryset=ArchivedOrderItem.objects.select_related('product').order_by('id'))
+        order = get_object_or_404(ArchivedOrder.objects.prefetch_related(items), id=order_id, user=request.user)
     return render(request, 'shop/order_detail.html', {'order': order})
 
 
+ORDER_HISTORY_ORDERING = ('-created', '-id')
+ORDERS_PAGE_SIZE = 10
+
+
+@query_budget(6)
 @login_required
 def order_history(request):
     """История заказов пользователя с фильтрами"""
-    orders = Order.objects.filter(user=request.user).order_by('-created')
+    # Рабочая таблица и архив старых заказов (см. shop/archive.py) читаются вместе
+    sources = [Order.objects.filter(user=request.user), ArchivedOrder.objects.filter(user=request.user)]
+
+    # Счетчики по статусам — один GROUP BY на таблицу вместо COUNT на каждый статус
+    orders_by_status = {status_code: 0 for status_code, _ in Order.STATUS_CHOICES}
+    for orders in sources:
+        counts = orders.order_by().values('status').annotate(total=Count('id')).values_list('status', 'total')
+        for status, total in counts:
+            orders_by_status[status] = orders_by_status.get(status, 0) + total
+    all_orders_count = sum(orders_by_status.values())
 
     # Получаем статус из GET параметра
     status_filter = request.GET.get('status')
     if status_filter:
-        orders = orders.filter(status=status_filter)
-
-    # Получаем все статусы заказов
-    status_choices = Order.STATUS_CHOICES
-
-    # Считаем количество заказов по статусам
-    orders_by_status = {}
-    all_orders = Order.objects.filter(user=request.user)
-    all_orders_count = all_orders.count()
-
-    for status_code, status_name in status_choices:
-        orders_by_status[status_code] = all_orders.filter(status=status_code).count()
+        sources = [orders.filter(status=status_filter) for orders in sources]
+
+    # Карточка рисуется из сводки на самом заказе (item_count, preview) без JOIN'ов с позициями
+    page = keyset_paginate_merged(
+        sources,
+        ORDER_HISTORY_ORDERING,
+        cursor=request.GET.get('cursor'),
+        page_size=ORDERS_PAGE_SIZE,
+    )
 
     return render(request, 'shop/order_history.html', {
-        'orders': orders,
+        'orders': page.items,
+        'page': page,
         'status_filter': status_filter,
-        'status_choices': status_choices,
+        'status_choices': Order.STATUS_CHOICES,
         'all_orders_count': all_orders_count,
         'orders_by_status': orders_by_status
     })
 
 
 # Функции для отзывов
+@query_budget(12)
 @login_required
 def add_review(request, product_id):
     product = get_object_or_404(Product, id=product_id)
@@ -285,6 +554,7 @@ def add_review(request, product_id):
     })
 
 
+@query_budget(10)
 @login_required
 def edit_review(request, review_id):
     review = get_object_or_404(Review, id=review_id, user=request.user)
@@ -306,6 +576,7 @@ def edit_review(request, review_id):
     })
 
 
+@query_budget(10)
 @login_required
 def delete_review(request, review_id):
     review = get_object_or_404(Review, id=review_id, user=request.user)
@@ -322,16 +593,30 @@ def delete_review(request, review_id):
     })
 
 
+# Справочник меняется редко: браузер может сам держать ответ несколько минут,
+# а потом перепроверить его по ETag
+LOCATIONS_CACHE_SECONDS = 300
+
+
+def _locations_etag(request):
+    return f'locations-{locations_version()}'
+
+
+@query_budget(3)
+@cache_control(public=True, max_age=LOCATIONS_CACHE_SECONDS)
+@condition(etag_func=_locations_etag)
 def api_locations(request):
     term = request.GET.get('term', '').strip()
     is_country = request.GET.get('type') == 'country'
-    # Используем istartswith для игнорирования регистра
-    locations = Location.objects.filter(
-        name__istartswith=term,  #
-        is_country=is_country
-    ).order_by('name')[:10]
-    return JsonResponse([loc.name for loc in locations], safe=False)
+    if request.GET.get('mode') == 'fuzzy':
+        # Подсказки с учетом опечаток по триграммам
+        names = location_index.fuzzy_search(term, is_country=is_country, limit=10)
+    else:
+        # Подсказки из префиксного индекса в памяти (см. shop/locations.py)
+        names = location_index.search(term, is_country=is_country, limit=10)
+    return JsonResponse(names, safe=False)
 
 
+@query_budget(2)
 def privacy_policy(request):
     return render(request, 'privacy_policy.html')
\ No newline at end of file
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 05:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0006_alter_customuser_managers'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['deleted_at'], name='user_deleted_idx'),
+        ),
+    ]
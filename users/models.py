@@ -15,6 +15,11 @@ class CustomUser(AbstractUser):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            # Удаленных единицы: частичный индекс нужен only_deleted() и восстановлению,
+            # а полный индекс по is_deleted=False планировщик все равно не выберет
+            models.Index(fields=['deleted_at'], condition=models.Q(is_deleted=True), name='user_deleted_idx'),
+        ]
 
     def soft_delete(self):
         self.is_deleted = True
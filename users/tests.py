@@ -4,6 +4,10 @@ from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
+from decimal import Decimal
+
+from shop.models import Cart, CartItem, Category, Order, OrderItem, Product
+from . import views
 
 User = get_user_model()
 
@@ -255,4 +259,114 @@ class UserManagersTests(TestCase):
 
         users = manager.get_queryset()
         self.assertEqual(users.count(), 1)  # Только неудаленные
-        self.assertEqual(users.first().username, 'user1')
\ No newline at end of file
+        self.assertEqual(users.first().username, 'user1')
+
+
+class UserQueryBudgetTests(TestCase):
+    """Представления пользователей укладываются в объявленный @query_budget на данных реального размера"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='TestPass123')
+        self.deleted = User.objects.create_user(username='gone', email='gone@example.com', password='TestPass123')
+        self.deleted.soft_delete()
+
+        # Профиль показывает корзину и последние заказы: у покупателя их много
+        category = Category.objects.create(name='Футболки', slug='t-shirts')
+        products = Product.objects.bulk_create([
+            Product(name=f'Товар {i}', slug=f'item-{i}', description='Хлопковая футболка',
+                    price=Decimal('100.00') + i, category=category, stock=50)
+            for i in range(10)
+        ])
+        cart = Cart.objects.create(user=self.user)
+        self.cart_items = CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=2) for product in products
+        ])
+        orders = []
+        for _ in range(30):
+            order = Order(user=self.user, status='delivered')
+            order.fill_summary(products)
+            orders.append(order)
+        Order.objects.bulk_create(orders)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=1)
+            for order in orders for product in products
+        ])
+
+    def _check(self, view, method, url, data=None):
+        with self.settings(QUERY_BUDGET_STRICT=True):
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+        self.assertLessEqual(int(response['X-DB-Queries']), view.query_budget, url)
+        return response
+
+    def test_anonymous_views_within_budget(self):
+        """Вход, регистрация и восстановление аккаунта"""
+        self._check(views.register, 'get', reverse('users:register'))
+        self._check(views.register, 'post', reverse('users:register'), {
+            'username': 'newbie', 'email': 'newbie@example.com',
+            'password1': 'StrongPass123!', 'password2': 'StrongPass123!',
+        })
+        self.client.logout()
+        self._check(views.user_login, 'get', reverse('users:login'))
+        self._check(views.restore_account, 'get', reverse('users:restore_account'))
+        self._check(views.restore_account, 'post', reverse('users:restore_account'),
+                    {'username': 'gone', 'email': 'gone@example.com'})
+        self._check(views.confirm_restore, 'get', reverse('users:confirm_restore'))
+        self._check(views.confirm_restore, 'post', reverse('users:confirm_restore'))
+        self.client.logout()
+        self._check(views.user_login, 'post', reverse('users:login'), {'username': 'buyer', 'password': 'TestPass123'})
+
+    def test_profile_views_within_budget(self):
+        """Профиль и его настройки"""
+        self.client.login(username='buyer', password='TestPass123')
+        self._check(views.profile, 'get', reverse('users:profile'))
+        self._check(views.edit_profile, 'get', reverse('users:edit_profile'))
+        self._check(views.change_password, 'get', reverse('users:change_password'))
+        self._check(views.delete_account, 'get', reverse('users:delete_account'))
+        self._check(views.user_logout, 'get', reverse('users:logout'))
+        self.client.login(username='buyer', password='TestPass123')
+        self._check(views.edit_profile, 'post', reverse('users:edit_profile'), {'email': 'not-an-email'})
+        self._check(views.change_password, 'post', reverse('users:change_password'), {'old_password': 'wrong'})
+        self._check(views.delete_account, 'post', reverse('users:delete_account'), {'password': 'wrong'})
+        self._check(views.delete_account, 'post', reverse('users:delete_account'), {'password': 'TestPass123'})
+
+    def test_profile_does_not_grow_with_cart(self):
+        """Профиль стоит одинаково для одной и для десяти позиций корзины"""
+        self.client.login(username='buyer', password='TestPass123')
+        full_cart = self._check(views.profile, 'get', reverse('users:profile'))
+        self.assertContains(full_cart, '2090,00 ₽')
+        CartItem.objects.exclude(pk=self.cart_items[0].pk).delete()
+        one_item = self._check(views.profile, 'get', reverse('users:profile'))
+        self.assertEqual(one_item['X-DB-Queries'], full_cart['X-DB-Queries'])
+
+    def _assert_worst_path(self, view, method, url, data=None):
+        """Самый дорогой путь представления расходует ровно его бюджет"""
+        with self.settings(QUERY_BUDGET_STRICT=True), self.assertNumQueries(view.query_budget):
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+
+    def test_worst_paths_match_budget(self):
+        """Бюджеты сняты с самых дорогих путей: сохранение форм, вход, восстановление, удаление"""
+        self._assert_worst_path(views.register, 'post', reverse('users:register'), {
+            'username': 'newbie', 'email': 'newbie@example.com',
+            'password1': 'StrongPass123!', 'password2': 'StrongPass123!',
+        })
+        # Профиль нового пользователя дороже всего: корзина создается при первом открытии
+        self._assert_worst_path(views.profile, 'get', reverse('users:profile'))
+        self.client.logout()
+        self._assert_worst_path(views.restore_account, 'post', reverse('users:restore_account'),
+                                {'username': 'gone', 'email': 'gone@example.com'})
+        self._assert_worst_path(views.confirm_restore, 'post', reverse('users:confirm_restore'))
+        self.client.logout()
+        self._assert_worst_path(views.user_login, 'post', reverse('users:login'),
+                                {'username': 'buyer', 'password': 'TestPass123'})
+        self._assert_worst_path(views.edit_profile, 'post', reverse('users:edit_profile'),
+                                {'first_name': 'Иван', 'last_name': 'Петров', 'email': 'ivan@example.com'})
+        # Смена пароля пересоздает сессию (update_session_auth_hash) — самый дорогой путь профиля
+        self._assert_worst_path(views.change_password, 'post', reverse('users:change_password'), {
+            'old_password': 'TestPass123', 'new_password1': 'NewStrong123!', 'new_password2': 'NewStrong123!',
+        })
+        self._assert_worst_path(views.delete_account, 'post', reverse('users:delete_account'),
+                                {'password': 'NewStrong123!'})
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_deleted)
@@ -4,12 +4,14 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib import messages
 from .forms import CustomUserCreationForm, ProfileEditForm, CustomPasswordChangeForm
+from shop.querybudget import query_budget
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
 
+@query_budget(5)
 def restore_account(request):
     if request.method == 'POST':
         username = request.POST.get('username', '').strip()
@@ -37,6 +39,7 @@ def restore_account(request):
     return render(request, 'users/restore_account.html')
 
 
+@query_budget(9)
 def user_login(request):
     """Вход с восстановлением удаленных аккаунтов"""
     if request.method == 'POST':
@@ -87,6 +90,7 @@ def user_login(request):
     return render(request, 'users/login.html', {'form': form})
 
 
+@query_budget(13)
 def confirm_restore(request):
     """Страница подтверждения восстановления"""
     user_id = request.session.get('user_to_restore_id')
@@ -122,6 +126,7 @@ def confirm_restore(request):
     return render(request, 'users/confirm_restore.html', {'user': user})
 
 
+@query_budget(11)
 def register(request):
     if request.method == 'POST':
         form = CustomUserCreationForm(request.POST)
@@ -137,17 +142,20 @@ def register(request):
     return render(request, 'users/register.html', {'form': form})
 
 
+@query_budget(4)
 def user_logout(request):
     logout(request)
     messages.success(request, 'Вы успешно вышли из системы')
     return redirect('home')
 
 
+@query_budget(10)
 @login_required
 def profile(request):
     return render(request, 'users/profile.html', {'user': request.user})
 
 
+@query_budget(3)
 @login_required
 def edit_profile(request):
     if request.method == 'POST':
@@ -162,6 +170,7 @@ def edit_profile(request):
     return render(request, 'users/edit_profile.html', {'form': form})
 
 
+@query_budget(12)
 @login_required
 def change_password(request):
     if request.method == 'POST':
@@ -179,6 +188,7 @@ def change_password(request):
     return render(request, 'users/change_password.html', {'form': form})
 
 
+@query_budget(5)
 @login_required
 def delete_account(request):
     if request.method == 'POST':